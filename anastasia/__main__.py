@@ -22,15 +22,203 @@
 
 """Main entrypoint for the package"""
 
+import argparse
+import logging
 import os
+import sys
+from typing import Dict, List, Tuple
 
+import anyio
 import uvicorn
 
+from anastasia.cluster import Cluster, rebalance
+from anastasia.index import INDEX_FILENAME, ImageIndex
+from anastasia.packs import PackStorage
+from anastasia.s3 import S3Storage
+from anastasia.settings import Settings
+from anastasia.storage import FileSystemStorage, StorageBackend
 
-def main() -> None:
+
+def migrate(workers: int) -> None:
     """
-    Main package function.
+    Moves images stored in a flat folder into the sharded layout.
+
+    Folder and depth are read from the configuration file. The webapp can
+    keep running during the migration.
+
+    Arguments:
+    ----------
+    workers: int
+      Number of concurrent threads
+    """
+    settings = Settings()
+    if settings.storage != "files":
+        raise SystemExit(f"storage is {settings.storage}: nothing to migrate")
+    if not settings.shard_depth:
+        raise SystemExit("shard_depth is 0: nothing to migrate")
+
+    storage = FileSystemStorage(os.path.abspath(settings.folder), settings.shard_depth)
+    moved = storage.migrate(workers)
+    print(f"Moved {moved} images")
+
+
+def open_storage(settings: Settings) -> StorageBackend:
+    """
+    Returns the storage backend described by the configuration.
+
+    Arguments:
+    ----------
+    settings: Settings
+      App configuration
+
+    Returns:
+    --------
+    StorageBackend: Storage backend
+    """
+    folder = os.path.abspath(settings.folder)
+    if settings.storage == "pack":
+        return PackStorage(folder, settings.pack_segment_bytes)
+    if settings.storage == "s3":
+        return S3Storage(
+            settings.s3_bucket,
+            prefix=settings.s3_prefix,
+            endpoint_url=settings.s3_endpoint_url,
+            region=settings.s3_region,
+            access_key=settings.s3_access_key,
+            secret_key=settings.s3_secret_key,
+            max_connections=settings.s3_max_connections,
+        )
+    return FileSystemStorage(folder, settings.shard_depth, settings.deduplicate)
+
+
+def reindex(workers: int) -> None:
+    """
+    Rebuilds the metadata index from the content of the image folder.
+
+    Folder and layout are read from the configuration file. The webapp can
+    keep running during the rebuild.
+
+    Arguments:
+    ----------
+    workers: int
+      Number of concurrent threads
+    """
+    settings = Settings()
+    folder = os.path.abspath(settings.folder)
+    storage = open_storage(settings)
+    index = ImageIndex(os.path.join(folder, INDEX_FILENAME))
+    try:
+        indexed = index.rebuild(storage, workers)
+    finally:
+        index.close()
+        storage.close()
+    print(f"Indexed {indexed} images")
+
+
+def rebalance_cluster(workers: int) -> None:
+    """
+    Moves the images this node no longer owns to their owners.
+
+    Nodes and layout are read from the configuration file, which has to
+    describe the cluster as it is after nodes were added, with the nodes
+    before the change in `cluster_previous_nodes`. The webapp can keep
+    running during the rebalance.
+
+    Arguments:
+    ----------
+    workers: int
+      Number of images moved at the same time
+    """
+    settings = Settings()
+    if not settings.cluster_nodes:
+        raise SystemExit("cluster_nodes is empty: nothing to rebalance")
+    if not settings.cluster_secret:
+        raise SystemExit("cluster_secret is empty: nodes refuse images from other nodes")
+
+    storage = open_storage(settings)
+    index = None
+    if settings.enable_index:
+        index = ImageIndex(os.path.join(os.path.abspath(settings.folder), INDEX_FILENAME))
+    cluster = Cluster(
+        settings.cluster_node,
+        settings.cluster_nodes,
+        max_connections=settings.cluster_max_connections,
+        secret=settings.cluster_secret,
+    )
+
+    async def run() -> Tuple[int, Dict[str, str]]:
+        try:
+            return await rebalance(cluster, storage, index, workers)
+        finally:
+            await cluster.close()
+
+    try:
+        moved, failures = anyio.run(run)
+    finally:
+        if index is not None:
+            index.close()
+        storage.close()
+    print(f"Moved {moved} images")
+    if failures:
+        for image_hash, reason in sorted(failures.items()):
+            print(f"Unable to move {image_hash}: {reason}", file=sys.stderr)
+        raise SystemExit(f"{len(failures)} images were not moved, run rebalance again")
+
+
+def compact() -> None:
+    """
+    Reclaims the space of images deleted from pack segments.
 
+    Folder is read from the configuration file. The webapp can keep running
+    during the compaction.
+    """
+    settings = Settings()
+    if settings.storage != "pack":
+        raise SystemExit("storage is not pack: nothing to compact")
+
+    packs = PackStorage(os.path.abspath(settings.folder), settings.pack_segment_bytes)
+    try:
+        reclaimed = packs.compact()
+    finally:
+        packs.close()
+    print(f"Reclaimed {reclaimed} bytes")
+
+
+def check_workers(settings: Settings, workers: int) -> List[str]:
+    """
+    Checks whether the configuration is safe to run in `workers` processes.
+
+    Every worker process holds its own copy of the in-memory state, so the
+    state has to be either shared through the image folder or bounded per
+    process.
+
+    Arguments:
+    ----------
+    settings: Settings
+      App configuration
+    workers: int
+      Number of worker processes
+
+    Returns:
+    --------
+    List[str]: Warnings about the configuration
+    """
+    warnings = []
+    if workers <= 1:
+        return warnings
+
+    if settings.memory_cache_bytes:
+        warnings.append(
+            f"memory_cache_bytes is allocated per worker: {workers} workers can use up to "
+            f"{settings.memory_cache_bytes * workers} bytes. Deletes reach the caches of "
+            "the other workers within seconds"
+        )
+
+    return warnings
+
+
+def serve() -> None:
+    """
     Starts uvicorn and runs `anastasia.create_app()`
     """
 
@@ -38,13 +226,26 @@ def main() -> None:
     host = os.getenv("ANASTASIA_HOST", "0.0.0.0")
     port = int(os.getenv("ANASTASIA_PORT", "8080"))
     debug = os.getenv("ANASTASIA_DEBUG", None) is not None
+    workers = int(os.getenv("ANASTASIA_WORKERS", str(os.cpu_count() or 1)))
+    loop = os.getenv("ANASTASIA_LOOP", "auto")
+    http = os.getenv("ANASTASIA_HTTP", "auto")
+    backlog = int(os.getenv("ANASTASIA_BACKLOG", "2048"))
+    timeout_keep_alive = int(os.getenv("ANASTASIA_KEEPALIVE", "5"))
+    limit_concurrency = os.getenv("ANASTASIA_LIMIT_CONCURRENCY", None)
+    access_log = os.getenv("ANASTASIA_ACCESS_LOG", "true").lower() in ("1", "true", "yes", "on")
 
     if debug:
+        # Reloading works with a single process only
         reload = True
         log_level = "debug"
+        workers = 1
     else:
         reload = False
-        log_level = "debug"
+        log_level = os.getenv("ANASTASIA_LOG_LEVEL", "info")
+
+    logging.basicConfig(level=log_level.upper())
+    for warning in check_workers(Settings(), workers):
+        logging.getLogger("anastasia").warning(warning)
 
     # Launch webapp through uvicorn
     uvicorn.run(
@@ -53,11 +254,63 @@ def main() -> None:
         port=port,
         log_level=log_level,
         reload=reload,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=backlog,
+        timeout_keep_alive=timeout_keep_alive,
+        limit_concurrency=int(limit_concurrency) if limit_concurrency else None,
+        access_log=access_log,
         factory=True,
         server_header=False,
         proxy_headers=True,
     )
 
 
+def main() -> None:
+    """
+    Main package function.
+
+    Parses command line arguments and runs the requested command. Defaults
+    to `serve`.
+    """
+    parser = argparse.ArgumentParser(
+        prog="anastasia", description="VERY minimalistic imgur-alike app"
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="run the webapp (default)")
+    migrate_parser = commands.add_parser(
+        "migrate", help="move images from a flat folder into the sharded layout"
+    )
+    migrate_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of concurrent threads"
+    )
+    reindex_parser = commands.add_parser(
+        "reindex", help="rebuild the metadata index from the image folder"
+    )
+    reindex_parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of concurrent threads"
+    )
+    commands.add_parser("compact", help="reclaim the space of images deleted from pack segments")
+    rebalance_parser = commands.add_parser(
+        "rebalance", help="move the images this node no longer owns to their owners"
+    )
+    rebalance_parser.add_argument(
+        "--workers", type=int, default=8, help="number of images moved at the same time"
+    )
+    arguments = parser.parse_args()
+
+    if arguments.command == "migrate":
+        migrate(arguments.workers)
+    elif arguments.command == "reindex":
+        reindex(arguments.workers)
+    elif arguments.command == "compact":
+        compact()
+    elif arguments.command == "rebalance":
+        rebalance_cluster(arguments.workers)
+    else:
+        serve()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,155 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Admission control.
+
+This module provides `Lane` which caps how many requests of a kind are
+handled at the same time, and `TokenBuckets` which caps how many requests
+each client sends per second.
+
+State is kept per worker and only ever updated from the event loop thread,
+so it needs no locking.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import anyio
+
+# Number of clients tracked before the least recently seen one is forgotten
+MAX_CLIENTS = 10000
+
+
+class Lane:
+    """
+    Lets `concurrency` requests in at the same time.
+
+    Up to `queue` more requests wait for their turn, for up to `timeout`
+    seconds each. Requests that find the queue full or outlive the timeout
+    are refused, so that they can be answered right away rather than piling
+    up.
+
+    Arguments:
+    ----------
+    concurrency: int
+      Requests handled at the same time. 0 means unlimited
+    queue: int
+      Requests allowed to wait for their turn
+    timeout: float
+      Seconds requests wait for their turn
+    """
+
+    def __init__(self, concurrency: int, queue: int, timeout: float):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.waiting = 0
+        self._semaphore = anyio.Semaphore(concurrency) if concurrency else None
+
+    async def acquire(self) -> bool:
+        """
+        Waits for a turn.
+
+        Returns:
+        --------
+        bool: True if the request got its turn and has to `release()` it,
+              False if it was refused
+        """
+        if self._semaphore is None:
+            return True
+        if self._semaphore.value:
+            await self._semaphore.acquire()
+            return True
+        if self.waiting >= self.queue:
+            return False
+
+        self.waiting += 1
+        try:
+            with anyio.move_on_after(self.timeout):
+                await self._semaphore.acquire()
+                return True
+        finally:
+            self.waiting -= 1
+        return False
+
+    def release(self) -> None:
+        """Gives the turn back"""
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+
+class TokenBuckets:
+    """
+    Per-client token buckets.
+
+    Every client gets a bucket of `burst` tokens that refills at `rate`
+    tokens per second, and every request takes a token. Up to `MAX_CLIENTS`
+    buckets are kept, the least recently used one is forgotten to make room
+    for a new client, as if that client were new as well.
+
+    Arguments:
+    ----------
+    rate: float
+      Tokens added to buckets per second
+    burst: int
+      Size of buckets
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        # Client: (tokens, monotonic time tokens were counted at), least
+        # recently used first
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def take(self, client: str) -> Optional[float]:
+        """
+        Takes a token from the bucket of `client`.
+
+        Arguments:
+        ----------
+        client: str
+          Client address
+
+        Returns:
+        --------
+        Optional[float]: None if a token was taken, otherwise seconds until
+                         the bucket holds one
+        """
+        now = time.monotonic()
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            tokens = self.burst
+            if len(self._buckets) >= MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self._buckets.move_to_end(client)
+
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self._buckets[client] = (tokens - 1, now)
+        return None
@@ -0,0 +1,256 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+GUI assets.
+
+This module provides `StaticAssets`, an ASGI app that serves the files of
+a folder from memory. Files are read and compressed once, when the app is
+created, and every request is answered with the variant the client accepts,
+with a strong ETag so that page loads are revalidated with 304.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+from starlette.types import Receive, Scope, Send
+
+from anastasia.responses import is_not_modified
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Content encodings, in order of preference
+ENCODINGS = ("br", "gzip")
+
+
+class Asset(NamedTuple):
+    """A file held in memory, with its compressed variants"""
+
+    media_type: str
+    # Hex digest of the uncompressed content
+    digest: str
+    # Content encoding ("identity" for none): body
+    bodies: Dict[str, bytes]
+
+
+def compress(content: bytes) -> Dict[str, bytes]:
+    """
+    Compresses `content` with every available content encoding.
+
+    Variants that are not smaller than the content are left out.
+
+    Arguments:
+    ----------
+    content: bytes
+      Uncompressed content
+
+    Returns:
+    --------
+    Dict[str, bytes]: Bodies by content encoding, including "identity"
+    """
+    bodies = {"identity": content}
+    # mtime is fixed, so that the same content always compresses the same
+    variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(content, quality=11)
+    for encoding, body in variants.items():
+        if len(body) < len(content):
+            bodies[encoding] = body
+    return bodies
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """
+    Returns the content encodings an Accept-Encoding header asks for.
+
+    Arguments:
+    ----------
+    accept_encoding: str
+      Accept-Encoding request header
+
+    Returns:
+    --------
+    Set[str]: Accepted content encodings, "*" included
+    """
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        encoding, *parameters = item.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(encoding.strip())
+    return accepted
+
+
+class StaticAssets:
+    """
+    Serves the files of `directory` from memory.
+
+    `/` and paths ending with `/` are answered with the `index.html` file
+    of the folder. Files and folders starting with `.` are not served.
+
+    Arguments:
+    ----------
+    directory: str
+      Folder the files are read from
+    max_age: int
+      Seconds clients and proxies are allowed to cache the files for.
+      0 means clients have to revalidate at every request
+    """
+
+    def __init__(self, directory: str, max_age: int = 0):
+        self.directory = directory
+        if max_age > 0:
+            self.cache_control = f"public, max-age={max_age}"
+        else:
+            self.cache_control = "public, no-cache"
+        self.assets: Dict[str, Asset] = {}
+        for root, folders, files in os.walk(directory):
+            folders[:] = [folder for folder in folders if not folder.startswith(".")]
+            for filename in files:
+                if filename.startswith("."):
+                    continue
+                file_path = os.path.join(root, filename)
+                path = "/" + os.path.relpath(file_path, directory).replace(os.sep, "/")
+                self.assets[path] = self.load(file_path)
+
+    @staticmethod
+    def load(file_path: str) -> Asset:
+        """
+        Reads and compresses a file.
+
+        Arguments:
+        ----------
+        file_path: str
+          Path of the file
+
+        Returns:
+        --------
+        Asset: The file and its compressed variants
+        """
+        with open(file_path, "rb") as file:
+            content = file.read()
+        media_type = mimetypes.guess_type(file_path)[0] or "application/octet-stream"
+        if media_type.startswith("text/"):
+            media_type = f"{media_type}; charset=utf-8"
+        return Asset(media_type, hashlib.sha256(content).hexdigest()[:32], compress(content))
+
+    def lookup(self, scope: Scope) -> Optional[Asset]:
+        """
+        Returns the asset a request asks for.
+
+        Arguments:
+        ----------
+        scope: Scope
+          ASGI connection scope
+
+        Returns:
+        --------
+        Optional[Asset]: The asset or None if there is none
+        """
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path) :]
+        if not path.startswith("/"):
+            path = f"/{path}"
+        if path.endswith("/"):
+            path = f"{path}index.html"
+        return self.assets.get(path)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        assert scope["type"] == "http"  # nosec B101
+
+        if scope["method"] not in ("GET", "HEAD"):
+            response = PlainTextResponse(
+                "Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"}
+            )
+            await response(scope, receive, send)
+            return
+
+        asset = self.lookup(scope)
+        if asset is None:
+            await PlainTextResponse("Not Found", status_code=404)(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+        encoding = "identity"
+        for candidate in ENCODINGS:
+            if candidate in asset.bodies and (candidate in accepted or "*" in accepted):
+                encoding = candidate
+                break
+        body = asset.bodies[encoding]
+
+        headers = {
+            "cache-control": self.cache_control,
+            "etag": (
+                f'"{asset.digest}"' if encoding == "identity" else f'"{asset.digest}-{encoding}"'
+            ),
+            "vary": "accept-encoding",
+        }
+        if is_not_modified(request_headers, headers):
+            await self.respond(send, 304, headers)
+            return
+
+        headers["content-type"] = asset.media_type
+        headers["content-length"] = str(len(body))
+        if encoding != "identity":
+            headers["content-encoding"] = encoding
+        await self.respond(send, 200, headers, b"" if scope["method"] == "HEAD" else body)
+
+    @staticmethod
+    async def respond(send: Send, status: int, headers: Dict[str, str], body: bytes = b"") -> None:
+        """
+        Sends a response.
+
+        Arguments:
+        ----------
+        send: Send
+          ASGI send channel
+        status: int
+          Status code of the response
+        headers: Dict[str, str]
+          Headers of the response
+        body: bytes
+          Body of the response
+        """
+        raw_headers: List[Tuple[bytes, bytes]] = [
+            (name.encode(), value.encode()) for name, value in headers.items()
+        ]
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": body})
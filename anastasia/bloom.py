@@ -0,0 +1,369 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Negative lookup filter.
+
+This module provides `BloomFilter` which tells whether an image might exist
+without touching the storage, so that requests for images that don't exist
+are answered straight away.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional
+
+# Folder, within the image folder, that holds the filter
+BLOOM_FOLDER = ".bloom"
+
+# Filter file, its replacement while being rebuilt and the lock files
+FILTER_FILENAME = "filter"
+REBUILD_FILENAME = "filter.new"
+BLOOM_LOCK = "lock"
+REBUILD_LOCK = "rebuild.lock"
+
+# Magic, bits, hashes, state, capacity, added, deleted, build seconds
+HEADER = struct.Struct("<8sQIIQQQd")
+HEADER_SIZE = 64
+MAGIC = b"ANBLOOM1"
+
+# Offsets of the header fields that change after the filter is created
+STATE_OFFSET = 20
+ADDED_OFFSET = 32
+DELETED_OFFSET = 40
+BUILD_SECONDS_OFFSET = 48
+
+# Filter states
+BUILDING = 0
+READY = 1
+RETIRED = 2
+
+# Number of hashes added per lock acquisition while rebuilding
+REBUILD_BATCH_SIZE = 10000
+
+
+class BloomFilter:
+    """
+    Bloom filter of the names of the stored images.
+
+    The filter lives in a file within `folder` that every worker process
+    maps in memory, so that uploads made by any worker are seen by all of
+    them and the filter is held in memory once. Lookups only read the
+    mapping. Writers serialize on a lock file.
+
+    Removing names from a Bloom filter is not possible, deletes are counted
+    instead. Deleted names and names added beyond the capacity raise the
+    false positive rate, so the filter is rebuilt from the storage when the
+    estimated rate is twice `error_rate`. The replacement is written next to
+    the filter, uploads made meanwhile are added to both, and workers switch
+    to it once it is complete. Names the rebuild may have missed, because
+    they were stored while it was listing the storage, have to be added
+    again once stored.
+
+    A filter that has not been built yet answers that every image might
+    exist.
+
+    Arguments:
+    ----------
+    folder: str
+      Image folder
+    capacity: int (optional)
+      Number of images the filter is sized for. Grows with rebuilds
+      (default: 1000000)
+    error_rate: float (optional)
+      Target false positive rate (default: 0.01)
+    """
+
+    def __init__(self, folder: str, capacity: int = 1000000, error_rate: float = 0.01):
+        self.root = os.path.join(folder, BLOOM_FOLDER)
+        self.path = os.path.join(self.root, FILTER_FILENAME)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._map: Optional[mmap.mmap] = None
+        self._bits = 0
+        self._hashes = 0
+
+        os.makedirs(self.root, exist_ok=True)
+        self._open()
+
+    def _open(self) -> None:
+        """Maps the current filter file, if any"""
+        try:
+            with open(self.path, "r+b") as file:
+                mapping = mmap.mmap(file.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            # Missing or empty
+            return
+
+        magic, bits, hashes, *_ = HEADER.unpack_from(mapping)
+        if magic != MAGIC or len(mapping) < HEADER_SIZE + bits // 8:
+            return
+        # Mappings are replaced, not closed, since lookups may be using them
+        self._bits, self._hashes = bits, hashes
+        self._map = mapping
+
+    def _state(self) -> int:
+        """Returns the state of the current filter"""
+        mapping = self._map
+        if mapping is None or _read(mapping, STATE_OFFSET, "<I") == RETIRED:
+            self._open()
+            mapping = self._map
+        if mapping is None:
+            return BUILDING
+        return _read(mapping, STATE_OFFSET, "<I")
+
+    @property
+    def ready(self) -> bool:
+        """Whether the filter has been built"""
+        return self._state() == READY
+
+    def __contains__(self, image_hash: str) -> bool:
+        if not self.ready:
+            return True
+        mapping, bits, hashes = self._map, self._bits, self._hashes
+        for position in _positions(image_hash, bits, hashes):
+            if not mapping[HEADER_SIZE + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    @contextmanager
+    def _exclusive(self, name: str = BLOOM_LOCK, blocking: bool = True) -> Iterator[bool]:
+        """Holds a lock shared by all of the processes. Yields whether it was acquired"""
+        with open(os.path.join(self.root, name), "a+b") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add(self, image_hash: str, again: bool = False) -> None:
+        """
+        Adds image `image_hash` to the filter and to its replacement, if any.
+
+        This blocks, so it is meant to be called from worker threads.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        again: bool (optional)
+          Whether the image was added already, so that it is not counted
+          twice (default: False)
+        """
+        with self._exclusive():
+            self._state()
+            if self._map is not None:
+                _add(self._map, self._bits, self._hashes, [image_hash], not again)
+            try:
+                with open(os.path.join(self.root, REBUILD_FILENAME), "r+b") as file:
+                    replacement = mmap.mmap(file.fileno(), 0)
+            except (FileNotFoundError, ValueError):
+                return
+            with replacement:
+                _, bits, hashes, *_ = HEADER.unpack_from(replacement)
+                _add(replacement, bits, hashes, [image_hash], not again)
+
+    def discard(self, image_hash: str) -> None:
+        """
+        Records that image `image_hash` has been deleted.
+
+        The image stays in the filter until it is rebuilt. This blocks, so
+        it is meant to be called from worker threads.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        """
+        with self._exclusive():
+            self._state()
+            if self._map is not None:
+                deleted = _read(self._map, DELETED_OFFSET, "<Q")
+                struct.pack_into("<Q", self._map, DELETED_OFFSET, deleted + 1)
+
+    def false_positive_rate(self) -> Optional[float]:
+        """
+        Estimates the false positive rate from the number of added images.
+
+        Returns:
+        --------
+        Optional[float]: Estimated rate or None if the filter has not been built
+        """
+        if not self.ready:
+            return None
+        added = _read(self._map, ADDED_OFFSET, "<Q")
+        return (1 - math.exp(-self._hashes * added / self._bits)) ** self._hashes
+
+    def needs_rebuild(self) -> bool:
+        """
+        Tells whether the filter is missing or too crowded.
+
+        Returns:
+        --------
+        bool: True if the filter has to be rebuilt
+        """
+        rate = self.false_positive_rate()
+        return rate is None or rate > 2 * self.error_rate
+
+    def rebuild(self, image_hashes: Iterable[str]) -> bool:
+        """
+        Builds the filter from `image_hashes` and replaces the current one.
+
+        The filter is sized for twice the images that were alive in the
+        current filter, and never for less than `capacity`. Only one process
+        at a time rebuilds the filter. This blocks, so it is meant to be
+        called from worker threads.
+
+        Arguments:
+        ----------
+        image_hashes: Iterable[str]
+          Names of the stored images
+
+        Returns:
+        --------
+        bool: False if another process is rebuilding the filter
+        """
+        with self._exclusive(REBUILD_LOCK, blocking=False) as acquired:
+            if not acquired:
+                return False
+
+            started = time.perf_counter()
+            capacity = self.capacity
+            if self._state() != BUILDING:
+                added = _read(self._map, ADDED_OFFSET, "<Q")
+                deleted = _read(self._map, DELETED_OFFSET, "<Q")
+                capacity = max(capacity, 2 * (added - deleted))
+            bits, hashes = dimensions(capacity, self.error_rate)
+
+            rebuild_path = os.path.join(self.root, REBUILD_FILENAME)
+            with self._exclusive():
+                with open(rebuild_path, "w+b") as file:
+                    file.truncate(HEADER_SIZE + bits // 8)
+                    replacement = mmap.mmap(file.fileno(), 0)
+                HEADER.pack_into(replacement, 0, MAGIC, bits, hashes, BUILDING, capacity, 0, 0, 0)
+
+            with replacement:
+                batch: List[str] = []
+                for image_hash in image_hashes:
+                    batch.append(image_hash)
+                    if len(batch) >= REBUILD_BATCH_SIZE:
+                        with self._exclusive():
+                            _add(replacement, bits, hashes, batch)
+                        batch = []
+
+                with self._exclusive():
+                    _add(replacement, bits, hashes, batch)
+                    struct.pack_into(
+                        "<d", replacement, BUILD_SECONDS_OFFSET, time.perf_counter() - started
+                    )
+                    struct.pack_into("<I", replacement, STATE_OFFSET, READY)
+                    replacement.flush()
+
+                    # Workers still using the current filter switch on next use
+                    try:
+                        with open(self.path, "r+b") as file:
+                            os.replace(rebuild_path, self.path)
+                            os.pwrite(file.fileno(), struct.pack("<I", RETIRED), STATE_OFFSET)
+                    except FileNotFoundError:
+                        os.replace(rebuild_path, self.path)
+                    self._open()
+
+        return True
+
+    def stats(self) -> Optional[dict]:
+        """
+        Returns the filter counters.
+
+        Returns:
+        --------
+        Optional[dict]: Size in bytes, added images, deleted images, estimated
+        false positive rate and seconds the last rebuild took. None if the
+        filter has not been built
+        """
+        rate = self.false_positive_rate()
+        if rate is None:
+            return None
+        return {
+            "bytes": self._bits // 8,
+            "added": _read(self._map, ADDED_OFFSET, "<Q"),
+            "deleted": _read(self._map, DELETED_OFFSET, "<Q"),
+            "false_positive_rate": rate,
+            "rebuild_seconds": _read(self._map, BUILD_SECONDS_OFFSET, "<d"),
+        }
+
+
+def dimensions(capacity: int, error_rate: float) -> tuple:
+    """
+    Returns the number of bits and hashes of a filter.
+
+    Arguments:
+    ----------
+    capacity: int
+      Number of items
+    error_rate: float
+      False positive rate at `capacity` items
+
+    Returns:
+    --------
+    tuple: Number of bits, multiple of 8, and number of hashes
+    """
+    capacity = max(capacity, 1)
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    bits = max(8, (bits + 7) // 8 * 8)
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+def _read(mapping: mmap.mmap, offset: int, fmt: str):
+    """Reads a header field"""
+    return struct.unpack_from(fmt, mapping, offset)[0]
+
+
+def _positions(image_hash: str, bits: int, hashes: int) -> Iterator[int]:
+    """Yields the bits of `image_hash` by double hashing"""
+    digest = hashlib.blake2b(image_hash.encode(), digest_size=16).digest()
+    first = int.from_bytes(digest[:8], "little")
+    second = int.from_bytes(digest[8:], "little") | 1
+    for number in range(hashes):
+        yield (first + number * second) % bits
+
+
+def _add(
+    mapping: mmap.mmap, bits: int, hashes: int, image_hashes: List[str], count: bool = True
+) -> None:
+    """Sets the bits of `image_hashes` and counts them, unless `count` is False"""
+    for image_hash in image_hashes:
+        for position in _positions(image_hash, bits, hashes):
+            mapping[HEADER_SIZE + (position >> 3)] |= 1 << (position & 7)
+    if count:
+        added = _read(mapping, ADDED_OFFSET, "<Q")
+        struct.pack_into("<Q", mapping, ADDED_OFFSET, added + len(image_hashes))
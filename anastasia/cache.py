@@ -0,0 +1,205 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+In-memory image cache.
+
+This module provides `ImageCache` which keeps the content of recently
+requested images in memory within a byte budget.
+"""
+
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+# Seconds after which a cached image is checked against the storage again.
+# Bounds how long other worker processes keep serving a deleted image.
+REVALIDATE_AFTER = 10
+
+
+class CachedImage(NamedTuple):
+    """Image held by `ImageCache`"""
+
+    # Image content
+    content: bytes
+    # Content-Type of the image
+    media_type: str
+    # Hex digest of the content
+    checksum: str
+    # Modification time of the image file
+    mtime: float
+    # When the image was last found in the storage (monotonic clock)
+    checked_at: float
+
+
+class ImageCache:
+    """
+    Least recently used cache of image contents.
+
+    Images larger than `max_item_bytes` are never cached. When the total size
+    of the cached images exceeds `max_bytes`, least recently used images are
+    evicted. All methods are meant to be called from the event loop, so no
+    locking is involved.
+
+    Arguments:
+    ----------
+    max_bytes: int
+      Total size of the cached images in bytes
+    max_item_bytes: int
+      Maximum size of a single image in bytes
+    """
+
+    def __init__(self, max_bytes: int, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images: OrderedDict = OrderedDict()
+
+    def accepts(self, size: int) -> bool:
+        """
+        Tells whether an image of `size` bytes can be cached.
+
+        Arguments:
+        ----------
+        size: int
+          Image size in bytes
+
+        Returns:
+        --------
+        bool: True if the image can be cached
+        """
+        return size <= self.max_item_bytes
+
+    def get(self, image_hash: str) -> Optional[CachedImage]:
+        """
+        Returns the cached image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[CachedImage]: The cached image or None
+        """
+        try:
+            self._images.move_to_end(image_hash)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self._images[image_hash]
+
+    def put(
+        self, image_hash: str, content: bytes, media_type: str, checksum: str, mtime: float
+    ) -> None:
+        """
+        Adds image `image_hash` to the cache, evicting other images if needed.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        content: bytes
+          Image content
+        media_type: str
+          Content-Type of the image
+        checksum: str
+          Hex digest of the content
+        mtime: float
+          Modification time of the image file
+        """
+        if not self.accepts(len(content)):
+            return
+
+        self.invalidate(image_hash)
+        self._images[image_hash] = CachedImage(
+            content, media_type, checksum, mtime, time.monotonic()
+        )
+        self.size += len(content)
+
+        while self.size > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.size -= len(evicted.content)
+            self.evictions += 1
+
+    def touch(self, image_hash: str) -> None:
+        """
+        Records that image `image_hash` has just been found in the storage.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        """
+        image = self._images.get(image_hash)
+        if image is not None:
+            self._images[image_hash] = image._replace(checked_at=time.monotonic())
+
+    def is_stale(self, image: CachedImage) -> bool:
+        """
+        Tells whether `image` has to be checked against the storage again.
+
+        Arguments:
+        ----------
+        image: CachedImage
+          The cached image
+
+        Returns:
+        --------
+        bool: True if the image has not been checked for `REVALIDATE_AFTER`
+        """
+        return time.monotonic() - image.checked_at > REVALIDATE_AFTER
+
+    def invalidate(self, image_hash: str) -> None:
+        """
+        Removes image `image_hash` from the cache.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        """
+        image = self._images.pop(image_hash, None)
+        if image is not None:
+            self.size -= len(image.content)
+
+    def stats(self) -> dict:
+        """
+        Returns cache counters.
+
+        Returns:
+        --------
+        dict: Number of hits, misses, evictions, cached images and bytes
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self._images),
+            "bytes": self.size,
+        }
@@ -0,0 +1,523 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Cluster mode.
+
+This module provides `Cluster` which spreads images over several nodes
+through a consistent-hash ring, so that every node stores and serves the
+images it owns and hands the others over to their owners.
+
+New images are not placed by the ring: the node that receives an upload
+picks a random name that it owns, so uploads never cross the cluster and
+any node can take them. The price is that data is spread like the
+traffic of the load balancer rather than evenly over the ring: a node
+that receives more uploads stores more images, and rebalancing does not
+change that because the names stay with their node. Balance uploads
+evenly to keep nodes even.
+"""
+
+import bisect
+import hashlib
+import hmac
+import logging
+import secrets
+import socket
+import sqlite3
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from urllib.parse import urlsplit
+
+import anyio
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+
+from anastasia.index import ImageIndex
+from anastasia.storage import ImageRecord, StorageBackend
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+# Points every node gets on the ring, so that images are spread evenly
+VNODES = 100
+
+# Header of requests forwarded by another node, which are never forwarded again
+FORWARDED_HEADER = "X-Anastasia-Forwarded"
+
+# Header that carries `secret` in requests between nodes
+SECRET_HEADER = "X-Anastasia-Secret"
+
+# Request headers passed on to the owner
+FORWARDED_HEADERS = (
+    "accept",
+    "content-length",
+    "content-type",
+    "if-modified-since",
+    "if-none-match",
+    "if-range",
+    "range",
+    "upload-length",
+    "upload-offset",
+)
+
+# Response headers that only apply to the connection to the owner, or that
+# the server of this node sets
+HOP_BY_HOP_HEADERS = (
+    "connection",
+    "date",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "server",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+)
+
+# Path of images on every node
+IMAGE_PATH = "/api/3/image/{image_hash}"
+
+
+class ClusterError(Exception):
+    """Raised when a node can't be reached"""
+
+
+def _point(key: str) -> int:
+    """Returns the position of `key` on the ring"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring.
+
+    Every node is placed on the ring `vnodes` times, and keys belong to the
+    node that follows them. Adding a node only moves the keys that fall
+    right before its points.
+
+    Arguments:
+    ----------
+    nodes: Iterable[str]
+      Node URLs
+    vnodes: int (optional)
+      Points per node (default: VNODES)
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = VNODES):
+        points: List[Tuple[int, str]] = sorted(
+            (_point(f"{node}#{number}"), node) for node in nodes for number in range(vnodes)
+        )
+        if not points:
+            raise ValueError("The ring needs at least one node")
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> str:
+        """
+        Returns the node `key` belongs to.
+
+        Arguments:
+        ----------
+        key: str
+          Image name or upload session identifier
+
+        Returns:
+        --------
+        str: Node URL
+        """
+        position = bisect.bisect(self._points, _point(key)) % len(self._points)
+        return self._nodes[position]
+
+
+class Cluster:
+    """
+    Nodes images are spread over.
+
+    Requests for images owned by other nodes are either proxied through a
+    pool of HTTP connections or redirected. While images are rebalanced
+    after nodes were added, images that are not found locally are looked
+    up on their owner according to `previous_nodes`.
+
+    Arguments:
+    ----------
+    node: str
+      URL of this node, one of `nodes`
+    nodes: Sequence[str]
+      URLs of every node
+    previous_nodes: Sequence[str] (optional)
+      URLs of every node before the latest change. Empty means no change
+      (default: empty)
+    redirect: bool (optional)
+      Redirect clients to owners rather than proxy requests (default: False)
+    max_connections: int (optional)
+      Size of the pool of connections to the other nodes (default: 100)
+    transport: httpx.AsyncBaseTransport (optional)
+      Transport to the other nodes (default: HTTP)
+    secret: str (optional)
+      Secret shared by the nodes, that lets them store images under names
+      of their choice. Empty means that they can't (default: empty)
+    """
+
+    def __init__(
+        self,
+        node: str,
+        nodes: Sequence[str],
+        previous_nodes: Sequence[str] = (),
+        redirect: bool = False,
+        max_connections: int = 100,
+        transport: Optional["httpx.AsyncBaseTransport"] = None,
+        secret: str = "",
+    ):  # pylint: disable=too-many-arguments
+        if httpx is None:
+            raise RuntimeError("Cluster mode requires httpx: pip install httpx")
+
+        self.node = node.rstrip("/")
+        nodes = [url.rstrip("/") for url in nodes]
+        if self.node not in nodes:
+            raise ValueError(f"{node} is not one of the cluster nodes")
+        self.ring = HashRing(nodes)
+        self.previous_ring = (
+            HashRing(url.rstrip("/") for url in previous_nodes) if previous_nodes else None
+        )
+        self.nodes = nodes + [url.rstrip("/") for url in previous_nodes]
+        self.redirect = redirect
+        self.secret = secret
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections, max_keepalive_connections=max_connections
+            ),
+            timeout=httpx.Timeout(30, pool=None),
+            transport=transport,
+        )
+
+    def owner(self, key: str) -> str:
+        """
+        Returns the node `key` belongs to.
+
+        Arguments:
+        ----------
+        key: str
+          Image name or upload session identifier
+
+        Returns:
+        --------
+        str: Node URL
+        """
+        return self.ring.owner(key)
+
+    def addresses(self) -> Set[str]:
+        """
+        Returns the IP addresses of the nodes, including the previous ones.
+
+        Names are resolved when this is called, those that can't be resolved
+        are left out. This blocks.
+
+        Returns:
+        --------
+        Set[str]: IP addresses
+        """
+        addresses = set()
+        for url in self.nodes:
+            hostname = urlsplit(url).hostname
+            try:
+                for *_, sockaddr in socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP):
+                    addresses.add(sockaddr[0])
+            except (OSError, UnicodeError):
+                logging.getLogger("anastasia").warning("Unable to resolve %s", hostname)
+        return addresses
+
+    def owns(self, key: str) -> bool:
+        """
+        Tells whether `key` belongs to this node.
+
+        Arguments:
+        ----------
+        key: str
+          Image name or upload session identifier
+
+        Returns:
+        --------
+        bool: True if this node is the owner
+        """
+        return self.ring.owner(key) == self.node
+
+    def previous_owner(self, key: str) -> Optional[str]:
+        """
+        Returns the node `key` belonged to before the latest change.
+
+        Arguments:
+        ----------
+        key: str
+          Image name or upload session identifier
+
+        Returns:
+        --------
+        Optional[str]: Node URL or None if it is this node or nothing changed
+        """
+        if self.previous_ring is None:
+            return None
+        owner = self.previous_ring.owner(key)
+        return None if owner == self.node else owner
+
+    async def forward(self, request: Request, node: str) -> Response:
+        """
+        Hands a request over to `node`.
+
+        Responses are streamed back as they are received.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        node: str
+          Node URL
+
+        Returns:
+        --------
+        Response: Response of `node`, or redirect to it
+
+        Raises:
+        -------
+        ClusterError: `node` can't be reached
+        """
+        url = f"{node}{request.url.path}"
+        if request.url.query:
+            url = f"{url}?{request.url.query}"
+        if self.redirect:
+            return RedirectResponse(url, status_code=307)
+
+        headers = [
+            (name, value) for name, value in request.headers.items() if name in FORWARDED_HEADERS
+        ]
+        headers.append((FORWARDED_HEADER, self.node))
+        content = None if request.method in ("GET", "HEAD", "DELETE") else request.stream()
+        try:
+            upstream = await self.client.send(
+                self.client.build_request(request.method, url, headers=headers, content=content),
+                stream=True,
+            )
+        except httpx.TransportError as error:
+            raise ClusterError(f"Unable to reach {node}") from error
+
+        return StreamingResponse(
+            upstream.aiter_raw(),
+            status_code=upstream.status_code,
+            headers={
+                name: value
+                for name, value in upstream.headers.items()
+                if name not in HOP_BY_HOP_HEADERS
+            },
+            background=BackgroundTask(upstream.aclose),
+        )
+
+    async def send(self, method: str, node: str, path: str, **kwargs) -> "httpx.Response":
+        """
+        Sends a request to `node` on behalf of this node.
+
+        Arguments:
+        ----------
+        method: str
+          HTTP method
+        node: str
+          Node URL
+        path: str
+          Request path
+        kwargs:
+          Passed on to `httpx.AsyncClient.request`
+
+        Returns:
+        --------
+        httpx.Response: Response of `node`
+
+        Raises:
+        -------
+        ClusterError: `node` can't be reached
+        """
+        headers = {**kwargs.pop("headers", {}), FORWARDED_HEADER: self.node}
+        if self.secret:
+            headers[SECRET_HEADER] = self.secret
+        try:
+            return await self.client.request(method, f"{node}{path}", headers=headers, **kwargs)
+        except httpx.TransportError as error:
+            raise ClusterError(f"Unable to reach {node}") from error
+
+    def authenticated(self, request: Request) -> bool:
+        """
+        Tells whether a request comes from a node of the cluster.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+
+        Returns:
+        --------
+        bool: True if the request carries the shared secret
+        """
+        supplied = request.headers.get(SECRET_HEADER, "")
+        return bool(self.secret) and hmac.compare_digest(supplied.encode(), self.secret.encode())
+
+    async def close(self) -> None:
+        """Closes the connections to the other nodes"""
+        await self.client.aclose()
+
+
+def multipart(
+    fields: Dict[str, str], name: str, record: ImageRecord, chunks: AsyncIterator[bytes]
+) -> Tuple[Dict[str, str], AsyncIterator[bytes]]:
+    """
+    Encodes a form with an image as multipart/form-data, without reading the image.
+
+    Arguments:
+    ----------
+    fields: Dict[str, str]
+      Text fields of the form
+    name: str
+      Name of the image field
+    record: ImageRecord
+      Image metadata
+    chunks: AsyncIterator[bytes]
+      Image content
+
+    Returns:
+    --------
+    Tuple[Dict[str, str], AsyncIterator[bytes]]: Request headers and body
+    """
+    boundary = secrets.token_hex(16)
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode()
+        for key, value in fields.items()
+    )
+    head += (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{name}"; filename="{record.image_hash}"\r\n'
+        f"Content-Type: {record.media_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body() -> AsyncIterator[bytes]:
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        yield tail
+
+    headers = {
+        "content-type": f"multipart/form-data; boundary={boundary}",
+        "content-length": str(len(head) + record.size + len(tail)),
+    }
+    return headers, body()
+
+
+async def rebalance(
+    cluster: Cluster,
+    storage: StorageBackend,
+    index: Optional[ImageIndex] = None,
+    workers: int = 8,
+) -> Tuple[int, Dict[str, str]]:
+    """
+    Moves the images this node no longer owns to their owners.
+
+    Only the images whose owner changed are read. Each one is streamed to
+    its owner under the same name, with the time it has left, and removed
+    once the owner has it. Images already on their owner, left behind by an
+    interrupted run, are removed too. Up to `workers` images are moved at
+    a time. Images that can't be moved are left in place and reported, so
+    that the others are moved anyway and a later run can retry them.
+
+    Arguments:
+    ----------
+    cluster: Cluster
+      Cluster, as it is after the change
+    storage: StorageBackend
+      Storage of this node
+    index: ImageIndex (optional)
+      Metadata index of this node. None means disabled (default: None)
+    workers: int (optional)
+      Number of images moved at the same time (default: 8)
+
+    Returns:
+    --------
+    Tuple[int, Dict[str, str]]: Number of moved images, and the reason each
+                                image that couldn't be moved wasn't
+    """
+
+    def misplaced() -> List[str]:
+        if index is not None:
+            hashes: Iterable[str] = index.iter_hashes()
+        else:
+            hashes = (image_hash for image_hash, _ in storage.iter_images())
+        return [image_hash for image_hash in hashes if not cluster.owns(image_hash)]
+
+    moved = 0
+    failures: Dict[str, str] = {}
+
+    async def move(image_hash: str) -> None:
+        nonlocal moved
+        record = await storage.stat(image_hash)
+        if record is None:
+            # Deleted in the meanwhile
+            return
+
+        # Expiry times are known to the index only
+        fields = {}
+        if index is not None:
+            indexed = await index.get(image_hash)
+            if indexed is None:
+                # Expired, the reaper removes it
+                return
+            if indexed.expires is not None:
+                fields["ttl"] = str(max(1, int(indexed.expires - time.time())))
+        owner = cluster.owner(image_hash)
+        headers, body = multipart(fields, "image", record, storage.stream(record))
+        response = await cluster.send(
+            "PUT", owner, IMAGE_PATH.format(image_hash=image_hash), headers=headers, content=body
+        )
+        # Conflicts mean that the owner has the image already
+        if response.status_code not in (200, 409):
+            raise ClusterError(f"Unable to move {image_hash} to {owner}: {response.status_code}")
+
+        if index is not None:
+            await index.remove(image_hash)
+        try:
+            await storage.delete(image_hash, record.checksum)
+        except FileNotFoundError:
+            pass
+        moved += 1
+
+    image_hashes = iter(await anyio.to_thread.run_sync(misplaced))
+
+    async def worker() -> None:
+        for image_hash in image_hashes:
+            try:
+                await move(image_hash)
+            except (ClusterError, OSError, sqlite3.Error) as error:
+                failures[image_hash] = str(error)
+
+    async with anyio.create_task_group() as task_group:
+        for _ in range(workers):
+            task_group.start_soon(worker)
+    return moved, failures
@@ -0,0 +1,221 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Image format detection.
+
+This module provides `sniff` which tells the format of an image from its
+first bytes, regardless of what the client claims, and `dimensions` which
+reads width and height from the image header.
+"""
+
+import struct
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+# Bytes of the upload that are inspected. Large enough for the headers of
+# JPEG files carrying EXIF data
+SNIFF_BYTES = 64 * 1024
+
+
+class ImageFormat(NamedTuple):
+    """Format of an uploaded file"""
+
+    # Format name
+    name: str
+    # Content-Type
+    media_type: str
+    # Extension of the stored file, dot included
+    extension: str
+
+
+PNG = ImageFormat("png", "image/png", ".png")
+JPEG = ImageFormat("jpeg", "image/jpeg", ".jpg")
+GIF = ImageFormat("gif", "image/gif", ".gif")
+WEBP = ImageFormat("webp", "image/webp", ".webp")
+AVIF = ImageFormat("avif", "image/avif", ".avif")
+MP4 = ImageFormat("mp4", "video/mp4", ".mp4")
+
+FORMATS = (PNG, JPEG, GIF, WEBP, AVIF, MP4)
+
+# Extension -> format, for the formats mimetypes might not know about
+EXTENSIONS = {image_format.extension: image_format for image_format in FORMATS}
+
+# ISO base media file brands
+AVIF_BRANDS = (b"avif", b"avis")
+MP4_BRANDS = (
+    b"isom",
+    b"iso2",
+    b"iso4",
+    b"iso5",
+    b"iso6",
+    b"mp41",
+    b"mp42",
+    b"avc1",
+    b"dash",
+    b"M4V ",
+    b"MSNV",
+)
+
+# JPEG start of frame markers, the ones that carry the dimensions
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def sniff(head: bytes) -> Optional[ImageFormat]:
+    """
+    Returns the format of a file from its first bytes.
+
+    Arguments:
+    ----------
+    head: bytes
+      First bytes of the file
+
+    Returns:
+    --------
+    Optional[ImageFormat]: The format or None if it is not supported
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return PNG
+    if head.startswith(b"\xff\xd8\xff"):
+        return JPEG
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return GIF
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return WEBP
+    if head[4:8] == b"ftyp":
+        size = min(struct.unpack(">I", head[:4])[0], len(head))
+        # Major brand, minor version, compatible brands
+        brands = [head[8:12]] + [head[offset : offset + 4] for offset in range(16, size, 4)]
+        if any(brand in AVIF_BRANDS for brand in brands):
+            return AVIF
+        if any(brand in MP4_BRANDS for brand in brands):
+            return MP4
+    return None
+
+
+def negotiate(accept: str, candidates: Sequence[ImageFormat]) -> Optional[ImageFormat]:
+    """
+    Returns the first of `candidates` that an Accept header asks for.
+
+    Only formats that are named explicitly count, since browsers send
+    wildcards whatever they support.
+
+    Arguments:
+    ----------
+    accept: str
+      Accept request header
+    candidates: Sequence[ImageFormat]
+      Formats, in order of preference
+
+    Returns:
+    --------
+    Optional[ImageFormat]: The format or None if none is accepted
+    """
+    accepted = set()
+    for item in accept.lower().split(","):
+        media_type, *parameters = item.split(";")
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(media_type.strip())
+
+    for image_format in candidates:
+        if image_format.media_type in accepted:
+            return image_format
+    return None
+
+
+def dimensions(head: bytes, image_format: ImageFormat) -> Optional[Tuple[int, int]]:
+    """
+    Returns width and height of an image from its first bytes.
+
+    Arguments:
+    ----------
+    head: bytes
+      First bytes of the image
+    image_format: ImageFormat
+      Format returned by `sniff`
+
+    Returns:
+    --------
+    Optional[Tuple[int, int]]: Width and height or None if they are not
+    within `head` or the format doesn't carry them in its header (MP4)
+    """
+    try:
+        if image_format is PNG:
+            return struct.unpack(">II", head[16:24])
+        if image_format is GIF:
+            return struct.unpack("<HH", head[6:10])
+        if image_format is JPEG:
+            return _jpeg_dimensions(head)
+        if image_format is WEBP:
+            return _webp_dimensions(head)
+        if image_format is AVIF:
+            offset = head.find(b"ispe")
+            if offset >= 0:
+                # Version and flags come first
+                return struct.unpack(">II", head[offset + 8 : offset + 16])
+    except struct.error:
+        # Truncated header
+        pass
+    return None
+
+
+def _jpeg_dimensions(head: bytes) -> Optional[Tuple[int, int]]:
+    """Walks JPEG segments up to the start of frame"""
+    offset = 2
+    while offset + 4 <= len(head):
+        if head[offset] != 0xFF:
+            return None
+        marker = head[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        length = struct.unpack(">H", head[offset + 2 : offset + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", head[offset + 5 : offset + 9])
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def _webp_dimensions(head: bytes) -> Optional[Tuple[int, int]]:
+    """Reads the dimensions from the first WebP chunk"""
+    chunk = head[12:16]
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        bits = struct.unpack("<I", head[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        return width, height
+    return None
@@ -0,0 +1,460 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Image metadata index.
+
+This module provides `ImageIndex` which keeps the metadata of stored images
+in a SQLite database, so that images can be looked up without touching the
+image folder.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import anyio
+
+from anastasia.storage import ImageRecord, StorageBackend, file_checksum, guess_media_type
+
+# Name of the database file within the image folder
+INDEX_FILENAME = ".index.sqlite3"
+
+# Number of records written per transaction by `rebuild`
+REBUILD_BATCH_SIZE = 1000
+
+# Columns records are read from
+COLUMNS = "hash, size, media_type, checksum, created, path, expires"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    media_type TEXT NOT NULL,
+    checksum TEXT NOT NULL,
+    created REAL NOT NULL,
+    path TEXT NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS images_created ON images (created, hash);
+
+CREATE TABLE IF NOT EXISTS stats (
+    media_type TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS images_insert AFTER INSERT ON images BEGIN
+    INSERT INTO stats (media_type, count, bytes) VALUES (NEW.media_type, 1, NEW.size)
+    ON CONFLICT (media_type) DO UPDATE SET count = count + 1, bytes = bytes + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS images_delete AFTER DELETE ON images BEGIN
+    UPDATE stats SET count = count - 1, bytes = bytes - OLD.size
+    WHERE media_type = OLD.media_type;
+END;
+CREATE TRIGGER IF NOT EXISTS images_update AFTER UPDATE ON images BEGIN
+    UPDATE stats SET count = count - 1, bytes = bytes - OLD.size
+    WHERE media_type = OLD.media_type;
+    INSERT INTO stats (media_type, count, bytes) VALUES (NEW.media_type, 1, NEW.size)
+    ON CONFLICT (media_type) DO UPDATE SET count = count + 1, bytes = bytes + NEW.size;
+END;
+"""
+
+
+class ImageIndex:
+    """
+    SQLite index of image metadata.
+
+    The database runs in WAL mode, so that several worker processes can read
+    it while one of them writes. Queries run in worker threads, each one with
+    its own connection.
+
+    Arguments:
+    ----------
+    path: str
+      Database file path
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+        # Databases created before expiry was introduced
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(images)")]
+        if "expires" not in columns:
+            with connection:
+                connection.execute("ALTER TABLE images ADD COLUMN expires REAL")
+        # Only expiring images are indexed, so that the index stays small
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_expires ON images (expires)"
+            " WHERE expires IS NOT NULL"
+        )
+
+        # Databases created before the stats table was introduced
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if connection.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 0:
+                connection.execute(
+                    "INSERT INTO stats (media_type, count, bytes)"
+                    " SELECT media_type, COUNT(*), SUM(size) FROM images GROUP BY media_type"
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self) -> None:
+        """Closes all of the connections"""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _get(self, image_hash: str) -> Optional[ImageRecord]:
+        """Blocking implementation of `get`"""
+        row = (
+            self._connect()
+            .execute(
+                f"SELECT {COLUMNS} FROM images"
+                " WHERE hash = ? AND (expires IS NULL OR expires > ?)",
+                (image_hash, time.time()),
+            )
+            .fetchone()
+        )
+        return None if row is None else _record(row)
+
+    def _add(self, records: Iterable[ImageRecord], keep_created: bool = False) -> None:
+        """
+        Blocking implementation of `add`.
+
+        Arguments:
+        ----------
+        records: Iterable[ImageRecord]
+          Records to be added or updated
+        keep_created: bool (optional)
+          Whether records that exist already keep their creation time, which
+          file modification times don't reflect (default: False)
+        """
+        created = "images.created" if keep_created else "excluded.created"
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                "INSERT INTO images (hash, size, media_type, checksum, created, path, expires)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (hash) DO UPDATE SET size = excluded.size,"
+                " media_type = excluded.media_type, checksum = excluded.checksum,"
+                f" created = {created}, path = excluded.path,"
+                # Storages don't know expiry times, so rebuilds keep them
+                " expires = COALESCE(excluded.expires, images.expires)",
+                # Offsets within pack segments change with compaction, so
+                # they are not indexed
+                ((*record[:6], record.expires) for record in records),
+            )
+
+    def _remove(self, image_hash: str) -> Optional[ImageRecord]:
+        """Blocking implementation of `remove`"""
+        connection = self._connect()
+        with connection:
+            # Locked before the SELECT, so that only one of concurrent
+            # removals of the same image finds it
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                f"SELECT {COLUMNS} FROM images WHERE hash = ?", (image_hash,)
+            ).fetchone()
+            if row is not None:
+                connection.execute("DELETE FROM images WHERE hash = ?", (image_hash,))
+        return None if row is None else _record(row)
+
+    def _list(self, before: Optional[Tuple[float, str]], limit: int) -> List[ImageRecord]:
+        """Blocking implementation of `list`"""
+        query = f"SELECT {COLUMNS} FROM images WHERE (expires IS NULL OR expires > ?)"
+        parameters: tuple = (time.time(),)
+        if before is not None:
+            query += " AND (created, hash) < (?, ?)"
+            parameters += before
+        query += " ORDER BY created DESC, hash DESC LIMIT ?"
+        rows = self._connect().execute(query, (*parameters, limit)).fetchall()
+        return [_record(row) for row in rows]
+
+    def _expired(self, image_hash: str) -> bool:
+        """Blocking implementation of `expired`"""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT 1 FROM images WHERE hash = ? AND expires <= ?",
+                (image_hash, time.time()),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def _due(self, limit: int) -> List[ImageRecord]:
+        """Blocking implementation of `due`"""
+        rows = (
+            self._connect()
+            .execute(
+                f"SELECT {COLUMNS} FROM images"
+                " WHERE expires IS NOT NULL AND expires <= ? ORDER BY expires LIMIT ?",
+                (time.time(), limit),
+            )
+            .fetchall()
+        )
+        return [_record(row) for row in rows]
+
+    def _stats(self) -> Dict[str, Tuple[int, int]]:
+        """Blocking implementation of `stats`"""
+        rows = self._connect().execute(
+            "SELECT media_type, count, bytes FROM stats WHERE count > 0 ORDER BY media_type"
+        )
+        return {media_type: (count, size) for media_type, count, size in rows}
+
+    def iter_hashes(self, batch_size: int = REBUILD_BATCH_SIZE) -> Iterator[str]:
+        """
+        Iterates over the names of the indexed images.
+
+        Names are read in batches, so that no read transaction stays open
+        while they are consumed. This blocks, so it is meant to be called
+        from worker threads.
+
+        Arguments:
+        ----------
+        batch_size: int (optional)
+          Names read per query (default: REBUILD_BATCH_SIZE)
+
+        Returns:
+        --------
+        Iterator[str]: Image names
+        """
+        last = ""
+        while True:
+            rows = (
+                self._connect()
+                .execute(
+                    "SELECT hash FROM images WHERE hash > ? ORDER BY hash LIMIT ?",
+                    (last, batch_size),
+                )
+                .fetchall()
+            )
+            for (last,) in rows:
+                yield last
+            if len(rows) < batch_size:
+                return
+
+    async def get(self, image_hash: str) -> Optional[ImageRecord]:
+        """
+        Returns the metadata of image `image_hash`.
+
+        Expired images are not returned, even before they are removed.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[ImageRecord]: Image metadata or None if the image does not exist
+        """
+        return await anyio.to_thread.run_sync(self._get, image_hash)
+
+    async def add(self, record: ImageRecord) -> None:
+        """
+        Adds or replaces the metadata of an image.
+
+        Arguments:
+        ----------
+        record: ImageRecord
+          Image metadata
+        """
+        await anyio.to_thread.run_sync(self._add, [record])
+
+    async def remove(self, image_hash: str) -> Optional[ImageRecord]:
+        """
+        Removes the metadata of image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[ImageRecord]: Removed metadata or None if the image does not exist
+        """
+        return await anyio.to_thread.run_sync(self._remove, image_hash)
+
+    async def list(
+        self, before: Optional[Tuple[float, str]] = None, limit: int = 50
+    ) -> List[ImageRecord]:
+        """
+        Returns the metadata of images that haven't expired, newest first.
+
+        Arguments:
+        ----------
+        before: Tuple[float, str] (optional)
+          Creation time and name of the image the list starts after. None
+          means the newest image (default: None)
+        limit: int (optional)
+          Maximum number of images (default: 50)
+
+        Returns:
+        --------
+        List[ImageRecord]: Images metadata
+        """
+        return await anyio.to_thread.run_sync(self._list, before, limit)
+
+    async def expired(self, image_hash: str) -> bool:
+        """
+        Tells whether image `image_hash` has expired.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        bool: True if the image has expired, False if it hasn't or it is not
+        indexed
+        """
+        return await anyio.to_thread.run_sync(self._expired, image_hash)
+
+    async def due(self, limit: int = REBUILD_BATCH_SIZE) -> List[ImageRecord]:
+        """
+        Returns the metadata of expired images, soonest expiry first.
+
+        Expiring images are indexed by expiry time, so this doesn't scan the
+        images table.
+
+        Arguments:
+        ----------
+        limit: int (optional)
+          Maximum number of images (default: REBUILD_BATCH_SIZE)
+
+        Returns:
+        --------
+        List[ImageRecord]: Images metadata
+        """
+        return await anyio.to_thread.run_sync(self._due, limit)
+
+    async def stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns the number and the size of the images, by content type.
+
+        Counters are maintained by triggers while images are added and
+        removed, so this doesn't scan the images table.
+
+        Returns:
+        --------
+        Dict[str, Tuple[int, int]]: Number of images and bytes by content type
+        """
+        return await anyio.to_thread.run_sync(self._stats)
+
+    def rebuild(self, storage: StorageBackend, workers: Optional[int] = None) -> int:
+        """
+        Rebuilds the index from the content of the image folder.
+
+        Files are checksummed concurrently and records are written in small
+        transactions, so the webapp can keep running in the meanwhile. Records
+        of images that are no longer in the folder are removed, unless they
+        have been added after the rebuild started. Images that are indexed
+        already keep their creation time, new ones get the modification time
+        of their file.
+
+        Arguments:
+        ----------
+        storage: StorageBackend
+          Storage to be indexed
+        workers: int (optional)
+          Number of concurrent threads (default: ThreadPoolExecutor default)
+
+        Returns:
+        --------
+        int: Number of indexed images
+        """
+        started = time.time()
+
+        def describe(item: tuple) -> Optional[ImageRecord]:
+            image_hash, file_path = item
+            # Storages other than files describe their images already
+            if isinstance(file_path, ImageRecord):
+                return file_path
+            try:
+                stat_result = os.stat(file_path)
+                checksum = file_checksum(file_path)
+            except FileNotFoundError:
+                # Deleted in the meanwhile
+                return None
+            return ImageRecord(
+                image_hash,
+                stat_result.st_size,
+                guess_media_type(image_hash),
+                checksum,
+                stat_result.st_mtime,
+                os.path.relpath(file_path, storage.folder),
+            )
+
+        seen = set()
+        images = storage.iter_images()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Images are submitted one batch at a time, so that pending work
+            # doesn't grow with the number of images
+            while items := list(islice(images, REBUILD_BATCH_SIZE)):
+                batch = [record for record in executor.map(describe, items) if record is not None]
+                seen.update(record.image_hash for record in batch)
+                self._add(batch, keep_created=True)
+
+        connection = self._connect()
+        stale = [
+            image_hash
+            for image_hash, in connection.execute(
+                "SELECT hash FROM images WHERE created < ?", (started,)
+            )
+            if image_hash not in seen
+        ]
+        with connection:
+            connection.executemany("DELETE FROM images WHERE hash = ?", [(h,) for h in stale])
+
+        return len(seen)
+
+
+def _record(row: tuple) -> ImageRecord:
+    """Returns the record of a row made of COLUMNS"""
+    *fields, expires = row
+    return ImageRecord(*fields, expires=expires)
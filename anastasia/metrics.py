@@ -0,0 +1,376 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Prometheus-style metrics.
+
+This module provides `Metrics` which keeps request and filesystem counters
+and renders them in the Prometheus text exposition format.
+
+Counters are only ever updated from the event loop thread, so they are
+plain integers and floats that need no locking. Each worker process
+periodically writes a snapshot of its counters to the metrics folder, and
+`/metrics` adds up the snapshots of all of the live workers.
+"""
+
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+
+import anyio
+
+# Name of the folder, within the image folder, where workers write snapshots
+METRICS_FOLDER = ".metrics"
+
+# Seconds between two snapshots of the same worker
+FLUSH_INTERVAL = 5
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Filesystem operations that are timed
+FS_OPERATIONS = ("stat", "write", "unlink")
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    `counts` holds the number of observations per bucket, the last one being
+    the +Inf bucket. Counts are not cumulative until they get rendered.
+    """
+
+    __slots__ = ("counts", "total")
+
+    def __init__(self, counts: Optional[List[int]] = None, total: float = 0.0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.total = total
+
+    def observe(self, seconds: float) -> None:
+        """
+        Records an observation.
+
+        Arguments:
+        ----------
+        seconds: float
+          Observed duration
+        """
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def merge(self, counts: List[int], total: float) -> None:
+        """
+        Adds up the observations of another histogram.
+
+        Arguments:
+        ----------
+        counts: List[int]
+          Observations per bucket
+        total: float
+          Sum of the observations
+        """
+        for bucket, count in enumerate(counts):
+            self.counts[bucket] += count
+        self.total += total
+
+
+class Metrics:
+    """
+    Request and filesystem metrics of a worker process.
+
+    Arguments:
+    ----------
+    folder: str (optional)
+      Folder where snapshots are shared with the other workers. None means
+      that only the metrics of this process are rendered (default: None)
+    """
+
+    def __init__(self, folder: Optional[str] = None):
+        self.folder = folder
+        self.requests: Dict[Tuple[str, str, str], Histogram] = {}
+        self.fs_operations = {operation: Histogram() for operation in FS_OPERATIONS}
+        self.in_flight = 0
+        self.uploaded_bytes = 0
+        self.served_bytes = 0
+
+    @property
+    def snapshot_path(self) -> Optional[str]:
+        """Path of the snapshot of this process"""
+        if self.folder is None:
+            return None
+        return os.path.join(self.folder, f"{os.getpid()}.json")
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        """
+        Records a served request.
+
+        Arguments:
+        ----------
+        route: str
+          Path template of the matched route
+        method: str
+          HTTP method
+        status: int
+          Response status code
+        seconds: float
+          Time spent serving the request
+        """
+        key = (route, method, str(status))
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_fs(self, operation: str, seconds: float) -> None:
+        """
+        Records a filesystem operation.
+
+        Arguments:
+        ----------
+        operation: str
+          One of FS_OPERATIONS
+        seconds: float
+          Time spent on the operation
+        """
+        self.fs_operations[operation].observe(seconds)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the counters of this process.
+
+        Returns:
+        --------
+        dict: JSON serializable counters
+        """
+        return {
+            "requests": [
+                [*key, histogram.counts, histogram.total]
+                for key, histogram in self.requests.items()
+            ],
+            "fs_operations": {
+                operation: [histogram.counts, histogram.total]
+                for operation, histogram in self.fs_operations.items()
+            },
+            "in_flight": self.in_flight,
+            "uploaded_bytes": self.uploaded_bytes,
+            "served_bytes": self.served_bytes,
+        }
+
+    def _flush(self, snapshot: dict) -> None:
+        """Blocking implementation of `flush`"""
+        snapshot_path = self.snapshot_path
+
+        os.makedirs(self.folder, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.folder, prefix=".", suffix=".part")
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as file:
+                json.dump(snapshot, file)
+            os.replace(temp_path, snapshot_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    async def flush(self) -> None:
+        """
+        Writes the snapshot of this process to the metrics folder atomically.
+
+        The snapshot is taken on the event loop and written from a worker
+        thread.
+        """
+        if self.folder is not None:
+            await anyio.to_thread.run_sync(self._flush, self.snapshot())
+
+    def discard(self) -> None:
+        """Removes the snapshot of this process from the metrics folder"""
+        snapshot_path = self.snapshot_path
+        if snapshot_path is None:
+            return
+        try:
+            os.unlink(snapshot_path)
+        except FileNotFoundError:
+            pass
+
+    def collect(self) -> List[dict]:
+        """
+        Returns the snapshots of the other live workers.
+
+        Snapshots that have not been refreshed for three flush intervals
+        belong to workers that are gone and are skipped.
+
+        Returns:
+        --------
+        List[dict]: Snapshots
+        """
+        snapshots: List[dict] = []
+        if self.folder is None:
+            return snapshots
+
+        own_path = self.snapshot_path
+        oldest = time.time() - 3 * FLUSH_INTERVAL
+        try:
+            entries = list(os.scandir(self.folder))
+        except FileNotFoundError:
+            return snapshots
+
+        for entry in entries:
+            if entry.name.startswith(".") or entry.path == own_path:
+                continue
+            try:
+                if entry.stat().st_mtime < oldest:
+                    continue
+                with open(entry.path, encoding="utf-8") as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                # Replaced or removed in the meanwhile
+                continue
+        return snapshots
+
+    async def render(
+        self, images: Optional[Dict[str, Tuple[int, int]]] = None, bloom: Optional[dict] = None
+    ) -> str:
+        """
+        Renders the metrics of all of the live workers.
+
+        The snapshot of this process is taken on the event loop, the ones of
+        the other workers are read from a worker thread.
+
+        Arguments:
+        ----------
+        images: Dict[str, Tuple[int, int]] (optional)
+          Number of stored images and bytes by content type. None means
+          unknown (default: None)
+        bloom: dict (optional)
+          Counters of the negative lookup filter (see `BloomFilter.stats`).
+          None means disabled or not built yet (default: None)
+
+        Returns:
+        --------
+        str: Metrics in the Prometheus text exposition format
+        """
+        snapshots = [self.snapshot(), *await anyio.to_thread.run_sync(self.collect)]
+
+        requests: Dict[tuple, Histogram] = {}
+        fs_operations = {operation: Histogram() for operation in FS_OPERATIONS}
+        in_flight = uploaded_bytes = served_bytes = 0
+        for snapshot in snapshots:
+            for route, method, status, counts, total in snapshot["requests"]:
+                requests.setdefault((route, method, status), Histogram()).merge(counts, total)
+            for operation, (counts, total) in snapshot["fs_operations"].items():
+                fs_operations[operation].merge(counts, total)
+            in_flight += snapshot["in_flight"]
+            uploaded_bytes += snapshot["uploaded_bytes"]
+            served_bytes += snapshot["served_bytes"]
+
+        lines = [
+            "# HELP anastasia_request_duration_seconds Time spent serving requests",
+            "# TYPE anastasia_request_duration_seconds histogram",
+        ]
+        for (route, method, status), histogram in sorted(requests.items()):
+            labels = f'route="{_escape(route)}",method="{method}",status="{status}"'
+            lines.extend(_render_histogram("anastasia_request_duration_seconds", labels, histogram))
+
+        lines.extend(
+            [
+                "# HELP anastasia_fs_operation_duration_seconds Time spent on filesystem calls",
+                "# TYPE anastasia_fs_operation_duration_seconds histogram",
+            ]
+        )
+        for operation, histogram in fs_operations.items():
+            lines.extend(
+                _render_histogram(
+                    "anastasia_fs_operation_duration_seconds",
+                    f'operation="{operation}"',
+                    histogram,
+                )
+            )
+
+        lines.extend(
+            [
+                "# HELP anastasia_requests_in_flight Requests being served",
+                "# TYPE anastasia_requests_in_flight gauge",
+                f"anastasia_requests_in_flight {in_flight}",
+                "# HELP anastasia_uploaded_bytes_total Size of the uploaded images",
+                "# TYPE anastasia_uploaded_bytes_total counter",
+                f"anastasia_uploaded_bytes_total {uploaded_bytes}",
+                "# HELP anastasia_served_bytes_total Size of the response bodies",
+                "# TYPE anastasia_served_bytes_total counter",
+                f"anastasia_served_bytes_total {served_bytes}",
+                "# HELP anastasia_workers Worker processes the metrics come from",
+                "# TYPE anastasia_workers gauge",
+                f"anastasia_workers {len(snapshots)}",
+            ]
+        )
+
+        if images is not None:
+            lines.extend(["# HELP anastasia_images Stored images", "# TYPE anastasia_images gauge"])
+            for media_type, (count, _) in images.items():
+                lines.append(f'anastasia_images{{media_type="{_escape(media_type)}"}} {count}')
+            lines.extend(
+                [
+                    "# HELP anastasia_images_bytes Size of the stored images",
+                    "# TYPE anastasia_images_bytes gauge",
+                ]
+            )
+            for media_type, (_, size) in images.items():
+                lines.append(f'anastasia_images_bytes{{media_type="{_escape(media_type)}"}} {size}')
+
+        if bloom is not None:
+            lines.extend(
+                [
+                    "# HELP anastasia_bloom_filter_bytes Size of the negative lookup filter",
+                    "# TYPE anastasia_bloom_filter_bytes gauge",
+                    f"anastasia_bloom_filter_bytes {bloom['bytes']}",
+                    "# HELP anastasia_bloom_filter_images Images added to and deleted from it",
+                    "# TYPE anastasia_bloom_filter_images gauge",
+                    f'anastasia_bloom_filter_images{{state="added"}} {bloom["added"]}',
+                    f'anastasia_bloom_filter_images{{state="deleted"}} {bloom["deleted"]}',
+                    "# HELP anastasia_bloom_filter_false_positive_rate Estimated error rate",
+                    "# TYPE anastasia_bloom_filter_false_positive_rate gauge",
+                    f"anastasia_bloom_filter_false_positive_rate {bloom['false_positive_rate']}",
+                    "# HELP anastasia_bloom_filter_rebuild_seconds Time the last rebuild took",
+                    "# TYPE anastasia_bloom_filter_rebuild_seconds gauge",
+                    f"anastasia_bloom_filter_rebuild_seconds {bloom['rebuild_seconds']}",
+                ]
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_histogram(name: str, labels: str, histogram: Histogram) -> List[str]:
+    """Renders `histogram` with cumulative buckets"""
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*BUCKETS, "+Inf"), histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.total}")
+    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+    return lines
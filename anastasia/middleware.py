@@ -0,0 +1,331 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+ASGI middlewares.
+
+This module provides pure ASGI middlewares that operate on the raw
+`receive` and `send` channels, before FastAPI gets to parse the request.
+"""
+
+import math
+import time
+from typing import Collection
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from anastasia.admission import Lane, TokenBuckets
+from anastasia.metrics import Metrics
+
+
+class LimitUploadSizeMiddleware:
+    """
+    Rejects requests whose body exceeds `max_upload_bytes`.
+
+    The declared Content-Length is checked before the application is called.
+    Bodies without Content-Length (chunked transfer encoding) are counted
+    while they are received and the request is cut off as soon as the limit
+    is crossed, so that oversized bodies are never spooled in full.
+
+    Arguments:
+    ----------
+    app: ASGIApp
+      The wrapped application
+    max_upload_bytes: int
+      Maximum size of request bodies in bytes. 0 means unlimited
+    """
+
+    def __init__(self, app: ASGIApp, max_upload_bytes: int):
+        self.app = app
+        self.max_upload_bytes = max_upload_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not self.max_upload_bytes:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            content_length = int(Headers(scope=scope).get("content-length", 0))
+        except ValueError:
+            content_length = 0
+        if content_length > self.max_upload_bytes:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_upload_bytes:
+                    rejected = True
+                    if not response_started:
+                        await self.reject(scope, receive, send)
+                    # Make the application believe the client went away
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message: Message) -> None:
+            nonlocal response_started
+            # The 413 response has already been sent on the app's behalf
+            if rejected:
+                return
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        await self.app(scope, limited_receive, guarded_send)
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Sends the 413 response.
+
+        Arguments:
+        ----------
+        scope: Scope
+          ASGI connection scope
+        receive: Receive
+          ASGI receive channel
+        send: Send
+          ASGI send channel
+        """
+        response = JSONResponse(
+            {"detail": f"Request body exceeds {self.max_upload_bytes} bytes"},
+            status_code=413,
+            headers={"Connection": "close"},
+        )
+        await response(scope, receive, send)
+
+
+class AdmissionMiddleware:
+    """
+    Sheds requests the app has no room for.
+
+    Requests go through the lane of their kind: GET and HEAD requests are
+    reads, DELETE requests and batch deletes are deletes, everything else is
+    an upload. Lanes are separate, so that slow uploads don't hold up reads.
+    Requests the lane refuses are answered with 503 before their body is
+    received. With `rate_limit` each client also gets a token bucket, and
+    requests that find it empty are answered with 429.
+
+    Arguments:
+    ----------
+    app: ASGIApp
+      The wrapped application
+    read: Lane
+      Lane of reads
+    upload: Lane
+      Lane of uploads
+    delete: Lane
+      Lane of deletes
+    rate_limit: TokenBuckets
+      Per-client rate limit. None means disabled
+    exempt: Collection[str]
+      Client addresses the rate limit doesn't apply to, eg: other nodes of the cluster
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        read: Lane,
+        upload: Lane,
+        delete: Lane,
+        rate_limit: TokenBuckets = None,
+        exempt: Collection[str] = (),
+    ):  # pylint: disable=too-many-arguments
+        self.app = app
+        self.read = read
+        self.upload = upload
+        self.delete = delete
+        self.rate_limit = rate_limit
+        self.exempt = frozenset(exempt)
+
+    def lane(self, scope: Scope) -> Lane:
+        """
+        Returns the lane of the request.
+
+        Arguments:
+        ----------
+        scope: Scope
+          ASGI connection scope
+
+        Returns:
+        --------
+        Lane: The lane of the request
+        """
+        if scope["method"] in ("GET", "HEAD", "OPTIONS"):
+            return self.read
+        if scope["method"] == "DELETE" or scope["path"].endswith("/delete/batch"):
+            return self.delete
+        return self.upload
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        client = scope.get("client")
+        if self.rate_limit is not None and client and client[0] not in self.exempt:
+            wait = self.rate_limit.take(client[0])
+            if wait is not None:
+                await self.reject(scope, receive, send, 429, "Too many requests", wait)
+                return
+
+        lane = self.lane(scope)
+        if not await lane.acquire():
+            await self.reject(scope, receive, send, 503, "Server busy", lane.timeout)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release()
+
+    async def reject(
+        self, scope: Scope, receive: Receive, send: Send, status: int, detail: str, wait: float
+    ) -> None:  # pylint: disable=too-many-arguments
+        """
+        Sends a response that tells the client to try again later.
+
+        Arguments:
+        ----------
+        scope: Scope
+          ASGI connection scope
+        receive: Receive
+          ASGI receive channel
+        send: Send
+          ASGI send channel
+        status: int
+          Status code of the response
+        detail: str
+          Reason of the refusal
+        wait: float
+          Seconds the client is asked to wait for
+        """
+        headers = {"Retry-After": str(max(1, math.ceil(wait)))}
+        # Don't let the client upload a body nobody is going to read
+        if self.lane(scope) is self.upload:
+            headers["Connection"] = "close"
+        response = JSONResponse({"detail": detail}, status_code=status, headers=headers)
+        await response(scope, receive, send)
+
+
+class SecurityHeadersMiddleware:
+    """
+    Adds security headers to responses.
+
+    Headers are the ones recommended by
+    https://github.com/shieldfy/API-Security-Checklist#output and are
+    injected into the `http.response.start` message, so that response bodies,
+    including streamed files, are passed through untouched.
+
+    Arguments:
+    ----------
+    app: ASGIApp
+      The wrapped application
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-Content-Type-Options"] = "nosniff"
+                headers["X-Frame-Options"] = "deny"
+                # Force restrictive content-security-policy for JSON content
+                if headers.get("content-type") == "application/json":
+                    headers["Content-Security-Policy"] = "default-src 'none'"
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+class MetricsMiddleware:
+    """
+    Records requests in `metrics`.
+
+    Requests are labelled with the path template of the route they matched,
+    so that the number of series doesn't grow with the number of images.
+    Served bytes are taken from the Content-Length response header when
+    available, so that file bodies are not inspected.
+
+    Arguments:
+    ----------
+    app: ASGIApp
+      The wrapped application
+    metrics: Metrics
+      Where requests are recorded
+    """
+
+    def __init__(self, app: ASGIApp, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self.metrics
+        status = 500
+        content_length = None
+
+        async def measured_send(message: Message) -> None:
+            nonlocal status, content_length
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                for name, value in message.get("headers", ()):
+                    if name == b"content-length" and scope["method"] != "HEAD":
+                        content_length = int(value)
+                        metrics.served_bytes += content_length
+                        break
+            elif message["type"] == "http.response.body" and content_length is None:
+                metrics.served_bytes += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, measured_send)
+        finally:
+            metrics.in_flight -= 1
+            route = scope.get("route")
+            path = getattr(route, "path", None)
+            if path is None:
+                label = "unmatched"
+            else:
+                label = scope.get("root_path", "") + path or "/"
+            metrics.observe_request(label, scope["method"], status, time.perf_counter() - started)
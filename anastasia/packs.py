@@ -0,0 +1,467 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Pack-file image storage.
+
+This module provides `PackStorage` which appends images to large segment
+files, so that millions of small images live in a few hundred files. Offset
+and size of each image are kept in a SQLite database next to the segments.
+"""
+
+import fcntl
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import IO, AsyncIterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import anyio
+
+from anastasia.metrics import Metrics
+from anastasia.storage import (
+    CHUNK_SIZE,
+    ImageRecord,
+    LocalStorageBackend,
+    SavedImage,
+    _write_chunk,
+    guess_media_type,
+    new_hasher,
+)
+
+# Folder, within the image folder, that holds segments and their database
+PACKS_FOLDER = ".packs"
+
+# Name of the database file within PACKS_FOLDER
+PACKS_DATABASE = "packs.sqlite3"
+
+# Name of the lock file writers serialize on, within PACKS_FOLDER
+PACKS_LOCK = "lock"
+
+# Segments whose deleted bytes reach this fraction of their size are compacted
+COMPACT_THRESHOLD = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bytes INTEGER NOT NULL,
+    dead INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    hash TEXT PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    created REAL NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment, deleted);
+"""
+
+
+class PackedImage(NamedTuple):
+    """Location and metadata of an image within a segment"""
+
+    # Segment file path
+    path: str
+    # Offset of the image within the segment
+    offset: int
+    # Content size in bytes
+    size: int
+    # Hex digest of the content
+    checksum: str
+    # Upload time (UNIX timestamp)
+    created: float
+
+
+class PackStorage(LocalStorageBackend):
+    """
+    Stores images within append-only segment files.
+
+    Uploads are spooled, then appended to the newest segment while holding an
+    exclusive lock on `PACKS_LOCK`, so that several worker processes can
+    write to the same folder. A new segment is started when the newest one
+    would grow beyond `segment_bytes`.
+
+    Deletes only mark the image as deleted (tombstone) and account its bytes
+    as dead. `compact` rewrites the live images of segments that are mostly
+    dead into the newest segment and retires them. Retired segment files are
+    removed by the following `compact`, so that readers that looked an image
+    up just before the compaction can still read it.
+
+    Arguments:
+    ----------
+    folder: str
+      Image folder. Segments are stored within its `PACKS_FOLDER` subfolder
+    segment_bytes: int (optional)
+      Size segments are rolled over at (default: 256 MiB)
+    metrics: Metrics (optional)
+      Where write, stat and unlink timings are recorded (default: None)
+    """
+
+    # Offsets change with compaction, so the metadata index can't be trusted
+    index_lookups = False
+
+    def __init__(
+        self,
+        folder: str,
+        segment_bytes: int = 256 * 1024 * 1024,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.folder = folder
+        self.root = os.path.join(folder, PACKS_FOLDER)
+        self.segment_bytes = segment_bytes
+        self.metrics = metrics
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Returns the database connection of the current thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                os.path.join(self.root, PACKS_DATABASE), timeout=30, check_same_thread=False
+            )
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self) -> None:
+        """Closes all of the database connections"""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    @contextmanager
+    def _exclusive(self) -> Iterator[None]:
+        """Holds the lock writers of all of the processes serialize on"""
+        with open(os.path.join(self.root, PACKS_LOCK), "a+b") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def segment_path(self, segment: int) -> str:
+        """
+        Returns the path of a segment file.
+
+        Arguments:
+        ----------
+        segment: int
+          Segment number
+
+        Returns:
+        --------
+        str: Segment file path
+        """
+        return os.path.join(self.root, f"segment-{segment:06d}.pack")
+
+    def _get(self, image_hash: str) -> Optional[PackedImage]:
+        """Blocking implementation of `get`"""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT segment, offset, size, checksum, created FROM entries"
+                " WHERE hash = ? AND deleted = 0",
+                (image_hash,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        segment, offset, size, checksum, created = row
+        return PackedImage(self.segment_path(segment), offset, size, checksum, created)
+
+    async def get(self, image_hash: str) -> Optional[PackedImage]:
+        """
+        Returns the location of image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[PackedImage]: Image location or None if the image does not exist
+        """
+        started = time.perf_counter()
+        image = await anyio.to_thread.run_sync(self._get, image_hash)
+        if self.metrics is not None:
+            self.metrics.observe_fs("stat", time.perf_counter() - started)
+        return image
+
+    async def stat(self, image_hash: str) -> Optional[ImageRecord]:
+        image = await self.get(image_hash)
+        if image is None:
+            return None
+        return ImageRecord(
+            image_hash,
+            image.size,
+            guess_media_type(image_hash),
+            image.checksum,
+            image.created,
+            os.path.relpath(image.path, self.folder),
+            image.offset,
+        )
+
+    async def save(self, image_hash: str, chunks: AsyncIterable[bytes]) -> SavedImage:
+        """
+        Saves image `image_hash`.
+
+        Content is checksummed while it is spooled, then appended to the
+        newest segment at once.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        chunks: AsyncIterable[bytes]
+          Image content
+
+        Returns:
+        --------
+        SavedImage: Size, checksum, upload time and segment path of the image
+        """
+        size = 0
+        hasher = new_hasher()
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE, dir=self.root) as spool:
+            async for chunk in chunks:
+                await anyio.to_thread.run_sync(_write_chunk, spool, hasher, chunk)
+                size += len(chunk)
+            checksum = hasher.hexdigest()
+
+            started = time.perf_counter()
+            with anyio.CancelScope(shield=True):
+                image = await anyio.to_thread.run_sync(
+                    self._append, image_hash, spool, size, checksum
+                )
+            if self.metrics is not None:
+                self.metrics.observe_fs("write", time.perf_counter() - started)
+
+        return SavedImage(size, checksum, image.created, os.path.relpath(image.path, self.folder))
+
+    def _append(self, image_hash: str, content: IO[bytes], size: int, checksum: str) -> PackedImage:
+        """Appends `content` to the newest segment and records where it went"""
+        content.seek(0)
+        created = time.time()
+        with self._exclusive():
+            connection = self._connect()
+            segment, offset = self._reserve(connection, size)
+            with open(self.segment_path(segment), "ab") as file:
+                shutil.copyfileobj(content, file, CHUNK_SIZE)
+
+            with connection:
+                self._bury(connection, image_hash)
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries"
+                    " (hash, segment, offset, size, checksum, created, deleted)"
+                    " VALUES (?, ?, ?, ?, ?, ?, 0)",
+                    (image_hash, segment, offset, size, checksum, created),
+                )
+                connection.execute(
+                    "UPDATE segments SET bytes = ? WHERE id = ?", (offset + size, segment)
+                )
+        return PackedImage(self.segment_path(segment), offset, size, checksum, created)
+
+    def _reserve(self, connection: sqlite3.Connection, size: int) -> tuple:
+        """
+        Returns segment and offset `size` bytes are to be appended at.
+
+        Must be called while holding `_exclusive`.
+        """
+        row = connection.execute("SELECT id FROM segments ORDER BY id DESC LIMIT 1").fetchone()
+        if row is not None:
+            segment = row[0]
+            try:
+                # Bytes written by interrupted appends are skipped
+                offset = os.path.getsize(self.segment_path(segment))
+            except FileNotFoundError:
+                offset = 0
+            if offset == 0 or offset + size <= self.segment_bytes:
+                return segment, offset
+
+        with connection:
+            segment = connection.execute(
+                "INSERT INTO segments (bytes, dead) VALUES (0, 0)"
+            ).lastrowid
+        return segment, 0
+
+    @staticmethod
+    def _bury(connection: sqlite3.Connection, image_hash: str) -> bool:
+        """Accounts the bytes of the live image `image_hash` as dead"""
+        row = connection.execute(
+            "SELECT segment, size FROM entries WHERE hash = ? AND deleted = 0", (image_hash,)
+        ).fetchone()
+        if row is None:
+            return False
+        segment, size = row
+        connection.execute("UPDATE segments SET dead = dead + ? WHERE id = ?", (size, segment))
+        return True
+
+    def _delete(self, image_hash: str) -> None:
+        """Blocking implementation of `delete`"""
+        connection = self._connect()
+        # Images must not be moved by `compact` while they are deleted
+        with self._exclusive(), connection:
+            if not self._bury(connection, image_hash):
+                raise FileNotFoundError(image_hash)
+            connection.execute("UPDATE entries SET deleted = 1 WHERE hash = ?", (image_hash,))
+
+    async def delete(self, image_hash: str, checksum: Optional[str] = None) -> None:
+        """
+        Deletes image `image_hash` by leaving a tombstone.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        checksum: str (optional)
+          Unused, accepted for compatibility with `FileSystemStorage`
+
+        Raises:
+        -------
+        FileNotFoundError: The image does not exist
+        """
+        started = time.perf_counter()
+        await anyio.to_thread.run_sync(self._delete, image_hash)
+        if self.metrics is not None:
+            self.metrics.observe_fs("unlink", time.perf_counter() - started)
+
+    def iter_images(self) -> Iterator[Tuple[str, ImageRecord]]:
+        """
+        Iterates over the stored images.
+
+        Returns:
+        --------
+        Iterator[Tuple[str, ImageRecord]]: Image names and metadata
+        """
+        rows = self._connect().execute(
+            "SELECT hash, segment, offset, size, checksum, created FROM entries WHERE deleted = 0"
+        )
+        for image_hash, segment, offset, size, checksum, created in rows:
+            yield image_hash, ImageRecord(
+                image_hash,
+                size,
+                guess_media_type(image_hash),
+                checksum,
+                created,
+                os.path.relpath(self.segment_path(segment), self.folder),
+                offset,
+            )
+
+    def compact(self, threshold: float = COMPACT_THRESHOLD) -> int:
+        """
+        Reclaims the space of deleted images.
+
+        Segment files retired by the previous run are removed first. Then
+        live images of the segments whose dead bytes reach `threshold` are
+        appended to the newest segment and their segments are retired.
+        Uploads wait while a segment is being rewritten.
+
+        Arguments:
+        ----------
+        threshold: float (optional)
+          Fraction of dead bytes segments are compacted at
+          (default: COMPACT_THRESHOLD)
+
+        Returns:
+        --------
+        int: Number of dead bytes that have been dropped
+        """
+        connection = self._connect()
+        reclaimed = 0
+        with self._exclusive():
+            segments = {segment for segment, in connection.execute("SELECT id FROM segments")}
+            for entry in os.scandir(self.root):
+                name = entry.name
+                if name.startswith("segment-") and name.endswith(".pack"):
+                    if int(name[len("segment-") : -len(".pack")]) not in segments:
+                        os.unlink(entry.path)
+
+            newest = max(segments, default=None)
+            candidates = connection.execute(
+                "SELECT id, bytes, dead FROM segments"
+                " WHERE id != ? AND dead > 0 AND dead >= bytes * ?",
+                (newest, threshold),
+            ).fetchall()
+
+        for segment, _, dead in candidates:
+            with self._exclusive():
+                self._rewrite(connection, segment)
+            reclaimed += dead
+        return reclaimed
+
+    def _rewrite(self, connection: sqlite3.Connection, segment: int) -> None:
+        """
+        Moves the live images of `segment` to the newest segment.
+
+        Must be called while holding `_exclusive`.
+        """
+        moved = []
+        source_path = self.segment_path(segment)
+        rows = connection.execute(
+            "SELECT hash, offset, size FROM entries WHERE segment = ? AND deleted = 0",
+            (segment,),
+        ).fetchall()
+        with open(source_path, "rb") as source:
+            for image_hash, offset, size in rows:
+                target, target_offset = self._reserve(connection, size)
+                with open(self.segment_path(target), "ab") as file:
+                    position = offset
+                    while position < offset + size:
+                        chunk = os.pread(
+                            source.fileno(), min(CHUNK_SIZE, offset + size - position), position
+                        )
+                        if not chunk:
+                            break
+                        file.write(chunk)
+                        position += len(chunk)
+                moved.append((target, target_offset, image_hash))
+                with connection:
+                    connection.execute(
+                        "UPDATE segments SET bytes = ? WHERE id = ?",
+                        (target_offset + size, target),
+                    )
+
+        with connection:
+            connection.executemany(
+                "UPDATE entries SET segment = ?, offset = ? WHERE hash = ?", moved
+            )
+            connection.execute("DELETE FROM entries WHERE segment = ? AND deleted = 1", (segment,))
+            connection.execute("DELETE FROM segments WHERE id = ?", (segment,))
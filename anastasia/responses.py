@@ -0,0 +1,543 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+HTTP responses.
+
+This module provides `ImageResponse`, `StreamingImageResponse` and
+`CachedImageResponse` which serve images, respectively from files, from
+asynchronous streams and from memory, with caching headers. All of them
+answer conditional requests with 304, `Range` requests with 206 and `HEAD`
+requests without touching the content.
+"""
+
+import mmap
+import os
+from abc import ABC, abstractmethod
+from email.utils import formatdate, parsedate_to_datetime
+from secrets import token_hex
+from typing import IO, AsyncIterator, Callable, List, Mapping, Optional, Sequence, Tuple, Union
+
+import anyio
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Headers that are repeated in 304 responses
+NOT_MODIFIED_HEADERS = ("cache-control", "etag", "last-modified", "vary")
+
+# Requests with more ranges than this are answered with the whole content
+MAX_RANGES = 100
+
+# Size of the chunks files are sent with when the server can't send them
+SEND_CHUNK_SIZE = 256 * 1024
+
+# Pieces of a response body: literal bytes or (start, end) content ranges
+Segments = Sequence[Union[bytes, Tuple[int, int]]]
+
+
+def cache_control(max_age: int) -> str:
+    """
+    Returns the Cache-Control header for write-once content.
+
+    Arguments:
+    ----------
+    max_age: int
+      Seconds clients and proxies are allowed to cache the content for.
+      0 means clients have to revalidate at every request
+
+    Returns:
+    --------
+    str: Cache-Control header value
+    """
+    if max_age <= 0:
+        return "public, no-cache"
+    return f"public, max-age={max_age}, immutable"
+
+
+def is_not_modified(request_headers: Headers, response_headers: Mapping[str, str]) -> bool:
+    """
+    Tells whether the client already holds the content of a response.
+
+    If-None-Match takes precedence over If-Modified-Since as per RFC 9110.
+
+    Arguments:
+    ----------
+    request_headers: Headers
+      Headers of the request
+    response_headers: Mapping[str, str]
+      Headers of the response
+
+    Returns:
+    --------
+    bool: True if a 304 response can be sent instead
+    """
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = response_headers.get("etag")
+        if etag is None:
+            return False
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    if_modified_since = request_headers.get("if-modified-since")
+    last_modified = response_headers.get("last-modified")
+    if if_modified_since is None or last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeNotSatisfiable(Exception):
+    """None of the requested ranges overlaps the content"""
+
+
+def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parses a `Range` request header.
+
+    Overlapping and adjacent ranges are merged. Invalid headers are ignored
+    as allowed by RFC 9110, so that the whole content is sent instead.
+
+    Arguments:
+    ----------
+    header: str
+      Range header value, eg: `bytes=0-99,-100`
+    size: int
+      Content size in bytes
+
+    Returns:
+    --------
+    Optional[List[Tuple[int, int]]]: Sorted (start, end) ranges, end being
+    exclusive. None means that the header has to be ignored
+
+    Raises:
+    -------
+    RangeNotSatisfiable: None of the ranges overlaps the content
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes" or not specs:
+        return None
+    specs = specs.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition("-")
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) + 1 if last else size
+                # last-byte-pos lower than first-byte-pos is invalid
+                if last and end <= start:
+                    return None
+            else:
+                # Suffix range: last `last` bytes
+                start, end = max(size - int(last), 0), size
+        except ValueError:
+            return None
+        if start < 0:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class BaseImageResponse(Response, ABC):
+    """
+    Serves an image with caching headers, conditional and range requests.
+
+    Uploaded images never change, so responses carry a strong ETag derived
+    from the content and a Cache-Control header that lets clients and CDNs
+    cache them for `max_age` seconds. Subclasses provide `send_segments`,
+    which sends the body.
+
+    Arguments:
+    ----------
+    content: bytes
+      Image content. None means that it's sent by `send_segments`
+    size: int
+      Content size in bytes
+    media_type: str
+      Content-Type of the image
+    checksum: str
+      Hex digest of the content
+    mtime: float
+      Modification time of the image file
+    max_age: int
+      Seconds clients and proxies are allowed to cache the image for
+    """
+
+    def __init__(
+        self,
+        content: Optional[bytes],
+        size: int,
+        media_type: str,
+        checksum: str,
+        mtime: float,
+        max_age: int,
+    ):
+        self.size = size
+        super().__init__(
+            content,
+            media_type=media_type,
+            headers={
+                "etag": f'"{checksum}"',
+                "cache-control": cache_control(max_age),
+                "last-modified": formatdate(mtime, usegmt=True),
+                "accept-ranges": "bytes",
+                "content-length": str(size),
+            },
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request_headers = Headers(scope=scope)
+        if is_not_modified(request_headers, self.headers):
+            headers = {
+                name: self.headers[name] for name in NOT_MODIFIED_HEADERS if name in self.headers
+            }
+            response = Response(status_code=304, headers=headers)
+            await response(scope, receive, send)
+            return
+
+        ranges = None
+        range_header = request_headers.get("range")
+        if range_header is not None and self.if_range(request_headers.get("if-range")):
+            try:
+                ranges = parse_range(range_header, self.size)
+            except RangeNotSatisfiable:
+                response = Response(
+                    status_code=416, headers={"content-range": f"bytes */{self.size}"}
+                )
+                await response(scope, receive, send)
+                return
+
+        status_code, headers, segments = self.plan(ranges)
+        await send({"type": "http.response.start", "status": status_code, "headers": headers})
+        if scope["method"] == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        spec_version = tuple(map(int, scope.get("asgi", {}).get("spec_version", "2.0").split(".")))
+        if spec_version >= (2, 4):
+            # Sending to a client that went away raises OSError
+            await self.send_segments(scope, send, segments)
+            return
+
+        # Stop sending as soon as the client goes away
+        async with anyio.create_task_group() as task_group:
+
+            async def send_body() -> None:
+                await self.send_segments(scope, send, segments)
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(send_body)
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            task_group.cancel_scope.cancel()
+
+    def if_range(self, if_range: Optional[str]) -> bool:
+        """
+        Tells whether the ranges can be served according to `If-Range`.
+
+        Arguments:
+        ----------
+        if_range: str
+          If-Range header value. None means that the header is missing
+
+        Returns:
+        --------
+        bool: True if the content the client holds is the current one
+        """
+        if if_range is None:
+            return True
+        return if_range in (self.headers["etag"], self.headers["last-modified"])
+
+    def plan(self, ranges: Optional[List[Tuple[int, int]]]) -> Tuple[int, list, Segments]:
+        """
+        Returns status code, headers and body of the response.
+
+        Arguments:
+        ----------
+        ranges: List[Tuple[int, int]]
+          Ranges to be sent. None means the whole content
+
+        Returns:
+        --------
+        Tuple[int, list, Segments]: Status code, raw headers and body segments
+        """
+        if ranges is None:
+            return 200, self.raw_headers, [(0, self.size)]
+
+        headers = MutableHeaders(raw=list(self.raw_headers))
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            headers["content-range"] = f"bytes {start}-{end - 1}/{self.size}"
+            headers["content-length"] = str(end - start)
+            return 206, headers.raw, ranges
+
+        boundary = token_hex(13)
+        content_type = self.headers["content-type"]
+        segments: List[Union[bytes, Tuple[int, int]]] = []
+        for start, end in ranges:
+            segments.append(
+                (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Range: bytes {start}-{end - 1}/{self.size}\r\n\r\n"
+                ).encode("latin-1")
+            )
+            segments.append((start, end))
+            segments.append(b"\r\n")
+        segments.append(f"--{boundary}--".encode("latin-1"))
+
+        headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["content-length"] = str(
+            sum(
+                len(segment) if isinstance(segment, bytes) else segment[1] - segment[0]
+                for segment in segments
+            )
+        )
+        return 206, headers.raw, segments
+
+    @abstractmethod
+    async def send_segments(self, scope: Scope, send: Send, segments: Segments) -> None:
+        """
+        Sends the response body.
+
+        Arguments:
+        ----------
+        scope: Scope
+          ASGI connection scope
+        send: Send
+          ASGI send channel
+        segments: Segments
+          Literal bytes and content ranges to be sent, in order
+        """
+
+
+class ImageResponse(BaseImageResponse):
+    """
+    Serves an image file.
+
+    Size and modification time are provided by the caller, so that the file
+    doesn't need to be stat'ed again.
+
+    The file is handed over to the server when it supports the
+    `http.response.zerocopysend` (os.sendfile) or `http.response.pathsend`
+    ASGI extensions. Otherwise it is memory-mapped and sent in chunks that
+    are sliced from worker threads.
+
+    Arguments:
+    ----------
+    path: str
+      Image file path
+    size: int
+      Size of the file in bytes
+    mtime: float
+      Modification time of the file
+    checksum: str
+      Hex digest of the content
+    max_age: int
+      Seconds clients and proxies are allowed to cache the image for
+    media_type: str
+      Content-Type of the image
+    offset: int (optional)
+      Offset of the image within the file. None means that the image is the
+      whole file (default: None)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        mtime: float,
+        checksum: str,
+        max_age: int,
+        media_type: str,
+        offset: Optional[int] = None,
+    ):
+        self.path = path
+        self.offset = offset
+        super().__init__(None, size, media_type, checksum, mtime, max_age)
+
+    async def send_segments(self, scope: Scope, send: Send, segments: Segments) -> None:
+        extensions = scope.get("extensions") or {}
+        if (
+            "http.response.pathsend" in extensions
+            and self.offset is None
+            and list(segments) == [(0, self.size)]
+        ):
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            if "http.response.zerocopysend" in extensions:
+                await self._zerocopysend(send, file, segments)
+            else:
+                await self._send_mapped(send, file, segments)
+        finally:
+            file.close()
+
+    async def _zerocopysend(self, send: Send, file: IO[bytes], segments: Segments) -> None:
+        """Lets the server send the content ranges with os.sendfile"""
+        base = self.offset or 0
+        for number, segment in enumerate(segments, 1):
+            more_body = number < len(segments)
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment, "more_body": more_body})
+            else:
+                start, end = segment
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": base + start,
+                        "count": end - start,
+                        "more_body": more_body,
+                    }
+                )
+
+    async def _send_mapped(self, send: Send, file: IO[bytes], segments: Segments) -> None:
+        """Sends the content ranges out of a memory map of the file"""
+        base = self.offset or 0
+        size = os.fstat(file.fileno()).st_size
+        # Empty files can't be mapped
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            if hasattr(mapped, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for segment in segments:
+                if isinstance(segment, bytes):
+                    await send({"type": "http.response.body", "body": segment, "more_body": True})
+                    continue
+                start, end = base + segment[0], base + segment[1]
+                for offset in range(start, end, SEND_CHUNK_SIZE):
+                    # Slicing might fault pages in from disk
+                    chunk = await anyio.to_thread.run_sync(
+                        mapped.__getitem__, slice(offset, min(offset + SEND_CHUNK_SIZE, end))
+                    )
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if size:
+                mapped.close()
+
+
+class StreamingImageResponse(BaseImageResponse):
+    """
+    Serves an image from an asynchronous stream, eg: a remote object.
+
+    Every range is streamed on its own, so that only the requested bytes are
+    fetched and content is never held in memory as a whole.
+
+    Arguments:
+    ----------
+    stream: Callable[[int, int], AsyncIterator[bytes]]
+      Returns the chunks of the content between the given start and end
+    size: int
+      Content size in bytes
+    mtime: float
+      Modification time of the image
+    checksum: str
+      Hex digest of the content
+    max_age: int
+      Seconds clients and proxies are allowed to cache the image for
+    media_type: str
+      Content-Type of the image
+    """
+
+    def __init__(
+        self,
+        stream: Callable[[int, int], AsyncIterator[bytes]],
+        size: int,
+        mtime: float,
+        checksum: str,
+        max_age: int,
+        media_type: str,
+    ):
+        self.stream = stream
+        super().__init__(None, size, media_type, checksum, mtime, max_age)
+
+    async def send_segments(self, scope: Scope, send: Send, segments: Segments) -> None:
+        for segment in segments:
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment, "more_body": True})
+                continue
+            async for chunk in self.stream(*segment):
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class CachedImageResponse(BaseImageResponse):
+    """
+    Serves an image held in memory.
+
+    Headers are the same `ImageResponse` would send for the same image.
+
+    Arguments:
+    ----------
+    content: bytes
+      Image content
+    media_type: str
+      Content-Type of the image
+    checksum: str
+      Hex digest of the content
+    mtime: float
+      Modification time of the image file
+    max_age: int
+      Seconds clients and proxies are allowed to cache the image for
+    """
+
+    def __init__(self, content: bytes, media_type: str, checksum: str, mtime: float, max_age: int):
+        super().__init__(content, len(content), media_type, checksum, mtime, max_age)
+
+    async def send_segments(self, scope: Scope, send: Send, segments: Segments) -> None:
+        for number, segment in enumerate(segments, 1):
+            if not isinstance(segment, bytes):
+                start, end = segment
+                segment = self.body if (start, end) == (0, self.size) else self.body[start:end]
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": segment,
+                    "more_body": number < len(segments),
+                }
+            )
@@ -27,18 +27,76 @@ This module provies `get_api` which is a FastAPI app factory that provide the
 APIrouter that implements API v3.0
 """
 
-import mimetypes
+import base64
+import binascii
 import os
 import random
+import re
+import sqlite3
 import string
+import time
+from contextlib import suppress
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 from typing_extensions import TypedDict
 
-from fastapi import APIRouter, File, HTTPException, Path, Request, UploadFile
+import anyio
+from fastapi import (
+    APIRouter,
+    File,
+    Form,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
 from fastapi.responses import FileResponse
 from pydantic import AnyHttpUrl, BaseModel, Field
+from starlette.requests import ClientDisconnect
+
+from anastasia.bloom import BloomFilter
+from anastasia.cache import ImageCache
+from anastasia.cluster import FORWARDED_HEADER, Cluster, ClusterError
+from anastasia.formats import SNIFF_BYTES, ImageFormat, dimensions, negotiate, sniff
+from anastasia.index import ImageIndex, ImageRecord
+from anastasia.metrics import Metrics
+from anastasia.responses import CachedImageResponse, ImageResponse
+from anastasia.storage import FileSystemStorage, StorageBackend, guess_media_type, iter_upload
+from anastasia.thumbnails import (
+    SIZES,
+    TRANSCODED_MEDIA_TYPES,
+    ThumbnailCache,
+    ThumbnailError,
+    thumbnail_format,
+)
+from anastasia.uploads import UploadConflictError, UploadSessions
 
 # Input Validation
-IMAGEHASH = Path(description="Image hash string", min_lentgh=1, max_length=64)
+# Names starting with a dot are reserved for temporary and internal files
+IMAGEHASH_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9._-]*$"
+IMAGEHASH = Path(
+    description="Image hash string",
+    min_lentgh=1,
+    max_length=64,
+    pattern=IMAGEHASH_PATTERN,
+)
+SESSIONID = Path(description="Upload session identifier", pattern=r"^[0-9a-f]{32}$")
+
+TTL = Form(
+    default=None,
+    ge=0,
+    description="Seconds the image is kept for. 0 means forever (default: server setting)",
+)
+
+# Content-Type of the chunks of resumable uploads
+OFFSET_MEDIA_TYPE = "application/offset+octet-stream"
+
+
+# Maximum number of images handled by a batch request
+BATCH_MAX_ITEMS = 100
 
 
 # Response Schemas
@@ -57,7 +115,137 @@ class UploadImageSchema(BaseModel):
     status: int = 200
 
 
+class UploadSessionDataFieldSchema(TypedDict, total=True):
+    """Defines the `data` field of the `UploadSessionSchema` schema"""
+
+    id: str
+    link: AnyHttpUrl
+    offset: int
+    length: int
+
+
+class UploadSessionSchema(BaseModel):
+    """Schema for `create_upload` responses"""
+
+    data: UploadSessionDataFieldSchema = None
+    success: bool = True
+    status: int = 201
+
+
+class BatchItemSchema(TypedDict, total=False):
+    """Defines an item within the `BatchSchema` schema"""
+
+    deletehash: str
+    link: AnyHttpUrl
+    filename: Optional[str]
+    status: int
+    success: bool
+    error: str
+
+
+class BatchSchema(BaseModel):
+    """Schema for `upload_images` and `delete_images` responses"""
+
+    data: List[BatchItemSchema] = None
+    success: bool = True
+    status: int = 200
+
+
+class DeleteImagesSchema(BaseModel):
+    """Schema for `delete_images` requests"""
+
+    hashes: List[str] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+class ImageDataSchema(TypedDict, total=True):
+    """Defines an image within the `ListImagesDataFieldSchema` schema"""
+
+    deletehash: str = Field(min_length=1, max_length=64)
+    link: AnyHttpUrl
+    type: str
+    size: int
+    datetime: int
+
+
+class ListImagesDataFieldSchema(TypedDict, total=True):
+    """Defines the `data` field of the `ListImagesSchema` schema"""
+
+    images: List[ImageDataSchema]
+    cursor: Optional[str]
+
+
+class ListImagesSchema(BaseModel):
+    """Schema for `list_images` responses"""
+
+    data: ListImagesDataFieldSchema = None
+    success: bool = True
+    status: int = 200
+
+
+class TypeStatsSchema(TypedDict, total=True):
+    """Defines a content type within the `StatsDataFieldSchema` schema"""
+
+    count: int
+    bytes: int
+
+
+class StatsDataFieldSchema(TypedDict, total=True):
+    """Defines the `data` field of the `StatsSchema` schema"""
+
+    count: int
+    bytes: int
+    types: Dict[str, TypeStatsSchema]
+
+
+class StatsSchema(BaseModel):
+    """Schema for `get_stats` responses"""
+
+    data: StatsDataFieldSchema = None
+    success: bool = True
+    status: int = 200
+
+
 # Supporting methods
+def encode_cursor(record: ImageRecord) -> str:
+    """
+    Returns the pagination cursor that points right after `record`.
+
+    Arguments:
+    ----------
+    record: ImageRecord
+      Last image of a page
+
+    Returns:
+    --------
+    str: Opaque cursor
+    """
+    return base64.urlsafe_b64encode(f"{record.created!r}:{record.image_hash}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
+    """
+    Returns creation time and name of the image a pagination cursor points to.
+
+    Arguments:
+    ----------
+    cursor: str
+      Opaque cursor returned by `encode_cursor`
+
+    Returns:
+    --------
+    Tuple[float, str]: Creation time and name of the image
+
+    Raises:
+    -------
+    ValueError: The cursor is not valid
+    """
+    try:
+        created, image_hash = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+        return float(created), image_hash
+    except (binascii.Error, ValueError) as error:
+        raise ValueError("Invalid cursor") from error
+
+
 def random_string(length: int = 8) -> str:
     """
     Returns random string of the given length.
@@ -76,7 +264,26 @@ def random_string(length: int = 8) -> str:
     )
 
 
-def get_api(folder: str, baseurl: str = "") -> APIRouter:
+def get_api(
+    folder: str,
+    baseurl: str = "",
+    shard_depth: int = 0,
+    deduplicate: bool = False,
+    cache_max_age: int = 31536000,
+    cache: Optional[ImageCache] = None,
+    index: Optional[ImageIndex] = None,
+    metrics: Optional[Metrics] = None,
+    storage: Optional[StorageBackend] = None,
+    bloom: Optional[BloomFilter] = None,
+    max_image_pixels: int = 0,
+    thumbnails: Optional[ThumbnailCache] = None,
+    transcoder: Optional[ThumbnailCache] = None,
+    transcode_formats: Sequence[ImageFormat] = (),
+    batch_workers: int = 8,
+    uploads: Optional[UploadSessions] = None,
+    default_ttl: int = 0,
+    cluster: Optional[Cluster] = None,
+) -> APIRouter:
     """
     APIRouter factory for API v3.0
 
@@ -92,6 +299,45 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
     baseurl: str
       Base URL used to build the link to the image after upload. Empty string
       means "guess"
+    shard_depth: int
+      Levels of subfolders images are spread over. 0 means flat folder
+    deduplicate: bool
+      Store identical content once and share it among images
+    cache_max_age: int
+      Seconds clients and proxies are allowed to cache images for
+    cache: ImageCache
+      In-memory cache for small images. None means disabled
+    index: ImageIndex
+      Metadata index images are looked up in. None means that images are
+      looked up in `folder`
+    metrics: Metrics
+      Where uploaded bytes and filesystem timings are recorded. None means
+      disabled
+    storage: StorageBackend
+      Where images are stored. None means one file per image in `folder`
+    bloom: BloomFilter
+      Filter requests for images that don't exist are answered from without
+      looking them up. None means disabled
+    max_image_pixels: int
+      Uploads whose width times height exceeds this are rejected. 0 means
+      unlimited
+    thumbnails: ThumbnailCache
+      Where thumbnails are made and kept. None means disabled
+    transcoder: ThumbnailCache
+      Where transcodes are made and kept. None means disabled
+    transcode_formats: Sequence[ImageFormat]
+      Formats images are transcoded to, in order of preference
+    batch_workers: int
+      Images of a batch request that are handled at the same time
+    uploads: UploadSessions
+      Where resumable uploads are kept while they are received. None means
+      disabled
+    default_ttl: int
+      Seconds images are kept for, unless their upload asks otherwise. 0
+      means forever. Expiry requires `index`
+    cluster: Cluster
+      Nodes images are spread over. None means that every image is stored
+      on this node
 
     Returns:
     --------
@@ -103,38 +349,657 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
     # Fix relative path
     if not os.path.isabs(folder):
         folder = os.path.join(os.getcwd(), folder)
+    if storage is None:
+        storage = FileSystemStorage(folder, shard_depth, deduplicate, metrics)
+
+    def get_link(request: Request, image_hash: str, name: str = "get_image") -> str:
+        """
+        Returns the URL of image `image_hash`.
+
+        The URL is either based on `baseurl` or guessed via url_for.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image_hash: str
+          Image name, or upload session identifier
+        name: str
+          Name of the route (default: get_image)
+
+        Returns:
+        --------
+        str: Image URL
+        """
+        parameter = "image_hash" if name == "get_image" else "session_id"
+        if baseurl:
+            url_path = api.url_path_for(name, **{parameter: image_hash})
+            while url_path.startswith("/"):
+                url_path = url_path[1:]
+            return f"{baseurl}{url_path}"
+        return str(request.url_for(name, **{parameter: image_hash}))
+
+    def may_exist(image_hash: str) -> bool:
+        """
+        Tells whether image `image_hash` might exist, without looking it up.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        bool: False if the image surely doesn't exist
+        """
+        return bloom is None or image_hash in bloom
+
+    async def lookup(image_hash: str) -> Optional[ImageRecord]:
+        """
+        Returns the metadata of image `image_hash`.
+
+        Metadata comes from `index` if any, otherwise from the storage.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[ImageRecord]: Image metadata or None if the image does not exist
+        """
+        if index is not None and storage.index_lookups:
+            return await index.get(image_hash)
+        record = await storage.stat(image_hash)
+        if record is not None and index is not None and await index.expired(image_hash):
+            return None
+        return record
+
+    async def exists(image_hash: str) -> bool:
+        """
+        Tells whether image `image_hash` exists.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        bool: True if the image exists
+        """
+        if index is not None and storage.index_lookups:
+            return await index.get(image_hash) is not None
+        if index is not None and await index.expired(image_hash):
+            return False
+        return await storage.exists(image_hash)
+
+    def owned(make: Callable[[], str]) -> str:
+        """
+        Returns a new key that belongs to this node.
+
+        Uploads are stored where they are received rather than forwarded,
+        so nodes fill up as unevenly as the load balancer spreads uploads.
+
+        Arguments:
+        ----------
+        make: Callable[[], str]
+          Returns random keys
+
+        Returns:
+        --------
+        str: Image name or upload session identifier
+        """
+        key = make()
+        while cluster is not None and not cluster.owns(key):
+            key = make()
+        return key
+
+    async def hand_over(
+        request: Request, key: str, node: Optional[str] = None
+    ) -> Optional[Response]:
+        """
+        Hands a request over to the node that owns `key`.
+
+        Requests that were handed over already are never handed over again.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        key: str
+          Image name or upload session identifier
+        node: str (optional)
+          Node to hand the request over to. None means the owner of `key`
+          (default: None)
+
+        Returns:
+        --------
+        Optional[Response]: Response of the node, None if this node has to
+        handle the request
+        """
+        if cluster is None or FORWARDED_HEADER in request.headers:
+            return None
+        if node is None:
+            node = cluster.owner(key)
+        if node == cluster.node:
+            return None
+        try:
+            return await cluster.forward(request, node)
+        except ClusterError as error:
+            raise HTTPException(status_code=503, detail=str(error)) from error
+
+    async def clustered(
+        request: Request, key: str, handler: Callable[[], Awaitable[Optional[Response]]]
+    ) -> Optional[Response]:
+        """
+        Handles a request on the node that owns `key`.
+
+        Keys that are not found locally are looked up on their previous
+        owner, while the cluster is being rebalanced.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        key: str
+          Image name
+        handler: Callable[[], Awaitable[Optional[Response]]]
+          Handles the request locally
+
+        Returns:
+        --------
+        Optional[Response]: Response of `handler` or of the owner
+        """
+        response = await hand_over(request, key)
+        if response is not None:
+            return response
+        try:
+            return await handler()
+        except HTTPException as error:
+            previous = None if cluster is None else cluster.previous_owner(key)
+            if error.status_code != 404 or previous is None:
+                raise
+            response = await hand_over(request, key, previous)
+            if response is None:
+                raise
+            return response
+
+    def max_age(record: ImageRecord) -> int:
+        """
+        Returns the seconds clients are allowed to cache image `record` for.
+
+        Arguments:
+        ----------
+        record: ImageRecord
+          Image metadata
+
+        Returns:
+        --------
+        int: `cache_max_age`, or less if the image expires sooner
+        """
+        if record.expires is None:
+            return cache_max_age
+        return max(0, min(cache_max_age, int(record.expires - time.time())))
+
+    async def run_batch(jobs: List[Callable[[], Awaitable[dict]]], items: List[dict]) -> List[dict]:
+        """
+        Runs the jobs of a batch request, `batch_workers` at a time.
+
+        Jobs that raise HTTPException are reported with its status and detail
+        rather than failing the batch.
+
+        Arguments:
+        ----------
+        jobs: List[Callable[[], Awaitable[dict]]]
+          Jobs, each one returning the description of its item
+        items: List[dict]
+          Description of the item of each job, used when it fails
+
+        Returns:
+        --------
+        List[dict]: Outcome of every job, in the order of `jobs`
+        """
+        results: List[dict] = [{} for _ in jobs]
+        limiter = anyio.CapacityLimiter(batch_workers)
+
+        async def run(position: int) -> None:
+            async with limiter:
+                try:
+                    item = await jobs[position]()
+                except HTTPException as error:
+                    results[position] = {
+                        **items[position],
+                        "status": error.status_code,
+                        "success": False,
+                        "error": error.detail,
+                    }
+                else:
+                    results[position] = {**item, "status": 200, "success": True}
+
+        async with anyio.create_task_group() as task_group:
+            for position in range(len(jobs)):
+                task_group.start_soon(run, position)
+        return results
+
+    async def get_thumbnail(image_hash: str, size: str) -> Response:
+        """
+        Gets a thumbnail of image `image_hash`.
+
+        Thumbnails are made on the first request and served from
+        `thumbnails` afterwards.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        size: str
+          Thumbnail size, one of SIZES
+
+        Returns:
+        --------
+        Response: Thumbnail response
+        """
+        record = await lookup(image_hash)
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
+        if not record.media_type.startswith("image/"):
+            raise HTTPException(
+                status_code=400, detail=f"Thumbnails are not available for {record.media_type}"
+            )
+
+        image_format = thumbnail_format(record.media_type)
+        path = thumbnails.path(image_hash, size, image_format)
+        try:
+            content = await thumbnails.get(path)
+            if content is None:
+                content = await thumbnails.make(
+                    image_hash, size, image_format, partial(storage.read, record)
+                )
+        except ThumbnailError as error:
+            raise HTTPException(status_code=400, detail="Unable to resize the image") from error
+        except FileNotFoundError as error:
+            # Deleted in the meanwhile
+            raise HTTPException(
+                status_code=404, detail=f"Unable to find image: {image_hash}"
+            ) from error
+        except OSError as error:
+            raise HTTPException(status_code=503, detail="Unable to resize the image") from error
+
+        return CachedImageResponse(
+            content,
+            image_format.media_type,
+            # Thumbnails change with their image only
+            f"{record.checksum}-{size}",
+            record.created,
+            max_age(record),
+        )
+
+    async def get_transcode(
+        image_hash: str, request: Request, start: bool
+    ) -> Tuple[Optional[Response], Optional[ImageRecord]]:
+        """
+        Gets the transcode of image `image_hash` the client prefers.
+
+        Transcodes are made in the background on the first request, the image
+        is served in the meanwhile and when the transcode is not smaller.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        request: Request
+          The HTTP request object
+        start: bool
+          Whether to start making the transcode when it doesn't exist
+
+        Returns:
+        --------
+        Tuple[Optional[Response], Optional[ImageRecord]]: Transcode response,
+        None if it is not available, and the image metadata if it was looked up
+        """
+        image_format = negotiate(request.headers.get("accept", ""), transcode_formats)
+        if image_format is None:
+            return None, None
+
+        record = await lookup(image_hash)
+        if record is None:
+            raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
+
+        path = transcoder.path(image_hash, None, image_format)
+        stat_result = await transcoder.stat(path)
+        if stat_result is None:
+            if start:
+                transcoder.start(image_hash, None, image_format, partial(storage.read, record))
+            return None, record
+        if not stat_result.st_size:
+            # Not smaller than the image
+            return None, record
+
+        return (
+            ImageResponse(
+                path,
+                stat_result.st_size,
+                record.created,
+                f"{record.checksum}-{image_format.name}",
+                max_age(record),
+                image_format.media_type,
+            ),
+            record,
+        )
+
+    async def get_original(image_hash: str, record: Optional[ImageRecord] = None) -> Response:
+        """
+        Gets image `image_hash` as it was uploaded.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        record: ImageRecord (optional)
+          Image metadata, if already looked up (default: None)
+
+        Returns:
+        --------
+        Response: Image response
+        """
+
+        if cache is not None:
+            cached = cache.get(image_hash)
+            if cached is not None:
+                if cache.is_stale(cached):
+                    # Might have been deleted by another worker
+                    if not await exists(image_hash):
+                        cache.invalidate(image_hash)
+                        raise HTTPException(
+                            status_code=404, detail=f"Unable to find image: {image_hash}"
+                        )
+                    cache.touch(image_hash)
+                return CachedImageResponse(
+                    cached.content, cached.media_type, cached.checksum, cached.mtime, cache_max_age
+                )
+
+        if record is None:
+            record = await lookup(image_hash)
+            if record is None:
+                raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
+
+        # Expiring images are never cached, so that they don't outlive their expiry
+        if cache is not None and cache.accepts(record.size) and record.expires is None:
+            try:
+                content = await storage.read(record)
+            except FileNotFoundError as error:
+                # Deleted in the meanwhile
+                raise HTTPException(
+                    status_code=404, detail=f"Unable to find image: {image_hash}"
+                ) from error
+            cache.put(image_hash, content, record.media_type, record.checksum, record.created)
+            return CachedImageResponse(
+                content, record.media_type, record.checksum, record.created, cache_max_age
+            )
+
+        return storage.response(record, max_age(record))
+
+    async def serve_image(request: Request, image_hash: str, size: Optional[str]) -> Response:
+        """
+        Serves image `image_hash` from this node.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image_hash: str
+          Image name
+        size: str
+          Thumbnail size, one of SIZES. None means the original image
+
+        Returns:
+        --------
+        Response: Image response
+        """
+        if not may_exist(image_hash):
+            raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
+
+        if size is not None and thumbnails is not None:
+            return await get_thumbnail(image_hash, size)
+
+        if transcoder is not None and guess_media_type(image_hash) in TRANSCODED_MEDIA_TYPES:
+            response, record = await get_transcode(image_hash, request, True)
+            if response is None:
+                response = await get_original(image_hash, record)
+            # Caches must not serve transcodes to clients that can't decode them
+            response.headers["Vary"] = "Accept"
+            return response
+
+        return await get_original(image_hash)
 
     @api.get(
         "/image/{image_hash}",
         response_class=FileResponse,
         responses={
             200: {"description": "Image retunerd"},
+            206: {"description": "Image ranges returned"},
+            304: {"description": "Image not modified"},
+            400: {"description": "Thumbnail not available"},
             404: {"description": "Image does not exist"},
+            416: {"description": "Range not satisfiable"},
             503: {"description": "Transient error"},
         },
         description="Returns image identified by `image_hash`",
     )
-    async def get_image(image_hash: str = IMAGEHASH) -> str:
+    async def get_image(
+        request: Request,
+        image_hash: str = IMAGEHASH,
+        size: Optional[str] = Query(
+            default=None,
+            pattern=f"^[{''.join(SIZES)}]$",
+            description="Thumbnail size: s (90x90 cropped), b (160x160 cropped), t (160), "
+            "m (320), l (640) or h (1024)",
+        ),
+    ) -> Response:
         """
         Gets image by `image_hash`
 
-        Returns the path to an image in the the `folder` folder whose name is
-        `image_hash`.
+        Returns the image in the the `folder` folder whose name is
+        `image_hash`, along with caching headers. Small images are served from
+        and added to `cache`, if any. `Range` requests are answered with the
+        requested parts of the image. With `size`, a thumbnail is returned if
+        thumbnails are enabled. PNG, JPEG and GIF images are served as one of
+        `transcode_formats` if the client accepts it and it is smaller.
 
         Arguments:
         ----------
+        request: Request
+          The HTTP request object
         image_hash: str
           Image name
+        size: str
+          Thumbnail size, one of SIZES. None means the original image
 
         Returns:
         --------
-        str: Image file path
+        Response: Image response
         """
-        filename = os.path.join(folder, image_hash)
-        if not os.path.exists(filename):
+        return await clustered(request, image_hash, partial(serve_image, request, image_hash, size))
+
+    async def serve_headers(request: Request, image_hash: str) -> Response:
+        """
+        Serves the headers of image `image_hash` from this node.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Response: Image response without body
+        """
+        if not may_exist(image_hash):
             raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
 
-        return filename
+        record = None
+        if transcoder is not None and guess_media_type(image_hash) in TRANSCODED_MEDIA_TYPES:
+            response, record = await get_transcode(image_hash, request, False)
+            if response is not None:
+                response.headers["Vary"] = "Accept"
+                return response
+
+        if cache is not None and record is None:
+            cached = cache.get(image_hash)
+            if cached is not None and not cache.is_stale(cached):
+                return CachedImageResponse(
+                    cached.content, cached.media_type, cached.checksum, cached.mtime, cache_max_age
+                )
+
+        if record is None:
+            record = await lookup(image_hash)
+            if record is None:
+                raise HTTPException(status_code=404, detail=f"Unable to find image: {image_hash}")
+
+        response = storage.response(record, max_age(record))
+        if transcoder is not None and record.media_type in TRANSCODED_MEDIA_TYPES:
+            response.headers["Vary"] = "Accept"
+        return response
+
+    @api.head(
+        "/image/{image_hash}",
+        response_class=FileResponse,
+        responses={
+            200: {"description": "Image exists"},
+            304: {"description": "Image not modified"},
+            404: {"description": "Image does not exist"},
+            503: {"description": "Transient error"},
+        },
+        description="Returns headers of image identified by `image_hash`",
+    )
+    async def head_image(request: Request, image_hash: str = IMAGEHASH) -> Response:
+        """
+        Gets headers of image by `image_hash`
+
+        Headers are built from the metadata, the image is neither read nor
+        added to `cache`. Transcodes are negotiated like with GET, but they
+        are not made.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Response: Image response without body
+        """
+        return await clustered(request, image_hash, partial(serve_headers, request, image_hash))
+
+    async def save_image(
+        request: Request,
+        image: UploadFile,
+        ttl: Optional[int] = None,
+        image_hash: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """
+        Saves an uploaded image.
+
+        The format is detected from the first bytes of the content, whatever
+        the client claims, and gives the image its extension. Files that are
+        not images, or larger than `max_image_pixels`, are rejected before
+        anything is stored.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image: UploadFile
+          The image itself
+        ttl: int (optional)
+          Seconds the image is kept for. 0 means forever, None means
+          `default_ttl` (default: None)
+        image_hash: str (optional)
+          Image name, whose extension must match the format. None means a
+          random name (default: None)
+
+        Returns:
+        --------
+        Dict[str, str]: Name and link of the image
+
+        Raises:
+        -------
+        HTTPException: The image can't be saved
+        """
+        if ttl is None:
+            ttl = default_ttl
+        if ttl and index is None:
+            raise HTTPException(status_code=400, detail="Expiring images require the index")
+
+        head = await image.read(SNIFF_BYTES)
+        image_format = sniff(head)
+        if image_format is None:
+            raise HTTPException(status_code=400, detail="Unsupported image format")
+        if max_image_pixels:
+            size = dimensions(head, image_format)
+            if size is not None and size[0] * size[1] > max_image_pixels:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Image exceeds {max_image_pixels} pixels: {size[0]}x{size[1]}",
+                )
+
+        if image_hash is None:
+            image_hash = owned(lambda: random_string(8) + image_format.extension)
+        elif os.path.splitext(image_hash)[1] != image_format.extension:
+            raise HTTPException(
+                status_code=400, detail=f"Image is {image_format.name}: {image_hash}"
+            )
+
+        link = get_link(request, image_hash)
+
+        try:
+            # Added first, so that the image is never filtered out once stored
+            if bloom is not None:
+                await anyio.to_thread.run_sync(bloom.add, image_hash)
+            saved = await storage.save(image_hash, iter_upload(image, head=head))
+        except OSError as error:
+            raise HTTPException(status_code=503, detail="Unable to upload the image") from error
+
+        # Deduplicated content keeps the mtime of its first upload, so the
+        # time of this upload is taken here
+        now = time.time()
+        media_type = guess_media_type(image_hash)
+        if index is not None:
+            record = ImageRecord(
+                image_hash,
+                saved.size,
+                media_type,
+                saved.checksum,
+                now,
+                saved.path,
+                expires=now + ttl if ttl else None,
+            )
+            try:
+                await index.add(record)
+            except sqlite3.Error as error:
+                await storage.delete(image_hash, saved.checksum)
+                raise HTTPException(status_code=503, detail="Unable to upload the image") from error
+
+        # Added again, in case a rebuild of the filter listed the images
+        # before this one was stored
+        if bloom is not None:
+            await anyio.to_thread.run_sync(partial(bloom.add, image_hash, again=True))
+
+        if metrics is not None:
+            metrics.uploaded_bytes += saved.size
+
+        # Freshly uploaded images are the most requested ones
+        if cache is not None and cache.accepts(saved.size) and not ttl:
+            await image.seek(0)
+            cache.put(image_hash, await image.read(), media_type, saved.checksum, now)
+
+        return {"deletehash": image_hash, "link": link}
 
     @api.post(
         "/upload",
@@ -146,7 +1011,9 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
         },
         description="Upload a new image",
     )
-    async def upload_image(request: Request, image: UploadFile = File(...)) -> dict:
+    async def upload_image(
+        request: Request, image: UploadFile = File(...), ttl: Optional[int] = TTL
+    ) -> dict:
         """
         Upload Image.
 
@@ -160,44 +1027,117 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
           The HTTP request object
         image: UploadFile
           The image itself
+        ttl: int
+          Seconds the image is kept for. 0 means forever, None means
+          `default_ttl`
 
         Returns:
         --------
         dict: Metadata that describe the image file (see UploadImageSchema).
         """
-        if not image.content_type.startswith("image/"):
+        return {"data": await save_image(request, image, ttl), "success": True, "status": 200}
+
+    @api.post(
+        "/upload/batch",
+        response_model=BatchSchema,
+        responses={
+            200: {"description": "Batch processed, see the status of each image"},
+            400: {"description": "Bad request"},
+        },
+        description="Upload several images",
+    )
+    async def upload_images(
+        request: Request, images: List[UploadFile] = File(...), ttl: Optional[int] = TTL
+    ) -> dict:
+        """
+        Upload Images.
+
+        Saves every image like `upload_image` does, `batch_workers` at a
+        time. Images that can't be saved don't fail the others: each one
+        gets its own status, in the order they were sent.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        images: List[UploadFile]
+          The images themselves
+        ttl: int
+          Seconds the images are kept for. 0 means forever, None means
+          `default_ttl`
+
+        Returns:
+        --------
+        dict: Outcome of every image (see BatchSchema).
+        """
+        if len(images) > BATCH_MAX_ITEMS:
             raise HTTPException(
-                status_code=400, detail=f"Unsupported content-type: {image.content_type}"
+                status_code=400, detail=f"Batches are limited to {BATCH_MAX_ITEMS} images"
             )
 
-        extension = mimetypes.guess_extension(image.content_type)
-        image_hash = random_string(8) + f"{extension}"
-        file_path = os.path.join(folder, image_hash)
-        data = await image.read()
+        async def upload(image: UploadFile) -> dict:
+            item = await save_image(request, image, ttl)
+            return {**item, "filename": image.filename}
 
-        if baseurl:
-            url_path = api.url_path_for("get_image", **{"image_hash": image_hash})
-            while url_path.startswith("/"):
-                url_path = url_path[1:]
-            link = f"{baseurl}{url_path}"
-        else:
-            link = request.url_for("get_image", **{"image_hash": image_hash})
+        results = await run_batch(
+            [partial(upload, image) for image in images],
+            [{"filename": image.filename} for image in images],
+        )
+        return {"data": results, "success": True, "status": 200}
+
+    async def remove_image(image_hash: str) -> None:
+        """
+        Removes image `image_hash` and everything derived from it.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Raises:
+        -------
+        HTTPException: The image doesn't exist or can't be removed
+        """
+        if not may_exist(image_hash):
+            raise HTTPException(status_code=404, detail="Image does not exist")
+
+        if cache is not None:
+            cache.invalidate(image_hash)
+
+        checksum = None
+        if index is not None:
+            # Forget the image first, so that it is never served half deleted
+            try:
+                record = await index.remove(image_hash)
+            except sqlite3.Error as error:
+                raise HTTPException(status_code=503, detail="Unable to delete the image") from error
+            if record is None:
+                raise HTTPException(status_code=404, detail="Image does not exist")
+            checksum = record.checksum
 
         try:
-            with open(file_path, "wb") as file:
-                file.write(data)
+            await storage.delete(image_hash, checksum)
         except FileNotFoundError as error:
-            raise HTTPException(status_code=503, detail="Unable to upload the image") from error
+            # Indexed images are gone already
+            if index is None:
+                raise HTTPException(status_code=404, detail="Image does not exist") from error
+        except IOError as error:
+            raise HTTPException(status_code=503, detail="Unable to delete the image") from error
 
-        return {
-            "data": {"deletehash": image_hash, "link": str(link)},
-            "success": True,
-            "status": 200,
-        }
+        # Thumbnails and transcodes share their cache
+        derived = thumbnails or transcoder
+        if derived is not None:
+            await derived.discard(image_hash)
+
+        if bloom is not None:
+            # Only feeds the rebuild schedule, the image is gone anyway
+            with suppress(OSError):
+                await anyio.to_thread.run_sync(bloom.discard, image_hash)
 
     @api.delete(
         "/image/{image_hash}",
         status_code=204,
+        response_model=None,
         responses={
             204: {"description": "Image deleted"},
             404: {"description": "Not Found"},
@@ -205,7 +1145,7 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
         },
         description="Deletes an existing image",
     )
-    async def delete_image(image_hash: str = IMAGEHASH) -> None:
+    async def delete_image(request: Request, image_hash: str = IMAGEHASH) -> Optional[Response]:
         """
         Deletes image by `image_hash`
 
@@ -213,18 +1153,517 @@ def get_api(folder: str, baseurl: str = "") -> APIRouter:
 
         Arguments:
         ----------
+        request: Request
+          The HTTP request object
         image_hash: str
           Image name
+
+        Returns:
+        --------
+        Optional[Response]: Response of the owner, if the image is on another node
         """
+        return await clustered(request, image_hash, partial(remove_image, image_hash))
 
-        filename = os.path.join(folder, image_hash)
+    async def delete_elsewhere(request: Request, image_hash: str, node: str) -> None:
+        """
+        Deletes image `image_hash` from another node.
 
-        if not os.path.exists(filename):
-            raise HTTPException(status_code=404, detail="Image does not exist")
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        image_hash: str
+          Image name
+        node: str
+          Node URL
 
+        Raises:
+        -------
+        HTTPException: The image doesn't exist or can't be removed
+        """
+        path = request.url_for("delete_image", image_hash=image_hash).path
         try:
-            os.unlink(filename)
-        except IOError as error:
-            raise HTTPException(status_code=503, detail="Unable to delete the image") from error
+            response = await cluster.send("DELETE", node, path)
+        except ClusterError as error:
+            raise HTTPException(status_code=503, detail=str(error)) from error
+        if response.status_code != 204:
+            # Proxies and load balancers in between may not answer with JSON
+            try:
+                detail = response.json()["detail"]
+            except (ValueError, KeyError, TypeError):
+                detail = response.reason_phrase or "Unable to delete the image"
+            raise HTTPException(status_code=response.status_code, detail=detail)
+
+    @api.post(
+        "/delete/batch",
+        response_model=BatchSchema,
+        responses={
+            200: {"description": "Batch processed, see the status of each image"},
+            422: {"description": "Validation error"},
+        },
+        description="Deletes several existing images",
+    )
+    async def delete_images(request: Request, batch: DeleteImagesSchema) -> dict:
+        """
+        Deletes images by `image_hash`
+
+        Deletes every image like `delete_image` does, `batch_workers` at a
+        time. Images that can't be deleted don't fail the others: each one
+        gets its own status, in the order they were sent.
+
+        Arguments:
+        ----------
+        request: Request
+          The HTTP request object
+        batch: DeleteImagesSchema
+          Names of the images
+
+        Returns:
+        --------
+        dict: Outcome of every image (see BatchSchema).
+        """
+
+        async def delete(image_hash: str) -> dict:
+            if len(image_hash) > 64 or not re.match(IMAGEHASH_PATTERN, image_hash):
+                raise HTTPException(status_code=400, detail=f"Invalid image hash: {image_hash}")
+            if cluster is not None and not cluster.owns(image_hash):
+                await delete_elsewhere(request, image_hash, cluster.owner(image_hash))
+            else:
+                try:
+                    await remove_image(image_hash)
+                except HTTPException as error:
+                    previous = None if cluster is None else cluster.previous_owner(image_hash)
+                    if error.status_code != 404 or previous is None:
+                        raise
+                    await delete_elsewhere(request, image_hash, previous)
+            return {"deletehash": image_hash}
+
+        results = await run_batch(
+            [partial(delete, image_hash) for image_hash in batch.hashes],
+            [{"deletehash": image_hash} for image_hash in batch.hashes],
+        )
+        for result in results:
+            if result["success"]:
+                result["status"] = 204
+        return {"data": results, "success": True, "status": 200}
+
+    if index is not None:
+
+        @api.get(
+            "/images",
+            response_model=ListImagesSchema,
+            responses={
+                200: {"description": "Images returned"},
+                400: {"description": "Bad request"},
+                503: {"description": "Transient error"},
+            },
+            description="Returns stored images, newest first",
+        )
+        async def list_images(
+            request: Request,
+            cursor: Optional[str] = Query(
+                default=None, description="`cursor` returned by the previous page"
+            ),
+            limit: int = Query(default=50, ge=1, le=500, description="Images per page"),
+        ) -> dict:
+            """
+            Lists images.
+
+            Pages are built with keyset pagination on the metadata index, so
+            the cost of a page doesn't depend on its position.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            cursor: str
+              Cursor returned by the previous page. None means first page
+            limit: int
+              Maximum number of images
+
+            Returns:
+            --------
+            dict: Images and cursor of the next page (see ListImagesSchema)
+            """
+            try:
+                before = None if cursor is None else decode_cursor(cursor)
+            except ValueError as error:
+                raise HTTPException(status_code=400, detail="Invalid cursor") from error
+
+            try:
+                records = await index.list(before, limit)
+            except sqlite3.Error as error:
+                raise HTTPException(status_code=503, detail="Unable to list images") from error
+
+            return {
+                "data": {
+                    "images": [
+                        {
+                            "deletehash": record.image_hash,
+                            "link": get_link(request, record.image_hash),
+                            "type": record.media_type,
+                            "size": record.size,
+                            "datetime": int(record.created),
+                        }
+                        for record in records
+                    ],
+                    "cursor": encode_cursor(records[-1]) if len(records) == limit else None,
+                },
+                "success": True,
+                "status": 200,
+            }
+
+        @api.get(
+            "/stats",
+            response_model=StatsSchema,
+            responses={
+                200: {"description": "Statistics returned"},
+                503: {"description": "Transient error"},
+            },
+            description="Returns number and size of stored images",
+        )
+        async def get_stats() -> dict:
+            """
+            Gets storage statistics.
+
+            Returns:
+            --------
+            dict: Number and size of images, by content type (see StatsSchema)
+            """
+            try:
+                stats = await index.stats()
+            except sqlite3.Error as error:
+                raise HTTPException(status_code=503, detail="Unable to get stats") from error
+
+            return {
+                "data": {
+                    "count": sum(count for count, _ in stats.values()),
+                    "bytes": sum(size for _, size in stats.values()),
+                    "types": {
+                        media_type: {"count": count, "bytes": size}
+                        for media_type, (count, size) in stats.items()
+                    },
+                },
+                "success": True,
+                "status": 200,
+            }
+
+    if cluster is not None:
+
+        @api.put(
+            "/image/{image_hash}",
+            response_model=UploadImageSchema,
+            responses={
+                200: {"description": "Image created"},
+                400: {"description": "Bad request"},
+                403: {"description": "Not sent by a node of the cluster"},
+                409: {"description": "Image exists"},
+                421: {"description": "Image belongs to another node"},
+                503: {"description": "Transient error"},
+            },
+            description="Stores an image under its name, to move it between nodes",
+            include_in_schema=False,
+        )
+        async def put_image(
+            request: Request,
+            image_hash: str = IMAGEHASH,
+            image: UploadFile = File(...),
+            ttl: Optional[int] = TTL,
+        ) -> dict:
+            """
+            Put Image.
+
+            Saves the image like `upload_image` does, but under `image_hash`,
+            which must belong to this node. Used by rebalancing to move
+            images to their new owner, so only nodes that know the cluster
+            secret are allowed to.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            image_hash: str
+              Image name
+            image: UploadFile
+              The image itself
+            ttl: int
+              Seconds the image is kept for. 0 means forever, None means
+              `default_ttl`
+
+            Returns:
+            --------
+            dict: Metadata that describe the image file (see UploadImageSchema).
+            """
+            if not cluster.authenticated(request):
+                raise HTTPException(status_code=403, detail="Not a node of the cluster")
+            if not cluster.owns(image_hash):
+                raise HTTPException(
+                    status_code=421,
+                    detail=f"Image belongs to {cluster.owner(image_hash)}: {image_hash}",
+                )
+            if await exists(image_hash):
+                raise HTTPException(status_code=409, detail=f"Image exists: {image_hash}")
+            data = await save_image(request, image, ttl, image_hash)
+            return {"data": data, "success": True, "status": 200}
+
+    if uploads is not None:
+
+        @api.post(
+            "/uploads",
+            status_code=201,
+            response_model=UploadSessionSchema,
+            responses={
+                201: {"description": "Upload session created"},
+                413: {"description": "Upload too large"},
+                503: {"description": "Transient error"},
+            },
+            description="Starts a resumable upload",
+        )
+        async def create_upload(
+            request: Request,
+            response: Response,
+            upload_length: int = Header(ge=0, description="Size of the image in bytes"),
+        ) -> dict:
+            """
+            Creates Upload Session.
+
+            The content of the image is then sent in chunks with
+            `append_upload`, and turned into an image with `finalize_upload`.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            response: Response
+              The HTTP response object
+            upload_length: int
+              Size of the image in bytes
+
+            Returns:
+            --------
+            dict: Identifier and link of the session (see UploadSessionSchema).
+            """
+            try:
+                session_id = await uploads.create(upload_length, owned(uploads.new_id))
+            except ValueError as error:
+                raise HTTPException(status_code=413, detail=str(error)) from error
+            except OSError as error:
+                raise HTTPException(status_code=503, detail="Unable to start the upload") from error
+
+            link = get_link(request, session_id, "get_upload")
+            response.headers["Location"] = link
+            response.headers["Upload-Offset"] = "0"
+            response.headers["Upload-Length"] = str(upload_length)
+            return {
+                "data": {"id": session_id, "link": link, "offset": 0, "length": upload_length},
+                "success": True,
+                "status": 201,
+            }
+
+        @api.head(
+            "/uploads/{session_id}",
+            responses={
+                200: {"description": "Offset returned"},
+                404: {"description": "Not Found"},
+            },
+            description="Returns how much of a resumable upload was received",
+        )
+        async def get_upload(request: Request, session_id: str = SESSIONID) -> Response:
+            """
+            Gets Upload Session.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            session_id: str
+              Session identifier
+
+            Returns:
+            --------
+            Response: Upload-Offset and Upload-Length headers
+            """
+            response = await hand_over(request, session_id)
+            if response is not None:
+                return response
+
+            status = await uploads.status(session_id)
+            if status is None:
+                raise HTTPException(status_code=404, detail="Upload does not exist")
+            return Response(
+                headers={
+                    "Upload-Offset": str(status[0]),
+                    "Upload-Length": str(status[1]),
+                    "Cache-Control": "no-store",
+                }
+            )
+
+        @api.patch(
+            "/uploads/{session_id}",
+            status_code=204,
+            responses={
+                204: {"description": "Chunk received"},
+                404: {"description": "Not Found"},
+                409: {"description": "Offset mismatch or upload in progress"},
+                413: {"description": "Chunk exceeds the upload length"},
+                415: {"description": f"Content-Type is not {OFFSET_MEDIA_TYPE}"},
+                503: {"description": "Transient error"},
+            },
+            description="Sends a chunk of a resumable upload",
+        )
+        async def append_upload(
+            request: Request,
+            session_id: str = SESSIONID,
+            upload_offset: int = Header(ge=0, description="Offset the chunk starts at"),
+        ) -> Response:
+            """
+            Appends Chunk To Upload Session.
+
+            The body is written to disk as it is received, so that the part
+            received before the client went away doesn't have to be sent
+            again. The offset to resume from is returned by `get_upload`.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            session_id: str
+              Session identifier
+            upload_offset: int
+              Offset the chunk starts at, which must be the one of the session
+
+            Returns:
+            --------
+            Response: New Upload-Offset header
+            """
+            response = await hand_over(request, session_id)
+            if response is not None:
+                return response
+
+            if request.headers.get("content-type") != OFFSET_MEDIA_TYPE:
+                raise HTTPException(
+                    status_code=415, detail=f"Content-Type must be {OFFSET_MEDIA_TYPE}"
+                )
+
+            try:
+                offset = await uploads.append(session_id, upload_offset, request.stream())
+            except FileNotFoundError as error:
+                raise HTTPException(status_code=404, detail="Upload does not exist") from error
+            except UploadConflictError as error:
+                raise HTTPException(status_code=409, detail=str(error)) from error
+            except ValueError as error:
+                raise HTTPException(status_code=413, detail=str(error)) from error
+            except ClientDisconnect:
+                # Nobody to answer, what was received is kept
+                return Response(status_code=204)
+            except OSError as error:
+                raise HTTPException(status_code=503, detail="Unable to store the chunk") from error
+
+            return Response(status_code=204, headers={"Upload-Offset": str(offset)})
+
+        @api.post(
+            "/uploads/{session_id}/finalize",
+            response_model=UploadImageSchema,
+            responses={
+                200: {"description": "Image created"},
+                400: {"description": "Bad request"},
+                404: {"description": "Not Found"},
+                409: {"description": "Upload incomplete or in progress"},
+                503: {"description": "Transient error"},
+            },
+            description="Turns a complete resumable upload into an image",
+        )
+        async def finalize_upload(request: Request, session_id: str = SESSIONID) -> dict:
+            """
+            Finalizes Upload Session.
+
+            Saves the content like `upload_image` does and removes the
+            session. Sessions whose content is refused are removed too,
+            sessions that fail for transient errors can be finalized again.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            session_id: str
+              Session identifier
+
+            Returns:
+            --------
+            dict: Metadata that describe the image file (see UploadImageSchema).
+            """
+            response = await hand_over(request, session_id)
+            if response is not None:
+                return response
+
+            try:
+                with uploads.open(session_id) as file:
+                    try:
+                        data = await save_image(request, UploadFile(file, filename=session_id))
+                    except HTTPException as error:
+                        if error.status_code < 500:
+                            await uploads.discard(session_id)
+                        raise
+            except FileNotFoundError as error:
+                raise HTTPException(status_code=404, detail="Upload does not exist") from error
+            except UploadConflictError as error:
+                raise HTTPException(status_code=409, detail=str(error)) from error
+
+            await uploads.discard(session_id)
+            return {"data": data, "success": True, "status": 200}
+
+        @api.delete(
+            "/uploads/{session_id}",
+            status_code=204,
+            response_model=None,
+            responses={
+                204: {"description": "Upload session removed"},
+                404: {"description": "Not Found"},
+            },
+            description="Abandons a resumable upload",
+        )
+        async def delete_upload(
+            request: Request, session_id: str = SESSIONID
+        ) -> Optional[Response]:
+            """
+            Deletes Upload Session.
+
+            Arguments:
+            ----------
+            request: Request
+              The HTTP request object
+            session_id: str
+              Session identifier
+
+            Returns:
+            --------
+            Optional[Response]: Response of the owner, if the session is on
+            another node
+            """
+            response = await hand_over(request, session_id)
+            if response is not None:
+                return response
+
+            if await uploads.status(session_id) is None:
+                raise HTTPException(status_code=404, detail="Upload does not exist")
+            await uploads.discard(session_id)
+            return None
+
+    if cache is not None:
+
+        @api.get(
+            "/cache",
+            responses={200: {"description": "Cache counters returned"}},
+            description="Returns counters of the in-memory image cache",
+        )
+        async def get_cache_stats() -> dict:
+            """
+            Gets in-memory image cache counters.
+
+            Returns:
+            --------
+            dict: Number of hits, misses, evictions, cached images and bytes
+            """
+            return {"data": cache.stats(), "success": True, "status": 200}
 
     return api
@@ -0,0 +1,309 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+S3-compatible image storage.
+
+This module provides `S3Storage` which stores images as objects of a bucket
+on AWS S3 or on any S3-compatible service (eg: MinIO). It requires boto3.
+"""
+
+import time
+from contextlib import suppress
+from typing import AsyncIterable, AsyncIterator, Iterator, Optional, Tuple
+
+import anyio
+
+from anastasia.metrics import Metrics
+from anastasia.storage import (
+    CHUNK_SIZE,
+    ImageRecord,
+    SavedImage,
+    StorageBackend,
+    guess_media_type,
+)
+
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+# Minimum size of the parts of multipart uploads allowed by S3
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3Storage(StorageBackend):
+    """
+    Stores images as objects within `bucket`.
+
+    Calls are made by a boto3 client from worker threads. The client keeps a
+    pool of up to `max_connections` connections, so concurrent requests
+    don't pay for new connections.
+
+    Uploads up to `part_size` bytes are sent with a single PUT. Larger ones
+    are sent as multipart uploads while they are received, so that at most
+    one part is held in memory. Downloads are streamed chunk by chunk and
+    ranges are fetched with ranged GETs. Object ETags are used as checksums,
+    so that listing the bucket describes the images as well as HEAD does.
+
+    Arguments:
+    ----------
+    bucket: str
+      Bucket name
+    prefix: str (optional)
+      Prefix of the object keys (default: "")
+    endpoint_url: str (optional)
+      URL of S3-compatible services. None means AWS (default: None)
+    region: str (optional)
+      Bucket region. None means boto3 default (default: None)
+    access_key: str (optional)
+      Access key ID. None means boto3 credential chain (default: None)
+    secret_key: str (optional)
+      Secret access key (default: None)
+    max_connections: int (optional)
+      Size of the connection pool (default: 10)
+    part_size: int (optional)
+      Size of the parts of multipart uploads (default: 8 MiB)
+    metrics: Metrics (optional)
+      Where write, stat and unlink timings are recorded (default: None)
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        max_connections: int = 10,
+        part_size: int = 8 * 1024 * 1024,
+        metrics: Optional[Metrics] = None,
+    ):
+        if boto3 is None:
+            raise RuntimeError("S3 storage requires boto3: pip install boto3")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.metrics = metrics
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=Config(
+                max_pool_connections=max_connections,
+                retries={"max_attempts": 3, "mode": "standard"},
+            ),
+        )
+
+    def key(self, image_hash: str) -> str:
+        """
+        Returns the object key of image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        str: Object key
+        """
+        return f"{self.prefix}{image_hash}"
+
+    def _observe(self, operation: str, started: float) -> None:
+        """Records the duration of a call started at `started`"""
+        if self.metrics is not None:
+            self.metrics.observe_fs(operation, time.perf_counter() - started)
+
+    async def save(self, image_hash: str, chunks: AsyncIterable[bytes]) -> SavedImage:
+        key = self.key(image_hash)
+        media_type = guess_media_type(image_hash)
+        buffer = bytearray()
+        size = 0
+        upload_id = None
+        parts = []
+        started = time.perf_counter()
+
+        try:
+            async for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = (
+                            await anyio.to_thread.run_sync(
+                                lambda: self.client.create_multipart_upload(
+                                    Bucket=self.bucket, Key=key, ContentType=media_type
+                                )
+                            )
+                        )["UploadId"]
+                    part = bytes(buffer[: self.part_size])
+                    del buffer[: self.part_size]
+                    parts.append(await self._upload_part(key, upload_id, len(parts) + 1, part))
+            if upload_id is None:
+                response = await anyio.to_thread.run_sync(
+                    lambda: self.client.put_object(
+                        Bucket=self.bucket,
+                        Key=key,
+                        Body=bytes(buffer),
+                        ContentType=media_type,
+                    )
+                )
+            else:
+                if buffer:
+                    parts.append(
+                        await self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer))
+                    )
+                response = await anyio.to_thread.run_sync(
+                    lambda: self.client.complete_multipart_upload(
+                        Bucket=self.bucket,
+                        Key=key,
+                        UploadId=upload_id,
+                        MultipartUpload={"Parts": parts},
+                    )
+                )
+        except BaseException as error:
+            if upload_id is not None:
+                # The original error is the one worth reporting
+                with anyio.CancelScope(shield=True), suppress(BotoCoreError, ClientError):
+                    await anyio.to_thread.run_sync(
+                        lambda: self.client.abort_multipart_upload(
+                            Bucket=self.bucket, Key=key, UploadId=upload_id
+                        )
+                    )
+            if isinstance(error, (BotoCoreError, ClientError)):
+                raise OSError(str(error)) from error
+            raise
+        self._observe("write", started)
+
+        return SavedImage(size, response["ETag"].strip('"'), time.time(), key)
+
+    async def _upload_part(self, key: str, upload_id: str, number: int, body: bytes) -> dict:
+        """Uploads a part of a multipart upload and returns its description"""
+        response = await anyio.to_thread.run_sync(
+            lambda: self.client.upload_part(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=body
+            )
+        )
+        return {"ETag": response["ETag"], "PartNumber": number}
+
+    async def stat(self, image_hash: str) -> Optional[ImageRecord]:
+        key = self.key(image_hash)
+        started = time.perf_counter()
+        try:
+            response = await anyio.to_thread.run_sync(
+                lambda: self.client.head_object(Bucket=self.bucket, Key=key)
+            )
+        except ClientError as error:
+            if _is_not_found(error):
+                return None
+            raise OSError(str(error)) from error
+        except BotoCoreError as error:
+            raise OSError(str(error)) from error
+        finally:
+            self._observe("stat", started)
+
+        return ImageRecord(
+            image_hash,
+            response["ContentLength"],
+            guess_media_type(image_hash),
+            response["ETag"].strip('"'),
+            response["LastModified"].timestamp(),
+            key,
+        )
+
+    async def delete(self, image_hash: str, checksum: Optional[str] = None) -> None:
+        # Deleting missing objects succeeds, but missing images have to be reported
+        if await self.stat(image_hash) is None:
+            raise FileNotFoundError(image_hash)
+
+        key = self.key(image_hash)
+        started = time.perf_counter()
+        try:
+            await anyio.to_thread.run_sync(
+                lambda: self.client.delete_object(Bucket=self.bucket, Key=key)
+            )
+        except (BotoCoreError, ClientError) as error:
+            raise OSError(str(error)) from error
+        self._observe("unlink", started)
+
+    async def stream(
+        self, record: ImageRecord, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        end = record.size if end is None else end
+        if start >= end:
+            return
+        try:
+            response = await anyio.to_thread.run_sync(
+                lambda: self.client.get_object(
+                    Bucket=self.bucket, Key=record.path, Range=f"bytes={start}-{end - 1}"
+                )
+            )
+        except ClientError as error:
+            if _is_not_found(error):
+                raise FileNotFoundError(record.image_hash) from error
+            raise OSError(str(error)) from error
+        except BotoCoreError as error:
+            raise OSError(str(error)) from error
+
+        body = response["Body"]
+        try:
+            while chunk := await anyio.to_thread.run_sync(body.read, CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    def iter_images(self) -> Iterator[Tuple[str, ImageRecord]]:
+        """
+        Iterates over the stored images.
+
+        Returns:
+        --------
+        Iterator[Tuple[str, ImageRecord]]: Image names and metadata
+        """
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                image_hash = item["Key"][len(self.prefix) :]
+                yield image_hash, ImageRecord(
+                    image_hash,
+                    item["Size"],
+                    guess_media_type(image_hash),
+                    item["ETag"].strip('"'),
+                    item["LastModified"].timestamp(),
+                    item["Key"],
+                )
+
+    def close(self) -> None:
+        self.client.close()
+
+
+def _is_not_found(error: "ClientError") -> bool:
+    """Tells whether `error` means that the object doesn't exist"""
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
@@ -31,10 +31,16 @@ This module defines app wide settings
 """
 
 import os
+from typing import List, Literal, Optional
 
-from pydantic import EmailStr
+from pydantic import EmailStr, field_validator
 from pydantic_settings import BaseSettings
 
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
 
 class Settings(BaseSettings):
     """App configuration schema"""
@@ -42,6 +48,51 @@ class Settings(BaseSettings):
     # Image folder
     folder: str
 
+    # One file per image ("files"), images appended to segment files ("pack")
+    # or objects of an S3-compatible bucket ("s3")
+    storage: Literal["files", "pack", "s3"] = "files"
+
+    # Size pack segments are rolled over at
+    pack_segment_bytes: int = 256 * 1024 * 1024
+
+    # Seconds between two compactions of pack segments (0 means disabled)
+    pack_compact_interval: int = 300
+
+    # S3-compatible bucket (None means boto3 defaults)
+    s3_bucket: str = ""
+    s3_prefix: str = ""
+    s3_endpoint_url: Optional[str] = None
+    s3_region: Optional[str] = None
+    s3_access_key: Optional[str] = None
+    s3_secret_key: Optional[str] = None
+    s3_max_connections: int = 10
+    s3_part_size: int = 8 * 1024 * 1024
+
+    # Levels of subfolders images are spread over (0 means flat folder)
+    shard_depth: int = 0
+
+    # Store identical content once
+    deduplicate: bool = False
+
+    # Look images up in the SQLite metadata index
+    enable_index: bool = False
+
+    # Seconds images are kept for, unless their upload asks otherwise (0 means forever)
+    default_ttl: int = 0
+
+    # Spread images over several nodes (empty means standalone)
+    cluster_nodes: List[str] = []
+    cluster_node: str = ""
+    cluster_previous_nodes: List[str] = []
+    cluster_redirect: bool = False
+    cluster_max_connections: int = 100
+    cluster_secret: str = ""
+
+    # Answer requests for images that don't exist from a Bloom filter
+    enable_bloom_filter: bool = False
+    bloom_filter_capacity: int = 1000000
+    bloom_filter_error_rate: float = 0.01
+
     # API frontend stuff
     contact_name: str
     contact_url: str
@@ -51,12 +102,68 @@ class Settings(BaseSettings):
     enable_gui: bool = False
     dadjokes_gui: bool = False
 
+    # Seconds clients are allowed to cache the GUI for (0 means revalidate every time)
+    gui_cache_max_age: int = 0
+
     # Activate API docs
     enable_docs: bool = False
 
     # Base URL for response
     baseurl: str = ""
 
+    # Seconds clients and proxies are allowed to cache images for
+    cache_max_age: int = 365 * 24 * 60 * 60
+
+    # In-memory cache for small images (0 means disabled)
+    memory_cache_bytes: int = 0
+    memory_cache_item_bytes: int = 1024 * 1024
+
+    # Maximum size of request bodies in bytes (0 means unlimited)
+    max_upload_bytes: int = 32 * 1024 * 1024
+
+    # Maximum width times height of uploaded images (0 means unlimited)
+    max_image_pixels: int = 0
+
+    # Images of a batch request handled at the same time
+    batch_workers: int = 8
+
+    # Requests handled at the same time, by kind (0 means unlimited), and how
+    # many more wait up to `queue_timeout` seconds before they are refused with 503
+    read_concurrency: int = 0
+    read_queue: int = 100
+    upload_concurrency: int = 0
+    upload_queue: int = 10
+    delete_concurrency: int = 0
+    delete_queue: int = 10
+    queue_timeout: float = 5.0
+
+    # Requests per second each client is allowed (0 means unlimited)
+    rate_limit: float = 0
+    rate_limit_burst: int = 20
+
+    # Accept uploads sent in chunks over several requests
+    enable_resumable_uploads: bool = False
+    upload_session_timeout: int = 24 * 60 * 60
+
+    # Serve thumbnails made in worker processes and kept on disk
+    enable_thumbnails: bool = False
+    thumbnail_cache_bytes: int = 1024 * 1024 * 1024
+    thumbnail_workers: int = 2
+
+    # Formats PNG, JPEG and GIF images are served as, if clients accept them
+    transcode_formats: List[Literal["avif", "webp"]] = []
+
+    # Expose Prometheus metrics at /metrics
+    enable_metrics: bool = False
+
+    @field_validator("cluster_nodes")
+    @classmethod
+    def check_cluster_nodes(cls, value: List[str]) -> List[str]:
+        """Cluster mode requires httpx"""
+        if value and httpx is None:
+            raise ValueError("Cluster mode requires httpx: pip install httpx")
+        return value
+
     class Config:
         """Tells pydantic to import ENV from `anastasia.cfg`"""
 
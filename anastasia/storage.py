@@ -0,0 +1,786 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Image storage.
+
+This module provides `StorageBackend`, the interface of image storages, and
+`FileSystemStorage` which writes image files to the local filesystem without
+blocking the event loop.
+"""
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import (
+    IO,
+    AsyncIterable,
+    AsyncIterator,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import anyio
+from fastapi import UploadFile
+from starlette.responses import Response
+
+from anastasia.formats import EXTENSIONS
+from anastasia.metrics import Metrics
+from anastasia.responses import ImageResponse, StreamingImageResponse
+
+# Size of the chunks uploads are read and written with
+CHUNK_SIZE = 1024 * 1024
+
+
+async def iter_upload(
+    upload: UploadFile, chunk_size: int = CHUNK_SIZE, head: bytes = b""
+) -> AsyncIterator[bytes]:
+    """
+    Iterates over the content of an uploaded file.
+
+    Arguments:
+    ----------
+    upload: UploadFile
+      The uploaded file
+    chunk_size: int (optional)
+      Maximum size of each chunk (default: CHUNK_SIZE)
+    head: bytes (optional)
+      Content already read from the file, which comes first (default: b"")
+
+    Returns:
+    --------
+    AsyncIterator[bytes]: Chunks of the uploaded file
+    """
+    if head:
+        yield head
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def guess_media_type(image_hash: str) -> str:
+    """
+    Returns the Content-Type of an image based on its extension.
+
+    Arguments:
+    ----------
+    image_hash: str
+      Image name
+
+    Returns:
+    --------
+    str: Content-Type
+    """
+    image_format = EXTENSIONS.get(os.path.splitext(image_hash)[1].lower())
+    if image_format is not None:
+        return image_format.media_type
+    return mimetypes.guess_type(image_hash)[0] or "application/octet-stream"
+
+
+def new_hasher() -> "hashlib.blake2b":
+    """Returns the hash object used to checksum image content"""
+    return hashlib.blake2b(digest_size=32)
+
+
+def file_checksum(path: str) -> str:
+    """
+    Returns the checksum of the content of a file.
+
+    Arguments:
+    ----------
+    path: str
+      File path
+
+    Returns:
+    --------
+    str: Hex digest of the content
+    """
+    hasher = new_hasher()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class SavedImage(NamedTuple):
+    """Describes an image that has just been saved"""
+
+    # Content size in bytes
+    size: int
+    # Hex digest of the content
+    checksum: str
+    # Modification time of the image file
+    mtime: float
+    # Path of the file the image is stored in, relative to the image folder
+    path: str
+
+
+class ImageRecord(NamedTuple):
+    """Metadata of a stored image"""
+
+    # Image name
+    image_hash: str
+    # Content size in bytes
+    size: int
+    # Content-Type of the image
+    media_type: str
+    # Hex digest of the content
+    checksum: str
+    # Upload time (UNIX timestamp)
+    created: float
+    # Where the image is stored: file path relative to the image folder or
+    # object key
+    path: str
+    # Offset of the image within a pack segment. None means the whole file
+    offset: Optional[int] = None
+    # Expiry time (UNIX timestamp). None means never, only known to the index
+    expires: Optional[float] = None
+
+
+def read_file(path: str, offset: Optional[int] = None, size: int = -1) -> bytes:
+    """
+    Returns the content of an image file.
+
+    Arguments:
+    ----------
+    path: str
+      Image file path
+    offset: int (optional)
+      Offset of the image within the file. None means that the image is the
+      whole file (default: None)
+    size: int (optional)
+      Size of the image, required along with `offset` (default: -1)
+
+    Returns:
+    --------
+    bytes: Image content
+    """
+    with open(path, "rb") as file:
+        if offset is None:
+            return file.read()
+        return os.pread(file.fileno(), size, offset)
+
+
+class StorageBackend(ABC):
+    """
+    Interface of image storages.
+
+    Methods are meant to be called from the event loop and must not block
+    it. Images are put with `save`, streamed with `stream` and removed with
+    `delete`.
+    """
+
+    # Whether records of the metadata index are enough to serve images
+    index_lookups = True
+
+    @abstractmethod
+    async def save(self, image_hash: str, chunks: AsyncIterable[bytes]) -> SavedImage:
+        """
+        Saves image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        chunks: AsyncIterable[bytes]
+          Image content
+
+        Returns:
+        --------
+        SavedImage: Size, checksum, modification time and path of the image
+        """
+
+    @abstractmethod
+    async def stat(self, image_hash: str) -> Optional[ImageRecord]:
+        """
+        Returns the metadata of image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[ImageRecord]: Image metadata or None if the image does not exist
+        """
+
+    async def exists(self, image_hash: str) -> bool:
+        """
+        Tells whether image `image_hash` exists.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        bool: True if the image exists
+        """
+        return await self.stat(image_hash) is not None
+
+    @abstractmethod
+    async def delete(self, image_hash: str, checksum: Optional[str] = None) -> None:
+        """
+        Deletes image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        checksum: str (optional)
+          Hex digest of the content, if known
+
+        Raises:
+        -------
+        FileNotFoundError: The image does not exist
+        """
+
+    @abstractmethod
+    def stream(
+        self, record: ImageRecord, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """
+        Iterates over the content of an image.
+
+        Arguments:
+        ----------
+        record: ImageRecord
+          Image metadata
+        start: int (optional)
+          First byte (default: 0)
+        end: int (optional)
+          Byte after the last one. None means the end of the image (default: None)
+
+        Returns:
+        --------
+        AsyncIterator[bytes]: Chunks of the content
+        """
+
+    async def read(self, record: ImageRecord) -> bytes:
+        """
+        Returns the content of an image.
+
+        Arguments:
+        ----------
+        record: ImageRecord
+          Image metadata
+
+        Returns:
+        --------
+        bytes: Image content
+        """
+        return b"".join([chunk async for chunk in self.stream(record)])
+
+    def response(self, record: ImageRecord, max_age: int) -> Response:
+        """
+        Returns the response that serves an image.
+
+        The content is streamed as it is read, it is never held in memory
+        as a whole.
+
+        Arguments:
+        ----------
+        record: ImageRecord
+          Image metadata
+        max_age: int
+          Seconds clients and proxies are allowed to cache the image for
+
+        Returns:
+        --------
+        Response: Image response
+        """
+        return StreamingImageResponse(
+            partial(self.stream, record),
+            record.size,
+            record.created,
+            record.checksum,
+            max_age,
+            record.media_type,
+        )
+
+    @abstractmethod
+    def iter_images(self) -> Iterator[Tuple[str, Union[str, ImageRecord]]]:
+        """
+        Iterates over the stored images.
+
+        This blocks, so it is meant to be called from worker threads.
+
+        Returns:
+        --------
+        Iterator[Tuple[str, Union[str, ImageRecord]]]: Image names and either
+        file paths or metadata
+        """
+
+    def close(self) -> None:
+        """Releases resources"""
+
+
+class LocalStorageBackend(StorageBackend):
+    """
+    Storage whose images are regions of files within `folder`.
+
+    Images are served through `ImageResponse`, which lets the server send
+    them with os.sendfile when possible.
+    """
+
+    folder: str
+
+    async def stream(
+        self, record: ImageRecord, start: int = 0, end: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        end = record.size if end is None else end
+        base = record.offset or 0
+        file = await anyio.to_thread.run_sync(open, os.path.join(self.folder, record.path), "rb")
+        try:
+            while start < end:
+                chunk = await anyio.to_thread.run_sync(
+                    os.pread, file.fileno(), min(CHUNK_SIZE, end - start), base + start
+                )
+                if not chunk:
+                    break
+                start += len(chunk)
+                yield chunk
+        finally:
+            file.close()
+
+    async def read(self, record: ImageRecord) -> bytes:
+        return await anyio.to_thread.run_sync(
+            read_file, os.path.join(self.folder, record.path), record.offset, record.size
+        )
+
+    def response(self, record: ImageRecord, max_age: int) -> Response:
+        return ImageResponse(
+            os.path.join(self.folder, record.path),
+            record.size,
+            record.created,
+            record.checksum,
+            max_age,
+            media_type=record.media_type,
+            offset=record.offset,
+        )
+
+
+# Number of characters of the image hash used for each level of subfolders
+SHARD_WIDTH = 2
+
+# Folder, within `folder`, that holds deduplicated content
+BLOBS_FOLDER = ".blobs"
+
+# Number of checksums kept in memory
+CHECKSUMS_SIZE = 65536
+
+
+class FileSystemStorage(LocalStorageBackend):
+    """
+    Stores images as files within `folder`.
+
+    Files are written chunk by chunk from a worker thread into a temporary
+    file that is renamed into place once complete, so that readers never see
+    partially written images and memory usage doesn't depend on file size.
+
+    When `shard_depth` is greater than 0, files are spread over `shard_depth`
+    levels of subfolders named after the first characters of the image hash,
+    (eg: `ab/cd/abcd1234.png`). Files stored at the top of `folder` are still
+    found, so that existing folders can be migrated while being served.
+
+    When `deduplicate` is True, content is stored once within `BLOBS_FOLDER`
+    under its checksum and every image is a hard link to it. The link count
+    of the blob acts as reference count: the blob is removed together with the
+    last image that points to it.
+
+    Arguments:
+    ----------
+    folder: str
+      Folder where files are stored
+    shard_depth: int (optional)
+      Levels of subfolders (default: 0)
+    deduplicate: bool (optional)
+      Store identical content once (default: False)
+    metrics: Metrics (optional)
+      Where write, stat and unlink timings are recorded (default: None)
+    """
+
+    def __init__(
+        self,
+        folder: str,
+        shard_depth: int = 0,
+        deduplicate: bool = False,
+        metrics: Optional[Metrics] = None,
+    ):
+        self.folder = folder
+        self.shard_depth = shard_depth
+        self.deduplicate = deduplicate
+        self.metrics = metrics
+        # (device, inode, mtime, size) -> checksum, in least recently used order
+        self._checksums: OrderedDict = OrderedDict()
+
+    def path(self, image_hash: str) -> str:
+        """
+        Returns the path of the file that stores `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        str: Image file path
+        """
+        prefix = image_hash[: self.shard_depth * SHARD_WIDTH]
+        # Hashes too short to be sharded stay at the top of the folder
+        if len(prefix) < self.shard_depth * SHARD_WIDTH or not prefix.isalnum():
+            return os.path.join(self.folder, image_hash)
+
+        shards = [
+            prefix[offset : offset + SHARD_WIDTH] for offset in range(0, len(prefix), SHARD_WIDTH)
+        ]
+        return os.path.join(self.folder, *shards, image_hash)
+
+    def blob_path(self, checksum: str) -> str:
+        """
+        Returns the path of the blob that stores content with `checksum`.
+
+        Arguments:
+        ----------
+        checksum: str
+          Hex digest of the content
+
+        Returns:
+        --------
+        str: Blob file path
+        """
+        return os.path.join(self.folder, BLOBS_FOLDER, checksum[:2], checksum[2:4], checksum)
+
+    def locate(self, image_hash: str) -> Optional[str]:
+        """
+        Returns the path of the file that stores `image_hash` if it exists.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+
+        Returns:
+        --------
+        Optional[str]: Image file path or None if the image does not exist
+        """
+        file_path = self.path(image_hash)
+        if os.path.isfile(file_path):
+            return file_path
+
+        flat_path = os.path.join(self.folder, image_hash)
+        if flat_path == file_path:
+            return None
+        if os.path.isfile(flat_path):
+            return flat_path
+
+        # The file might have been migrated between the two lookups
+        if os.path.isfile(file_path):
+            return file_path
+        return None
+
+    async def checksum(self, file_path: str, stat_result: os.stat_result) -> str:
+        """
+        Returns the checksum of an image file.
+
+        Images are write-once, so checksums are remembered by inode and
+        modification time and content is read at most once.
+
+        Arguments:
+        ----------
+        file_path: str
+          Image file path
+        stat_result: os.stat_result
+          Result of `os.stat(file_path)`
+
+        Returns:
+        --------
+        str: Hex digest of the content
+        """
+        key = _stat_key(stat_result)
+        try:
+            self._checksums.move_to_end(key)
+            return self._checksums[key]
+        except KeyError:
+            pass
+
+        checksum = await anyio.to_thread.run_sync(file_checksum, file_path)
+        self._remember_checksum(key, checksum)
+        return checksum
+
+    async def stat(self, image_hash: str) -> Optional[ImageRecord]:
+        filename = self.locate(image_hash)
+        if filename is None:
+            return None
+        try:
+            started = time.perf_counter()
+            stat_result = os.stat(filename)
+            if self.metrics is not None:
+                self.metrics.observe_fs("stat", time.perf_counter() - started)
+            checksum = await self.checksum(filename, stat_result)
+        except FileNotFoundError:
+            # Deleted in the meanwhile
+            return None
+
+        return ImageRecord(
+            image_hash,
+            stat_result.st_size,
+            guess_media_type(image_hash),
+            checksum,
+            stat_result.st_mtime,
+            os.path.relpath(filename, self.folder),
+        )
+
+    async def exists(self, image_hash: str) -> bool:
+        return self.locate(image_hash) is not None
+
+    def _remember_checksum(self, key: tuple, checksum: str) -> None:
+        """Adds `checksum` to the in-memory checksums"""
+        self._checksums[key] = checksum
+        if len(self._checksums) > CHECKSUMS_SIZE:
+            self._checksums.popitem(last=False)
+
+    async def delete(self, image_hash: str, checksum: Optional[str] = None) -> None:
+        """
+        Deletes image `image_hash`.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        checksum: str (optional)
+          Hex digest of the content, if known. Saves reading the content when
+          the last image pointing to a blob is deleted
+
+        Raises:
+        -------
+        FileNotFoundError: The image does not exist
+        """
+        started = time.perf_counter()
+        await anyio.to_thread.run_sync(self._delete, image_hash, checksum)
+        if self.metrics is not None:
+            self.metrics.observe_fs("unlink", time.perf_counter() - started)
+
+    def _delete(self, image_hash: str, checksum: Optional[str]) -> None:
+        """Blocking implementation of `delete`"""
+        file_path = self.locate(image_hash)
+        if file_path is None:
+            raise FileNotFoundError(image_hash)
+
+        # Two links means that this is the last image pointing to a blob
+        stat_result = os.stat(file_path)
+        if stat_result.st_nlink != 2:
+            checksum = None
+        elif checksum is None:
+            checksum = file_checksum(file_path)
+
+        os.unlink(file_path)
+
+        if checksum is not None:
+            blob_path = self.blob_path(checksum)
+            try:
+                blob_stat = os.stat(blob_path)
+                if blob_stat.st_ino == stat_result.st_ino and blob_stat.st_nlink == 1:
+                    os.unlink(blob_path)
+            except FileNotFoundError:
+                pass
+
+    async def save(self, image_hash: str, chunks: AsyncIterable[bytes]) -> SavedImage:
+        """
+        Saves image `image_hash` atomically.
+
+        Content is checksummed while it is written.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        chunks: AsyncIterable[bytes]
+          Image content
+
+        Returns:
+        --------
+        SavedImage: Size, checksum, modification time and path of the image
+        """
+        file_path = self.path(image_hash)
+        file_descriptor, temp_path = await anyio.to_thread.run_sync(
+            _mkstemp, os.path.dirname(file_path)
+        )
+
+        size = 0
+        writing = 0.0
+        hasher = new_hasher()
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                async for chunk in chunks:
+                    started = time.perf_counter()
+                    await anyio.to_thread.run_sync(_write_chunk, file, hasher, chunk)
+                    writing += time.perf_counter() - started
+                    size += len(chunk)
+            checksum = hasher.hexdigest()
+
+            if self.deduplicate:
+                await anyio.to_thread.run_sync(self._link_blob, temp_path, file_path, checksum)
+            else:
+                await anyio.to_thread.run_sync(os.replace, temp_path, file_path)
+        except BaseException:
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(_unlink, temp_path)
+            raise
+
+        started = time.perf_counter()
+        stat_result = await anyio.to_thread.run_sync(os.stat, file_path)
+        if self.metrics is not None:
+            self.metrics.observe_fs("write", writing)
+            self.metrics.observe_fs("stat", time.perf_counter() - started)
+        self._remember_checksum(_stat_key(stat_result), checksum)
+
+        return SavedImage(
+            size, checksum, stat_result.st_mtime, os.path.relpath(file_path, self.folder)
+        )
+
+    def _link_blob(self, temp_path: str, file_path: str, checksum: str) -> None:
+        """
+        Makes `file_path` a hard link to the blob with `checksum`.
+
+        The blob is created from `temp_path` unless it exists already.
+        `temp_path` is removed in both cases.
+        """
+        blob_path = self.blob_path(checksum)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        link_path = f"{temp_path}.link"
+
+        while True:
+            try:
+                os.link(temp_path, blob_path)
+            except FileExistsError:
+                pass
+            try:
+                os.link(blob_path, link_path)
+            except FileNotFoundError:
+                # The blob has been removed by a concurrent delete
+                continue
+            break
+
+        os.replace(link_path, file_path)
+        os.unlink(temp_path)
+
+    def iter_images(self) -> Iterator[Tuple[str, str]]:
+        """
+        Iterates over the stored images, in both flat and sharded layouts.
+
+        Returns:
+        --------
+        Iterator[Tuple[str, str]]: Image names and file paths
+        """
+        folders = [self.folder]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    # Temporary and internal files
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.name, entry.path
+
+    def migrate(self, workers: Optional[int] = None) -> int:
+        """
+        Moves files stored at the top of `folder` into their subfolders.
+
+        Files are moved concurrently with atomic renames, so the folder can
+        keep being served in the meanwhile.
+
+        Arguments:
+        ----------
+        workers: int (optional)
+          Number of concurrent threads (default: ThreadPoolExecutor default)
+
+        Returns:
+        --------
+        int: Number of files that have been moved
+        """
+        if not self.shard_depth:
+            return 0
+
+        def move(image_hash: str) -> bool:
+            file_path = self.path(image_hash)
+            flat_path = os.path.join(self.folder, image_hash)
+            if file_path == flat_path:
+                return False
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            try:
+                os.rename(flat_path, file_path)
+            except FileNotFoundError:
+                # Deleted in the meanwhile
+                return False
+            return True
+
+        with os.scandir(self.folder) as entries:
+            image_hashes = [
+                entry.name
+                for entry in entries
+                if not entry.name.startswith(".") and entry.is_file(follow_symlinks=False)
+            ]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return sum(executor.map(move, image_hashes))
+
+
+def _stat_key(stat_result: os.stat_result) -> tuple:
+    """Returns the key checksums are remembered by"""
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+
+def _write_chunk(file: IO[bytes], hasher: "hashlib.blake2b", chunk: bytes) -> None:
+    """Writes `chunk` to `file` and feeds it to `hasher`"""
+    file.write(chunk)
+    hasher.update(chunk)
+
+
+def _mkstemp(directory: str) -> tuple:
+    """Creates a hidden temporary file within `directory`, creating it if necessary"""
+    os.makedirs(directory, exist_ok=True)
+    return tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+
+
+def _unlink(path: str) -> None:
+    """Removes `path` ignoring missing files"""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,571 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Thumbnails and transcodes.
+
+This module provides `ThumbnailCache` which resizes images to a fixed set
+of imgur-style sizes, or converts them to formats that compress better, in
+worker processes, and keeps the results on disk within a byte budget.
+"""
+
+import asyncio
+import fcntl
+import io
+import os
+import shutil
+import struct
+import tempfile
+import time
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import anyio
+import anyio.to_process
+
+from anastasia.formats import AVIF, GIF, JPEG, PNG, WEBP, ImageFormat
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover
+    Image = None
+
+# Folder, within the image folder, that holds the thumbnails
+THUMBNAILS_FOLDER = ".thumbnails"
+
+# Seconds between two refreshes of the modification time of a thumbnail,
+# which is the time it was last used
+TOUCH_INTERVAL = 60
+
+# File, within the thumbnails folder, that holds the size of the cache as
+# a 64 bit integer, shared by all of the processes. It is missing or empty
+# when the size is not known
+SIZE_FILE = ".size"
+SIZE_FORMAT = struct.Struct("<q")
+
+# Lock file that keeps evictions from running in several processes at once
+EVICT_LOCK = ".evict"
+
+# Evictions bring the cache down to this fraction of its budget, so that
+# they don't run on every new thumbnail
+EVICT_TO = 0.9
+
+
+class ThumbnailSize(NamedTuple):
+    """Size of a thumbnail"""
+
+    # Maximum width and height
+    width: int
+    height: int
+    # Whether the image is cropped to fill the size, rather than fit within it
+    crop: bool
+
+
+# Suffixes of imgur thumbnails
+SIZES = {
+    "s": ThumbnailSize(90, 90, True),
+    "b": ThumbnailSize(160, 160, True),
+    "t": ThumbnailSize(160, 160, False),
+    "m": ThumbnailSize(320, 320, False),
+    "l": ThumbnailSize(640, 640, False),
+    "h": ThumbnailSize(1024, 1024, False),
+}
+
+# Thumbnails keep the format of the original when it is one of these,
+# others (GIF, AVIF) become PNG
+THUMBNAIL_FORMATS = {image_format.media_type: image_format for image_format in (JPEG, PNG, WEBP)}
+
+
+# Encoder options by format, for lossy ("JPEG") and other sources. Images
+# that are not JPEG already are kept lossless when the format allows it
+ENCODER_OPTIONS = {
+    WEBP: ({"quality": 80}, {"lossless": True}),
+    AVIF: ({"quality": 70}, {"quality": 90}),
+}
+
+# Names of the files of transcodes, which keep the size of their image
+FULL_SIZE = "full"
+
+# Content-Types of the images that are transcoded
+TRANSCODED_MEDIA_TYPES = frozenset(image_format.media_type for image_format in (PNG, JPEG, GIF))
+
+
+class ThumbnailError(Exception):
+    """The image can't be resized or transcoded"""
+
+
+def thumbnail_format(media_type: str) -> ImageFormat:
+    """
+    Returns the format of the thumbnails of an image.
+
+    Arguments:
+    ----------
+    media_type: str
+      Content-Type of the image
+
+    Returns:
+    --------
+    ImageFormat: Thumbnail format
+    """
+    return THUMBNAIL_FORMATS.get(media_type, PNG)
+
+
+def encodable(image_format: ImageFormat) -> bool:
+    """
+    Tells whether Pillow can save images in a format.
+
+    Arguments:
+    ----------
+    image_format: ImageFormat
+      The format
+
+    Returns:
+    --------
+    bool: True if Pillow has an encoder for the format
+    """
+    if Image is None:
+        return False
+    Image.init()
+    return image_format.name.upper() in Image.SAVE
+
+
+def render(content: bytes, size: Optional[str], image_format: ImageFormat) -> bytes:
+    """
+    Resizes or transcodes an image. Runs within worker processes.
+
+    Images are never enlarged. Thumbnails are made of the first frame of
+    animations, which are not transcoded.
+
+    Arguments:
+    ----------
+    content: bytes
+      Original image
+    size: str
+      One of SIZES. None means that the image keeps its size
+    image_format: ImageFormat
+      Format of the result
+
+    Returns:
+    --------
+    bytes: Thumbnail or transcode
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            lossy, lossless = ENCODER_OPTIONS.get(image_format, ({}, {}))
+            options = lossy if image.format == "JPEG" else lossless
+            if size is None:
+                if getattr(image, "is_animated", False):
+                    raise ThumbnailError("Animations are not transcoded")
+                image = ImageOps.exif_transpose(image)
+            else:
+                width, height, crop = SIZES[size]
+                # Lets JPEG decoders skip the resolution that is not needed
+                image.draft("RGB", (width, height))
+                image = ImageOps.exif_transpose(image)
+                if crop:
+                    image = ImageOps.fit(image, (width, height))
+                else:
+                    image.thumbnail((width, height))
+            if image_format is JPEG and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode == "P":
+                image = image.convert("RGBA")
+
+            output = io.BytesIO()
+            image.save(output, image_format.name.upper(), **options)
+    # KeyError means that Pillow has no encoder for the format
+    except (KeyError, OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ThumbnailError(str(error)) from None
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """
+    Disk cache of thumbnails.
+
+    Thumbnails are stored as `<image hash>/<size><extension>` within the
+    `.thumbnails` subfolder of `folder`, and transcodes as
+    `<image hash>/full<extension>`, so that the ones of an image are removed
+    together. Every worker process sees the thumbnails made by the
+    others. Modification times record when thumbnails were last used, and
+    the least recently used ones are removed when the cache exceeds
+    `max_bytes`. The size of the cache is kept up to date as thumbnails are
+    stored and removed, so that the cache is only scanned when it is over
+    budget, or when its size is not known yet.
+
+    Thumbnails and transcodes are made in up to `workers` processes.
+    Concurrent requests for one that is being made wait for the same job.
+    Transcodes that are not smaller than their image, or that can't be made,
+    are stored empty, so that they are not attempted again.
+
+    Arguments:
+    ----------
+    folder: str
+      Image folder
+    max_bytes: int
+      Size of the cache in bytes
+    workers: int (optional)
+      Maximum number of concurrent jobs (default: 2)
+    """
+
+    def __init__(self, folder: str, max_bytes: int, workers: int = 2):
+        if Image is None:
+            raise RuntimeError("Thumbnails require Pillow: pip install pillow")
+
+        self.root = os.path.join(folder, THUMBNAILS_FOLDER)
+        self.max_bytes = max_bytes
+        self.limiter = anyio.CapacityLimiter(workers)
+        self._jobs: Dict[str, asyncio.Future] = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, image_hash: str, size: Optional[str], image_format: ImageFormat) -> str:
+        """
+        Returns the path of a thumbnail or of a transcode.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        size: str
+          One of SIZES. None means transcode
+        image_format: ImageFormat
+          Format of the thumbnail or of the transcode
+
+        Returns:
+        --------
+        str: File path
+        """
+        name = size or FULL_SIZE
+        return os.path.join(self.root, image_hash, f"{name}{image_format.extension}")
+
+    def _touch(self, path: str, mtime: float) -> None:
+        """Records that a file has been used"""
+        now = time.time()
+        if now - mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except FileNotFoundError:
+                # Evicted in the meanwhile
+                pass
+
+    def _get(self, path: str) -> Optional[bytes]:
+        """Blocking implementation of `get`"""
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+                mtime = os.fstat(file.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+        self._touch(path, mtime)
+        return content
+
+    async def get(self, path: str) -> Optional[bytes]:
+        """
+        Returns a thumbnail and records that it has been used.
+
+        Thumbnails are small, so they are read as a whole.
+
+        Arguments:
+        ----------
+        path: str
+          Thumbnail file path
+
+        Returns:
+        --------
+        Optional[bytes]: Thumbnail or None if it doesn't exist
+        """
+        return await anyio.to_thread.run_sync(self._get, path)
+
+    def _stat(self, path: str) -> Optional[os.stat_result]:
+        """Blocking implementation of `stat`"""
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        self._touch(path, stat_result.st_mtime)
+        return stat_result
+
+    async def stat(self, path: str) -> Optional[os.stat_result]:
+        """
+        Looks a transcode up and records that it has been used.
+
+        Transcodes can be as large as their image, so they are sent from
+        their file. Having just been used, they are not the next to be
+        evicted.
+
+        Arguments:
+        ----------
+        path: str
+          Transcode file path
+
+        Returns:
+        --------
+        Optional[os.stat_result]: File status or None if it doesn't exist
+        """
+        return await anyio.to_thread.run_sync(self._stat, path)
+
+    def _update_size(self, update: Callable[[Optional[int]], Optional[int]]) -> Optional[int]:
+        """
+        Updates the size of the cache shared by all of the processes.
+
+        This blocks, so it is meant to be called from worker threads.
+
+        Arguments:
+        ----------
+        update: Callable[[Optional[int]], Optional[int]]
+          Returns the new size given the current one, which is None if it is
+          not known. None leaves the size unknown
+
+        Returns:
+        --------
+        Optional[int]: Size of the cache before the update, or None if it was
+          not known
+        """
+        file_descriptor = os.open(os.path.join(self.root, SIZE_FILE), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX)
+            content = os.pread(file_descriptor, SIZE_FORMAT.size, 0)
+            size = SIZE_FORMAT.unpack(content)[0] if len(content) == SIZE_FORMAT.size else None
+            new_size = update(size)
+            if new_size is not None and new_size != size:
+                os.pwrite(file_descriptor, SIZE_FORMAT.pack(max(new_size, 0)), 0)
+            return size
+        finally:
+            # Releases the lock too
+            os.close(file_descriptor)
+
+    def _grow(self, delta: int) -> None:
+        """Adds `delta` bytes to the size of the cache, if it is known"""
+        self._update_size(lambda size: None if size is None else size + delta)
+
+    def _put(self, path: str, content: bytes) -> None:
+        """Writes a thumbnail atomically"""
+        # Counted before it is stored: if it is not, the size is too large
+        # and the next eviction fixes it with a scan
+        self._grow(len(content))
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.root, prefix=".", suffix=".part")
+        try:
+            with os.fdopen(file_descriptor, "wb") as file:
+                file.write(content)
+            # Evictions remove folders that are left empty
+            for _ in range(3):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.replace(temp_path, path)
+                    break
+                except FileNotFoundError:
+                    continue
+            else:
+                raise OSError(f"Unable to store {path}")
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def start(
+        self,
+        image_hash: str,
+        size: Optional[str],
+        image_format: ImageFormat,
+        read: Callable[[], Awaitable[bytes]],
+    ) -> asyncio.Future:
+        """
+        Starts making a thumbnail or a transcode, unless it is being made.
+
+        Jobs run on their own, so that they aren't cancelled with the request
+        that started them while other requests wait for them.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        size: str
+          One of SIZES. None means transcode
+        image_format: ImageFormat
+          Format of the thumbnail or of the transcode
+        read: Callable[[], Awaitable[bytes]]
+          Returns the content of the image
+
+        Returns:
+        --------
+        asyncio.Future: The job, whose result is the thumbnail or the transcode
+        """
+        path = self.path(image_hash, size, image_format)
+        job = self._jobs.get(path)
+        if job is None:
+            job = self._jobs[path] = asyncio.ensure_future(
+                self._make(path, size, image_format, read)
+            )
+            job.add_done_callback(lambda _: self._forget(path))
+        return job
+
+    async def make(
+        self,
+        image_hash: str,
+        size: Optional[str],
+        image_format: ImageFormat,
+        read: Callable[[], Awaitable[bytes]],
+    ) -> bytes:
+        """
+        Makes a thumbnail or a transcode and stores it.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        size: str
+          One of SIZES. None means transcode
+        image_format: ImageFormat
+          Format of the thumbnail or of the transcode
+        read: Callable[[], Awaitable[bytes]]
+          Returns the content of the image
+
+        Returns:
+        --------
+        bytes: Thumbnail or transcode, empty if the transcode is not smaller
+
+        Raises:
+        -------
+        ThumbnailError: The image can't be resized
+        """
+        return await asyncio.shield(self.start(image_hash, size, image_format, read))
+
+    def _forget(self, path: str) -> None:
+        """Removes a finished job"""
+        job = self._jobs.pop(path)
+        # Retrieved, so that failures nobody waited for are not logged
+        if not job.cancelled():
+            job.exception()
+
+    async def _make(
+        self,
+        path: str,
+        size: Optional[str],
+        image_format: ImageFormat,
+        read: Callable[[], Awaitable[bytes]],
+    ) -> bytes:
+        """Implementation of `make`"""
+        original = await read()
+        try:
+            content = await anyio.to_process.run_sync(
+                render, original, size, image_format, limiter=self.limiter
+            )
+        except ThumbnailError:
+            if size is not None:
+                raise
+            content = b""
+        if size is None and len(content) >= len(original):
+            content = b""
+        await anyio.to_thread.run_sync(self._put, path, content)
+        return content
+
+    def _discard(self, image_hash: str) -> None:
+        """Blocking implementation of `discard`"""
+        folder = os.path.join(self.root, image_hash)
+        removed = 0
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    removed += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            return
+        shutil.rmtree(folder, ignore_errors=True)
+        self._grow(-removed)
+
+    async def discard(self, image_hash: str) -> None:
+        """
+        Removes the thumbnails and the transcodes of an image.
+
+        Arguments:
+        ----------
+        image_hash: str
+          Image name
+        """
+        await anyio.to_thread.run_sync(self._discard, image_hash)
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used thumbnails if the cache exceeds its size.
+
+        The cache is only scanned if its size exceeds the budget or is not
+        known, and by one process at a time: the others leave it alone in
+        the meanwhile.
+
+        This blocks, so it is meant to be called from worker threads.
+
+        Returns:
+        --------
+        int: Number of removed thumbnails
+        """
+        with open(os.path.join(self.root, EVICT_LOCK), "a+b") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            try:
+                return self._evict()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict(self) -> int:
+        """Implementation of `evict`, once its lock is held"""
+        known = self._update_size(lambda size: size)
+        if known is not None and known <= self.max_bytes:
+            return 0
+
+        thumbnails: List[Tuple[float, int, str]] = []
+        total = 0
+        with os.scandir(self.root) as folders:
+            for folder in folders:
+                if folder.name.startswith(".") or not folder.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    with os.scandir(folder.path) as entries:
+                        for entry in entries:
+                            stat_result = entry.stat(follow_symlinks=False)
+                            thumbnails.append(
+                                (stat_result.st_mtime, stat_result.st_size, entry.path)
+                            )
+                            total += stat_result.st_size
+                except FileNotFoundError:
+                    # Discarded in the meanwhile
+                    continue
+
+        removed = 0
+        if total > self.max_bytes:
+            thumbnails.sort()
+            for _, size, path in thumbnails:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.unlink(path)
+                    # Fails unless it was the last thumbnail of its image
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+                total -= size
+                removed += 1
+
+        # Keeps what was stored and discarded during the scan
+        self._update_size(
+            lambda size: total if size is None or known is None else total + size - known
+        )
+        return removed
@@ -0,0 +1,306 @@
+# MIT License
+#
+# Copyright (c) 2024, Marco Marzetti <marco@lamehost.it>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Resumable uploads.
+
+This module provides `UploadSessions` which keeps the content of uploads
+that are received over several requests, so that clients on flaky links
+can resume them rather than start over.
+"""
+
+import fcntl
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+from typing import IO, AsyncIterable, Iterator, Optional, Tuple
+
+import anyio
+
+# Folder, within the image folder, that holds the upload sessions
+UPLOADS_FOLDER = ".uploads"
+
+
+class UploadConflictError(Exception):
+    """Raised when a session is being written by another request, or is elsewhere"""
+
+
+class UploadSessions:
+    """
+    Sessions of resumable uploads.
+
+    Sessions are kept within the `.uploads` subfolder of `folder`, as the
+    content received so far plus a `.json` file that holds the declared
+    length, so that every worker process can resume the sessions created
+    by the others. The offset of a session is the size of its content, and
+    requests that write to it hold an exclusive lock on it.
+
+    Arguments:
+    ----------
+    folder: str
+      Image folder
+    timeout: int
+      Seconds sessions are kept for after they were last written to
+    max_bytes: int (optional)
+      Maximum length of the uploads. 0 means unlimited (default: 0)
+    """
+
+    def __init__(self, folder: str, timeout: int, max_bytes: int = 0):
+        self.root = os.path.join(folder, UPLOADS_FOLDER)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, session_id: str) -> str:
+        """
+        Returns the path of the content of a session.
+
+        Arguments:
+        ----------
+        session_id: str
+          Session identifier
+
+        Returns:
+        --------
+        str: File path
+        """
+        return os.path.join(self.root, session_id)
+
+    @staticmethod
+    def new_id() -> str:
+        """
+        Returns a random session identifier.
+
+        Returns:
+        --------
+        str: Session identifier
+        """
+        return secrets.token_hex(16)
+
+    def _create(self, length: int, session_id: str) -> str:
+        """Blocking implementation of `create`"""
+        with open(self.path(session_id), "xb"):
+            pass
+        with open(f"{self.path(session_id)}.json", "x", encoding="utf-8") as file:
+            json.dump({"length": length, "created": time.time()}, file)
+        return session_id
+
+    async def create(self, length: int, session_id: Optional[str] = None) -> str:
+        """
+        Creates a session.
+
+        Arguments:
+        ----------
+        length: int
+          Size of the upload in bytes
+        session_id: str (optional)
+          Session identifier, from `new_id`. None means a new one
+          (default: None)
+
+        Returns:
+        --------
+        str: Session identifier
+
+        Raises:
+        -------
+        ValueError: `length` exceeds `max_bytes`
+        """
+        if length < 0 or (self.max_bytes and length > self.max_bytes):
+            raise ValueError(f"Upload length must be between 0 and {self.max_bytes} bytes")
+        return await anyio.to_thread.run_sync(self._create, length, session_id or self.new_id())
+
+    def _status(self, session_id: str) -> Optional[Tuple[int, int]]:
+        """Blocking implementation of `status`"""
+        try:
+            with open(f"{self.path(session_id)}.json", encoding="utf-8") as file:
+                length = json.load(file)["length"]
+            return os.stat(self.path(session_id)).st_size, length
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    async def status(self, session_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Returns offset and length of a session.
+
+        Arguments:
+        ----------
+        session_id: str
+          Session identifier
+
+        Returns:
+        --------
+        Optional[Tuple[int, int]]: Bytes received and bytes declared, or None
+        if the session does not exist
+        """
+        return await anyio.to_thread.run_sync(self._status, session_id)
+
+    @contextmanager
+    def _exclusive(self, session_id: str, append: bool = False) -> Iterator[IO[bytes]]:
+        """Opens the content of a session and locks it, without waiting"""
+        if append:
+            # Never recreates sessions removed in the meanwhile
+            file = os.fdopen(os.open(self.path(session_id), os.O_WRONLY | os.O_APPEND), "ab")
+        else:
+            file = open(self.path(session_id), "rb")  # pylint: disable=consider-using-with
+        try:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError as error:
+                raise UploadConflictError("Upload is being written by another request") from error
+            yield file
+        finally:
+            file.close()
+
+    async def append(self, session_id: str, offset: int, chunks: AsyncIterable[bytes]) -> int:
+        """
+        Appends content to a session.
+
+        Chunks are written as they are received, so whatever was received
+        before the client went away is kept. Chunks that would exceed the
+        declared length are refused whole.
+
+        Arguments:
+        ----------
+        session_id: str
+          Session identifier
+        offset: int
+          Offset the content starts at, which must be the one of the session
+        chunks: AsyncIterable[bytes]
+          Content
+
+        Returns:
+        --------
+        int: New offset of the session
+
+        Raises:
+        -------
+        FileNotFoundError: The session does not exist
+        UploadConflictError: `offset` is not the one of the session, or the
+        session is being written by another request
+        ValueError: Content exceeds the declared length
+        """
+        status = await self.status(session_id)
+        if status is None:
+            raise FileNotFoundError(session_id)
+        length = status[1]
+
+        with self._exclusive(session_id, append=True) as file:
+            position = os.fstat(file.fileno()).st_size
+            if position != offset:
+                raise UploadConflictError(f"Upload is at offset {position}")
+            try:
+                async for chunk in chunks:
+                    if position + len(chunk) > length:
+                        raise ValueError(f"Upload exceeds its length of {length} bytes")
+                    await anyio.to_thread.run_sync(file.write, chunk)
+                    position += len(chunk)
+            finally:
+                await anyio.to_thread.run_sync(file.flush)
+        return position
+
+    @contextmanager
+    def open(self, session_id: str) -> Iterator[IO[bytes]]:
+        """
+        Opens the content of a complete session for reading.
+
+        The session is locked meanwhile, so that it is read once.
+
+        Arguments:
+        ----------
+        session_id: str
+          Session identifier
+
+        Returns:
+        --------
+        Iterator[IO[bytes]]: Content
+
+        Raises:
+        -------
+        FileNotFoundError: The session does not exist
+        UploadConflictError: The session is incomplete, or used by another
+        request
+        """
+        status = self._status(session_id)
+        if status is None:
+            raise FileNotFoundError(session_id)
+        with self._exclusive(session_id) as file:
+            offset = os.fstat(file.fileno()).st_size
+            if offset != status[1]:
+                raise UploadConflictError(f"Upload is at offset {offset} of {status[1]}")
+            yield file
+
+    def _discard(self, session_id: str) -> None:
+        """Blocking implementation of `discard`"""
+        for path in (f"{self.path(session_id)}.json", self.path(session_id)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    async def discard(self, session_id: str) -> None:
+        """
+        Removes a session.
+
+        Arguments:
+        ----------
+        session_id: str
+          Session identifier
+        """
+        await anyio.to_thread.run_sync(self._discard, session_id)
+
+    def expire(self) -> int:
+        """
+        Removes sessions that haven't been written to for `timeout` seconds.
+
+        Sessions that are being written to are kept. This blocks, so it is
+        meant to be called from worker threads.
+
+        Returns:
+        --------
+        int: Number of removed sessions
+        """
+        deadline = time.time() - self.timeout
+        removed = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                session_id = entry.name[: -len(".json")]
+                try:
+                    mtime = os.stat(self.path(session_id)).st_mtime
+                except FileNotFoundError:
+                    # Content is gone, but metadata was left behind
+                    mtime = 0.0
+                if mtime > deadline:
+                    continue
+                try:
+                    with self._exclusive(session_id):
+                        self._discard(session_id)
+                except FileNotFoundError:
+                    self._discard(session_id)
+                except UploadConflictError:
+                    continue
+                removed += 1
+        return removed
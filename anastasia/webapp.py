@@ -27,18 +27,57 @@ This module provies `create_app` which is a FastAPI app factory that provide
 API and web frontend for the application.
 """
 
+import asyncio
+import logging
 import os
+import sqlite3
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
-from typing import Callable
+from typing import AsyncIterator, Iterator
 
-from fastapi import FastAPI, Request
-from fastapi.staticfiles import StaticFiles
+import anyio
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
+from anastasia.admission import Lane, TokenBuckets
+from anastasia.assets import StaticAssets
+from anastasia.bloom import BloomFilter
+from anastasia.cache import ImageCache
+from anastasia.cluster import Cluster
+from anastasia.formats import FORMATS
+from anastasia.index import INDEX_FILENAME, ImageIndex, ImageRecord
+from anastasia.metrics import FLUSH_INTERVAL, METRICS_FOLDER, Metrics
+from anastasia.middleware import (
+    AdmissionMiddleware,
+    LimitUploadSizeMiddleware,
+    MetricsMiddleware,
+    SecurityHeadersMiddleware,
+)
+from anastasia.packs import PackStorage
 from anastasia.routers import v3_0
+from anastasia.s3 import S3Storage
 from anastasia.settings import Settings
+from anastasia.storage import FileSystemStorage
+from anastasia.thumbnails import ThumbnailCache, encodable
+from anastasia.uploads import UploadSessions
 
 VERSION = "1.0.4"
 
+# Seconds between two checks of whether the Bloom filter has to be rebuilt
+BLOOM_CHECK_INTERVAL = 60
+
+# Seconds between two evictions of least recently used thumbnails
+THUMBNAIL_EVICT_INTERVAL = 60
+
+# Seconds between two removals of abandoned upload sessions
+UPLOAD_EXPIRE_INTERVAL = 60
+
+# Seconds between two removals of expired images
+REAP_INTERVAL = 10
+
+# Number of expired images looked up at once
+REAP_BATCH_SIZE = 100
+
 
 def create_app(api_mount_point: str = "/api/", settings: dict = False):
     """
@@ -62,9 +101,221 @@ def create_app(api_mount_point: str = "/api/", settings: dict = False):
     # Read settings
     if not settings:
         settings = Settings().dict()
+    else:
+        # Fill in defaults for the settings that were not provided
+        settings = Settings.model_construct(**settings).model_dump()
+
+    # Create folder
+    Path(settings["folder"]).mkdir(parents=True, exist_ok=True)
+
+    # Create in-memory image cache
+    if settings["memory_cache_bytes"] > 0:
+        cache = ImageCache(settings["memory_cache_bytes"], settings["memory_cache_item_bytes"])
+    else:
+        cache = None
+
+    if settings["default_ttl"] and not settings["enable_index"]:
+        raise ValueError("default_ttl requires enable_index")
+
+    # Create metadata index
+    if settings["enable_index"]:
+        index = ImageIndex(os.path.join(settings["folder"], INDEX_FILENAME))
+    else:
+        index = None
+
+    # Create metrics, shared among workers through the image folder
+    if settings["enable_metrics"]:
+        metrics = Metrics(os.path.join(settings["folder"], METRICS_FOLDER))
+    else:
+        metrics = None
+
+    # Create storage backend
+    packs = None
+    if settings["storage"] == "pack":
+        packs = PackStorage(settings["folder"], settings["pack_segment_bytes"], metrics)
+        storage = packs
+    elif settings["storage"] == "s3":
+        storage = S3Storage(
+            settings["s3_bucket"],
+            prefix=settings["s3_prefix"],
+            endpoint_url=settings["s3_endpoint_url"],
+            region=settings["s3_region"],
+            access_key=settings["s3_access_key"],
+            secret_key=settings["s3_secret_key"],
+            max_connections=settings["s3_max_connections"],
+            part_size=settings["s3_part_size"],
+            metrics=metrics,
+        )
+    else:
+        storage = FileSystemStorage(
+            os.path.abspath(settings["folder"]),
+            settings["shard_depth"],
+            settings["deduplicate"],
+            metrics,
+        )
+
+    # Create cluster of nodes images are spread over
+    if settings["cluster_nodes"]:
+        cluster = Cluster(
+            settings["cluster_node"],
+            settings["cluster_nodes"],
+            settings["cluster_previous_nodes"],
+            settings["cluster_redirect"],
+            settings["cluster_max_connections"],
+            secret=settings["cluster_secret"],
+        )
+    else:
+        cluster = None
+
+    # Create negative lookup filter, shared among workers through the image folder
+    if settings["enable_bloom_filter"]:
+        bloom = BloomFilter(
+            settings["folder"],
+            settings["bloom_filter_capacity"],
+            settings["bloom_filter_error_rate"],
+        )
+    else:
+        bloom = None
+
+    # Create cache of thumbnails and transcodes, shared among workers through
+    # the image folder
+    if settings["enable_thumbnails"] or settings["transcode_formats"]:
+        derived = ThumbnailCache(
+            settings["folder"], settings["thumbnail_cache_bytes"], settings["thumbnail_workers"]
+        )
+    else:
+        derived = None
+    transcode_formats = [
+        image_format
+        for name in settings["transcode_formats"]
+        for image_format in FORMATS
+        if image_format.name == name
+    ]
+    for image_format in list(transcode_formats):
+        if not encodable(image_format):
+            logging.getLogger("anastasia").warning(
+                "Pillow can't encode %s, images are not transcoded to it", image_format.name
+            )
+            transcode_formats.remove(image_format)
+
+    # Create resumable upload sessions, shared among workers through the image folder
+    if settings["enable_resumable_uploads"]:
+        uploads = UploadSessions(
+            settings["folder"], settings["upload_session_timeout"], settings["max_upload_bytes"]
+        )
+    else:
+        uploads = None
+
+    def iter_hashes() -> Iterator[str]:
+        """Yields the names of the stored images, from the index if enabled"""
+        if index is not None:
+            yield from index.iter_hashes()
+        else:
+            for image_hash, _ in storage.iter_images():
+                yield image_hash
+
+    async def maintain_bloom() -> None:
+        """Rebuilds the Bloom filter when it is missing or too crowded"""
+        while True:
+            if bloom.needs_rebuild():
+                try:
+                    await anyio.to_thread.run_sync(bloom.rebuild, iter_hashes())
+                except (OSError, sqlite3.Error):
+                    logging.getLogger("anastasia").exception("Unable to rebuild the Bloom filter")
+            await asyncio.sleep(BLOOM_CHECK_INTERVAL)
+
+    async def evict_thumbnails() -> None:
+        """Keeps thumbnails and transcodes within `thumbnail_cache_bytes`"""
+        while True:
+            try:
+                await anyio.to_thread.run_sync(derived.evict)
+            except OSError:
+                logging.getLogger("anastasia").exception("Unable to evict thumbnails")
+            await asyncio.sleep(THUMBNAIL_EVICT_INTERVAL)
+
+    async def expire_uploads() -> None:
+        """Removes upload sessions abandoned for `upload_session_timeout` seconds"""
+        while True:
+            try:
+                await anyio.to_thread.run_sync(uploads.expire)
+            except OSError:
+                logging.getLogger("anastasia").exception("Unable to expire upload sessions")
+            await asyncio.sleep(UPLOAD_EXPIRE_INTERVAL)
+
+    async def reap_image(record: ImageRecord) -> None:
+        """Removes expired image `record` and everything derived from it"""
+        # Forget the image first, so that workers reaping at the same time
+        # remove it once
+        if await index.remove(record.image_hash) is None:
+            return
+        if cache is not None:
+            cache.invalidate(record.image_hash)
+        with suppress(FileNotFoundError):
+            await storage.delete(record.image_hash, record.checksum)
+        if derived is not None:
+            await derived.discard(record.image_hash)
+        if bloom is not None:
+            await anyio.to_thread.run_sync(bloom.discard, record.image_hash)
+
+    async def reap_images() -> None:
+        """Removes expired images, in batches, every REAP_INTERVAL seconds"""
+        while True:
+            try:
+                while True:
+                    records = await index.due(REAP_BATCH_SIZE)
+                    for record in records:
+                        await reap_image(record)
+                    if len(records) < REAP_BATCH_SIZE:
+                        break
+            except (OSError, sqlite3.Error):
+                logging.getLogger("anastasia").exception("Unable to remove expired images")
+            await asyncio.sleep(REAP_INTERVAL)
+
+    async def compact_packs() -> None:
+        """Reclaims the space of deleted images every `pack_compact_interval` seconds"""
+        while True:
+            await asyncio.sleep(settings["pack_compact_interval"])
+            try:
+                await anyio.to_thread.run_sync(packs.compact)
+            except (OSError, sqlite3.Error):
+                logging.getLogger("anastasia").exception("Unable to compact pack segments")
+
+    async def flush_metrics() -> None:
+        """Shares the metrics of this worker every FLUSH_INTERVAL seconds"""
+        while True:
+            await metrics.flush()
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+    @asynccontextmanager
+    async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+        """Runs background tasks and releases resources on shutdown"""
+        tasks = []
+        if metrics is not None:
+            tasks.append(asyncio.create_task(flush_metrics()))
+        if bloom is not None:
+            tasks.append(asyncio.create_task(maintain_bloom()))
+        if derived is not None:
+            tasks.append(asyncio.create_task(evict_thumbnails()))
+        if uploads is not None:
+            tasks.append(asyncio.create_task(expire_uploads()))
+        if index is not None:
+            tasks.append(asyncio.create_task(reap_images()))
+        if packs is not None and settings["pack_compact_interval"] > 0:
+            tasks.append(asyncio.create_task(compact_packs()))
+        yield
+        for task in tasks:
+            task.cancel()
+        if metrics is not None:
+            metrics.discard()
+        if index is not None:
+            index.close()
+        if cluster is not None:
+            await cluster.close()
+        storage.close()
 
     # Create root webapp
     webapp = FastAPI(
+        lifespan=lifespan,
         docs_url=False,
         contact={
             "name": settings["contact_name"],
@@ -118,26 +369,73 @@ def create_app(api_mount_point: str = "/api/", settings: dict = False):
         if not baseurl.endswith("/"):
             baseurl = f"{baseurl}/"
 
-    # Create folder
-    Path(settings["folder"]).mkdir(parents=True, exist_ok=True)
-
     # Import API versions
-    api.include_router(v3_0.get_api(settings["folder"], baseurl))
+    api.include_router(
+        v3_0.get_api(
+            settings["folder"],
+            baseurl,
+            shard_depth=settings["shard_depth"],
+            deduplicate=settings["deduplicate"],
+            cache_max_age=settings["cache_max_age"],
+            cache=cache,
+            index=index,
+            metrics=metrics,
+            storage=storage,
+            bloom=bloom,
+            max_image_pixels=settings["max_image_pixels"],
+            thumbnails=derived if settings["enable_thumbnails"] else None,
+            transcoder=derived if transcode_formats else None,
+            transcode_formats=transcode_formats,
+            batch_workers=settings["batch_workers"],
+            uploads=uploads,
+            default_ttl=settings["default_ttl"],
+            cluster=cluster,
+        )
+    )
+
+    # Shed requests the API has no room for, so that uploads don't starve reads.
+    # Added first, so that refusals get the security headers too
+    if settings["rate_limit"] > 0:
+        rate_limit = TokenBuckets(settings["rate_limit"], settings["rate_limit_burst"])
+    else:
+        rate_limit = None
+    api.add_middleware(
+        AdmissionMiddleware,
+        read=Lane(settings["read_concurrency"], settings["read_queue"], settings["queue_timeout"]),
+        upload=Lane(
+            settings["upload_concurrency"], settings["upload_queue"], settings["queue_timeout"]
+        ),
+        delete=Lane(
+            settings["delete_concurrency"], settings["delete_queue"], settings["queue_timeout"]
+        ),
+        rate_limit=rate_limit,
+        # Requests proxied by other nodes were rate limited by them already
+        exempt=cluster.addresses() if cluster is not None and rate_limit is not None else (),
+    )
 
     # Add custom headers as recommended by
     # https://github.com/shieldfy/API-Security-Checklist#output
-    @api.middleware("http")
-    async def add_custom_headers(request: Request, call_next: Callable):
-        response = await call_next(request)
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "deny"
-        # Force restrictive content-security-policy for JSON content
-        try:
-            if response.headers["content-type"] == "application/json":
-                response.headers["Content-Security-Policy"] = "default-src 'none'"
-        except KeyError:
-            pass
-        return response
+    api.add_middleware(SecurityHeadersMiddleware)
+
+    # Cut off oversized request bodies before they get parsed
+    webapp.add_middleware(LimitUploadSizeMiddleware, max_upload_bytes=settings["max_upload_bytes"])
+
+    if metrics is not None:
+
+        @webapp.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+        async def get_metrics() -> str:
+            """
+            Gets metrics of all of the workers.
+
+            Returns:
+            --------
+            str: Metrics in the Prometheus text exposition format
+            """
+            images = await index.stats() if index is not None else None
+            return await metrics.render(images, bloom.stats() if bloom is not None else None)
+
+        # Outermost, so that rejected uploads are counted too
+        webapp.add_middleware(MetricsMiddleware, metrics=metrics)
 
     # Add API engine to webapp
     webapp.mount(api_mount_point, api)
@@ -149,6 +447,9 @@ def create_app(api_mount_point: str = "/api/", settings: dict = False):
             static_directory = os.path.join(app_directory, "templates", "dadjokes")
         else:
             static_directory = os.path.join(app_directory, "templates", "regular")
-        webapp.mount("/", StaticFiles(directory=static_directory, html=True), name="templates")
+        # Files are compressed once and served from memory
+        webapp.mount(
+            "/", StaticAssets(static_directory, settings["gui_cache_max_age"]), name="templates"
+        )
 
     return webapp
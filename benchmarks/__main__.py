@@ -0,0 +1,90 @@
+"""
+Benchmarks entrypoint.
+
+Runs the load-testing suite and writes the results as JSON, so that they
+can be compared between releases.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from benchmarks.load import parse_size, run
+
+
+def parse_setting(setting: str) -> tuple:
+    """Converts `key=value` into a settings item, decoding JSON values"""
+    key, value = setting.split("=", 1)
+    try:
+        return key, json.loads(value)
+    except json.JSONDecodeError:
+        return key, value
+
+
+def main() -> None:
+    """Parses command line arguments and runs the benchmarks"""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Anastasia load-testing suite"
+    )
+    parser.add_argument(
+        "--mode",
+        nargs="+",
+        choices=["asgi", "server"],
+        default=["asgi"],
+        help="drive the app in-process (asgi) or through uvicorn (server)",
+    )
+    parser.add_argument(
+        "--operation",
+        nargs="+",
+        choices=["upload", "get", "delete"],
+        default=["upload", "get", "delete"],
+    )
+    parser.add_argument(
+        "--size", nargs="+", default=["1KB", "100KB", "1MB"], help="file sizes, eg: 1KB 20MB"
+    )
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 10])
+    parser.add_argument(
+        "--population",
+        nargs="+",
+        type=int,
+        default=[0],
+        help="number of images stored before measuring, eg: 0 10000 1000000",
+    )
+    parser.add_argument("--requests", type=int, default=200, help="requests per combination")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (server mode)")
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        type=parse_setting,
+        help="app setting as key=value, eg: shard_depth=2. Can be repeated",
+    )
+    parser.add_argument("--output", default="-", help="JSON output file (default: stdout)")
+    arguments = parser.parse_args()
+
+    results = asyncio.run(
+        run(
+            arguments.mode,
+            arguments.operation,
+            [parse_size(size) for size in arguments.size],
+            arguments.concurrency,
+            arguments.population,
+            arguments.requests,
+            arguments.workers,
+            dict(arguments.setting),
+        )
+    )
+
+    if arguments.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(arguments.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {os.path.abspath(arguments.output)}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
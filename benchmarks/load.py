@@ -0,0 +1,300 @@
+"""
+Load-testing suite.
+
+Measures throughput and latency percentiles of the upload, GET and DELETE
+paths, across file sizes, concurrency levels and number of images already
+in the folder. The app is either driven in-process through an ASGI transport
+or through a real uvicorn process over TCP.
+
+usage: python -m benchmarks [options]   (see --help)
+"""
+
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import string
+import subprocess  # nosec B404
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from shutil import rmtree
+from typing import AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from anastasia import create_app
+from anastasia.index import INDEX_FILENAME, ImageIndex, ImageRecord
+from anastasia.storage import FileSystemStorage
+from anastasia.webapp import VERSION
+
+# Settings every run starts from
+BASE_SETTINGS = {
+    "contact_name": "Benchmark",
+    "contact_url": "http://localhost/",
+    "contact_email": "benchmark@example.com",
+    "baseurl": "http://localhost:8080/",
+    "max_upload_bytes": 0,
+}
+
+# Number of population records written per batch
+POPULATE_BATCH_SIZE = 10000
+
+
+def parse_size(size: str) -> int:
+    """Converts sizes like `1KB`, `20MB` or `512` into bytes"""
+    units = {"KB": 1024, "MB": 1024 * 1024, "GB": 1024 * 1024 * 1024}
+    size = size.strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * multiplier)
+    return int(size)
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    """Returns the nearest-rank percentile of sorted `latencies`"""
+    if not latencies:
+        return 0.0
+    rank = max(0, min(len(latencies) - 1, round(fraction * len(latencies)) - 1))
+    return latencies[rank]
+
+
+def payload(size: int) -> bytes:
+    """Returns a GIF-looking payload of `size` bytes"""
+    header = b"GIF89a\x01\x00\x01\x00\x00\x00\x00;"
+    return header + os.urandom(max(0, size - len(header)))
+
+
+def populate(settings: dict, count: int) -> None:
+    """
+    Fills the image folder with `count` small images.
+
+    Images are laid out according to `shard_depth` and added to the
+    metadata index if enabled, as if they had been uploaded.
+    """
+    if not count:
+        return
+
+    storage = FileSystemStorage(settings["folder"], settings.get("shard_depth", 0))
+    index = None
+    if settings.get("enable_index"):
+        index = ImageIndex(os.path.join(settings["folder"], INDEX_FILENAME))
+
+    alphabet = string.ascii_lowercase + string.digits
+    records = []
+    now = time.time()
+    for _ in range(count):
+        image_hash = "".join(random.choices(alphabet, k=8)) + ".gif"  # nosec B311
+        file_path = storage.path(image_hash)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as file:
+            file.write(b"GIF89a")
+        if index is not None:
+            path = os.path.relpath(file_path, settings["folder"])
+            records.append(ImageRecord(image_hash, 6, "image/gif", "0" * 64, now, path))
+            if len(records) >= POPULATE_BATCH_SIZE:
+                index._add(records)  # pylint: disable=protected-access
+                records = []
+
+    if index is not None:
+        index._add(records)  # pylint: disable=protected-access
+        index.close()
+
+
+def free_port() -> int:
+    """Returns a TCP port nobody is listening on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def asgi_client(settings: dict) -> AsyncIterator[httpx.AsyncClient]:
+    """Yields a client that drives `create_app()` in-process"""
+    transport = httpx.ASGITransport(app=create_app(settings=settings))
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost/api/3") as client:
+        yield client
+
+
+@asynccontextmanager
+async def server_client(settings: dict, workers: int) -> AsyncIterator[httpx.AsyncClient]:
+    """Yields a client connected to `create_app()` running within uvicorn"""
+    port = free_port()
+    config = os.path.join(settings["folder"], ".benchmark.cfg")
+    with open(config, "w", encoding="utf-8") as file:
+        for key, value in settings.items():
+            # Settings are parsed as JSON, which Python's reprs of lists,
+            # dicts and booleans are not. None is the default already
+            if value is not None:
+                file.write(f"{key}={json.dumps(value)}\n")
+
+    process = subprocess.Popen(  # nosec B603
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "anastasia:create_app",
+            "--factory",
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--no-access-log",
+            "--log-level",
+            "warning",
+        ],
+        env={**os.environ, "ANASTASIA_ENV": config},
+    )
+    try:
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}/api/3", limits=limits, timeout=60
+        ) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/image/ready.gif")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn didn't start")
+            yield client
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def upload(client: httpx.AsyncClient, data: bytes) -> str:
+    """Uploads `data` and returns the image hash"""
+    response = await client.post("/upload", files={"image": ("image.gif", data, "image/gif")})
+    response.raise_for_status()
+    return response.json()["data"]["deletehash"]
+
+
+async def drive(
+    client: httpx.AsyncClient, operation: str, data: bytes, concurrency: int, requests: int
+) -> Dict:
+    """
+    Runs `requests` operations with `concurrency` concurrent clients.
+
+    GETs are spread over `concurrency` images uploaded beforehand, DELETEs
+    remove images uploaded beforehand. Setup requests are not measured.
+    """
+    if operation == "get":
+        hashes = [await upload(client, data) for _ in range(concurrency)]
+    elif operation == "delete":
+        hashes = [await upload(client, data) for _ in range(requests)]
+    else:
+        hashes = []
+
+    latencies: List[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for number in counter:
+            started = time.perf_counter()
+            if operation == "upload":
+                response = await client.post(
+                    "/upload", files={"image": ("image.gif", data, "image/gif")}
+                )
+            elif operation == "get":
+                response = await client.get(f"/image/{hashes[number % len(hashes)]}")
+            else:
+                response = await client.delete(f"/image/{hashes[number]}")
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": requests / elapsed,
+        "bytes_per_second": requests * len(data) / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+    }
+
+
+async def run(
+    modes: List[str],
+    operations: List[str],
+    sizes: List[int],
+    concurrencies: List[int],
+    populations: List[int],
+    requests: int,
+    workers: int,
+    settings: Optional[dict] = None,
+) -> Dict:
+    """
+    Runs every combination of the arguments and returns the results.
+
+    Each population gets a fresh image folder, which is shared by the
+    combinations that run on it.
+    """
+    results = []
+    for population in populations:
+        folder = tempfile.mkdtemp(prefix="anastasia-benchmark-")
+        try:
+            run_settings = {**BASE_SETTINGS, **(settings or {}), "folder": folder}
+            populate(run_settings, population)
+
+            for mode in modes:
+                if mode == "asgi":
+                    client_context = asgi_client(run_settings)
+                else:
+                    client_context = server_client(run_settings, workers)
+                async with client_context as client:
+                    for operation in operations:
+                        for size in sizes:
+                            for concurrency in concurrencies:
+                                result = await drive(
+                                    client, operation, payload(size), concurrency, requests
+                                )
+                                result.update(
+                                    {
+                                        "mode": mode,
+                                        "operation": operation,
+                                        "size": size,
+                                        "concurrency": concurrency,
+                                        "population": population,
+                                    }
+                                )
+                                print(
+                                    f"{mode:>6} {operation:>6} size={size:<9} "
+                                    f"concurrency={concurrency:<4} population={population:<8} "
+                                    f"{result['throughput']:9.1f} req/s "
+                                    f"p50={result['p50'] * 1000:8.2f}ms "
+                                    f"p99={result['p99'] * 1000:8.2f}ms "
+                                    f"errors={result['errors']}",
+                                    file=sys.stderr,
+                                )
+                                results.append(result)
+        finally:
+            rmtree(folder)
+
+    return {
+        "meta": {
+            "version": VERSION,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "requests": requests,
+            "workers": workers,
+            "settings": settings or {},
+        },
+        "results": results,
+    }
@@ -0,0 +1,112 @@
+"""
+Security headers middleware benchmark.
+
+Measures requests per second of GET /3/image/{image_hash} served by the
+v3.0 router without middleware, with the former `BaseHTTPMiddleware` based
+implementation and with `SecurityHeadersMiddleware`.
+
+Requests are fed straight into the ASGI application, so that numbers only
+account for the application and not for the HTTP server.
+
+usage: python -m benchmarks.security_headers [--requests N] [--rounds N]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from shutil import rmtree
+from typing import Callable
+
+from fastapi import FastAPI, Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from anastasia.middleware import SecurityHeadersMiddleware
+from anastasia.routers import v3_0
+
+
+async def legacy_headers(request: Request, call_next: Callable):
+    """The middleware `create_app` used to install via `@api.middleware("http")`"""
+    response = await call_next(request)
+    response.headers["X-Content-Type-Options"] = "nosniff"
+    response.headers["X-Frame-Options"] = "deny"
+    try:
+        if response.headers["content-type"] == "application/json":
+            response.headers["Content-Security-Policy"] = "default-src 'none'"
+    except KeyError:
+        pass
+    return response
+
+
+async def measure(app, path: str, requests: int) -> float:
+    """Returns requests per second of `requests` sequential GETs to `path`"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost")],
+        "server": ("localhost", 8080),
+        "client": ("127.0.0.1", 12345),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            assert message["status"] == 200, message
+
+    # Warm up
+    for _ in range(100):
+        await app(dict(scope), receive, send)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return requests / (time.perf_counter() - started)
+
+
+async def main(requests: int, rounds: int) -> None:
+    """Runs the benchmark and prints the results"""
+    folder = tempfile.mkdtemp()
+    try:
+        image_hash = "abcd1234.gif"
+        with open(os.path.join(os.path.dirname(__file__), "..", "tests", "image.gif"), "rb") as src:
+            with open(os.path.join(folder, image_hash), "wb") as dst:
+                dst.write(src.read())
+
+        variants = {}
+        variants["none"] = FastAPI()
+        variants["BaseHTTPMiddleware"] = FastAPI()
+        variants["BaseHTTPMiddleware"].add_middleware(BaseHTTPMiddleware, dispatch=legacy_headers)
+        variants["SecurityHeadersMiddleware"] = FastAPI()
+        variants["SecurityHeadersMiddleware"].add_middleware(SecurityHeadersMiddleware)
+        for app in variants.values():
+            app.include_router(v3_0.get_api(folder))
+
+        # Rounds are interleaved and the best one is kept to reduce noise
+        results = {name: 0.0 for name in variants}
+        for _ in range(rounds):
+            for name, app in variants.items():
+                rps = await measure(app, f"/3/image/{image_hash}", requests)
+                results[name] = max(results[name], rps)
+
+        for name, rps in results.items():
+            print(f"{name:>26}: {rps:8.0f} req/s")
+    finally:
+        rmtree(folder)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000, help="requests per round")
+    parser.add_argument("--rounds", type=int, default=5, help="number of rounds")
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments.requests, arguments.rounds))
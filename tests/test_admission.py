@@ -0,0 +1,41 @@
+import unittest
+from unittest.mock import patch
+
+from anastasia.admission import Lane, TokenBuckets
+
+
+class TestTokenBuckets(unittest.TestCase):
+    def test_take(self):
+        buckets = TokenBuckets(1, 2)
+        self.assertIsNone(buckets.take('10.0.0.1'))
+        self.assertIsNone(buckets.take('10.0.0.1'))
+        self.assertGreater(buckets.take('10.0.0.1'), 0)
+        self.assertIsNone(buckets.take('10.0.0.2'))
+
+    def test_forget(self):
+        buckets = TokenBuckets(1, 1)
+        with patch('anastasia.admission.MAX_CLIENTS', 2):
+            buckets.take('10.0.0.1')
+            buckets.take('10.0.0.2')
+            # Seen recently, so it is kept
+            self.assertIsNotNone(buckets.take('10.0.0.1'))
+            buckets.take('10.0.0.3')
+            self.assertEqual(len(buckets._buckets), 2)
+            # Forgotten, so it gets a full bucket
+            self.assertIsNone(buckets.take('10.0.0.2'))
+            self.assertIsNotNone(buckets.take('10.0.0.3'))
+
+
+class TestLane(unittest.IsolatedAsyncioTestCase):
+    async def test_acquire(self):
+        lane = Lane(1, 0, 0.01)
+        self.assertTrue(await lane.acquire())
+        self.assertFalse(await lane.acquire())
+        lane.release()
+        self.assertTrue(await lane.acquire())
+        lane.release()
+
+        # Unlimited
+        lane = Lane(0, 0, 0.01)
+        for _ in range(10):
+            self.assertTrue(await lane.acquire())
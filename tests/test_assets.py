@@ -0,0 +1,111 @@
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from httpx import AsyncClient, ASGITransport
+
+from anastasia import create_app
+from anastasia.assets import StaticAssets, accepted_encodings, brotli
+
+
+class TestAcceptedEncodings(unittest.TestCase):
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('gzip, deflate, br'), {'gzip', 'deflate', 'br'})
+        self.assertEqual(accepted_encodings('br;q=0, gzip;q=0.5'), {'gzip'})
+        self.assertEqual(accepted_encodings(''), {''})
+
+
+class TestStaticAssets(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.html = b'<html>' + b'anastasia ' * 200 + b'</html>'
+        with open(os.path.join(self.folder, 'index.html'), 'wb') as file:
+            file.write(self.html)
+        with open(os.path.join(self.folder, 'tiny.txt'), 'wb') as file:
+            file.write(b'a')
+        os.mkdir(os.path.join(self.folder, '.hidden'))
+        with open(os.path.join(self.folder, '.hidden', 'secret.txt'), 'wb') as file:
+            file.write(b'secret')
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_serve(self):
+        transport = ASGITransport(app=StaticAssets(self.folder))
+        async with AsyncClient(transport=transport, base_url='http://0.0.0.0:8080') as client:
+            # Uncompressed
+            response = await client.get('/', headers={'Accept-Encoding': 'identity'})
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, self.html)
+            self.assertNotIn('content-encoding', response.headers)
+            self.assertEqual(response.headers['content-type'], 'text/html; charset=utf-8')
+            self.assertEqual(response.headers['cache-control'], 'public, no-cache')
+            self.assertEqual(response.headers['vary'], 'accept-encoding')
+            etag = response.headers['etag']
+
+            # Compressed
+            response = await client.get('/index.html', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.headers['content-encoding'], 'gzip')
+            self.assertLess(int(response.headers['content-length']), len(self.html))
+            self.assertEqual(response.content, self.html)
+            self.assertNotEqual(response.headers['etag'], etag)
+            if brotli is not None:
+                response = await client.get('/', headers={'Accept-Encoding': 'gzip, br'})
+                self.assertEqual(response.headers['content-encoding'], 'br')
+
+            # Revalidated
+            response = await client.get(
+                '/', headers={'Accept-Encoding': 'identity', 'If-None-Match': etag}
+            )
+            self.assertEqual(response.status_code,  304)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response.headers['etag'], etag)
+
+            # Files that don't shrink are not compressed
+            response = await client.get('/tiny.txt', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code,  200)
+            self.assertNotIn('content-encoding', response.headers)
+
+            # HEAD
+            response = await client.head('/', headers={'Accept-Encoding': 'identity'})
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.headers['content-length'], str(len(self.html)))
+            self.assertEqual(response.content, b'')
+
+            response = await client.get('/.hidden/secret.txt')
+            self.assertEqual(response.status_code,  404)
+            response = await client.get('/missing.html')
+            self.assertEqual(response.status_code,  404)
+            response = await client.post('/')
+            self.assertEqual(response.status_code,  405)
+
+    async def test_webapp(self):
+        settings = {
+            'folder': self.folder,
+            'contact_name': 'Average Joe',
+            'contact_url': 'http://0.0.0.0:8080/',
+            'contact_email': 'averagejoe@example.com',
+            'enable_gui': True,
+            'gui_cache_max_age': 300,
+            'baseurl': 'http://0.0.0.0:8080/'
+        }
+        app = create_app(settings=settings)
+        path = os.path.join(
+            os.path.dirname(__file__), '..', 'anastasia', 'templates', 'regular', 'index.html'
+        )
+        with open(path, 'rb') as file:
+            html = file.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url='http://0.0.0.0:8080') as client:
+            response = await client.get('/', headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.headers['cache-control'], 'public, max-age=300')
+            self.assertEqual(response.headers['content-encoding'], 'gzip')
+            self.assertEqual(response.content, html)
+
+            # The API is still there
+            response = await client.get('/api/3/image/missing.gif')
+            self.assertEqual(response.status_code,  404)
@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+from shutil import rmtree
+
+from anastasia.bloom import BloomFilter, dimensions
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.bloom = BloomFilter(self.folder, capacity=1000, error_rate=0.01)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    def test_dimensions(self):
+        bits, hashes = dimensions(1000, 0.01)
+        self.assertEqual(bits, 9592)
+        self.assertEqual(hashes, 7)
+
+    def test_lookup(self):
+        # Everything might exist until the filter is built
+        self.assertIn('missing.png', self.bloom)
+        self.assertTrue(self.bloom.needs_rebuild())
+        self.assertIsNone(self.bloom.stats())
+
+        self.assertTrue(self.bloom.rebuild(f'{number}.png' for number in range(500)))
+        self.assertFalse(self.bloom.needs_rebuild())
+        for number in range(500):
+            self.assertIn(f'{number}.png', self.bloom)
+        false_positives = sum(f'{number}.gif' in self.bloom for number in range(10000))
+        self.assertLess(false_positives, 100)
+
+        stats = self.bloom.stats()
+        self.assertEqual(stats['bytes'], 1199)
+        self.assertEqual(stats['added'], 500)
+        self.assertLess(stats['false_positive_rate'], 0.01)
+
+    def test_workers(self):
+        self.bloom.rebuild([])
+        other = BloomFilter(self.folder, capacity=1000, error_rate=0.01)
+
+        # Uploads are seen by every worker
+        self.bloom.add('first.png')
+        self.assertIn('first.png', other)
+        self.assertNotIn('second.png', other)
+
+        # Deletes only count until the filter is rebuilt
+        other.discard('first.png')
+        self.assertEqual(self.bloom.stats()['deleted'], 1)
+        self.assertIn('first.png', self.bloom)
+
+        # Other workers switch to the rebuilt filter
+        other.rebuild(['second.png'])
+        self.assertIn('second.png', self.bloom)
+        self.assertNotIn('first.png', self.bloom)
+        self.assertEqual(self.bloom.stats()['deleted'], 0)
+
+    def test_crowded(self):
+        self.bloom.rebuild([])
+        for number in range(1500):
+            self.bloom.add(f'{number}.png')
+        self.assertTrue(self.bloom.needs_rebuild())
+
+        # Sized for the images alive in the crowded filter
+        self.bloom.rebuild(f'{number}.png' for number in range(1500))
+        self.assertFalse(self.bloom.needs_rebuild())
+        self.assertEqual(self.bloom.stats()['bytes'], dimensions(3000, 0.01)[0] // 8)
+
+    def test_rebuild_race(self):
+        self.bloom.rebuild([])
+
+        # Added before being stored, then missed by a rebuild that listed
+        # the images before it was stored
+        self.bloom.add('late.png')
+        other = BloomFilter(self.folder, capacity=1000, error_rate=0.01)
+        other.rebuild([])
+        self.assertNotIn('late.png', self.bloom)
+
+        # Added again once stored, without being counted twice
+        self.bloom.add('late.png', again=True)
+        self.assertIn('late.png', self.bloom)
+        self.assertEqual(self.bloom.stats()['added'], 0)
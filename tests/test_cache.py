@@ -0,0 +1,32 @@
+import unittest
+
+from anastasia.cache import ImageCache
+
+
+class TestImageCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = ImageCache(max_bytes=10, max_item_bytes=6)
+
+        cache.put('a', b'aaaa', 'image/png', 'a', 0)
+        cache.put('b', b'bbbb', 'image/png', 'b', 0)
+        # Too large
+        cache.put('c', b'ccccccc', 'image/png', 'c', 0)
+        self.assertIsNone(cache.get('c'))
+
+        # 'a' becomes the most recently used, so 'b' gets evicted
+        self.assertEqual(cache.get('a').content, b'aaaa')
+        cache.put('d', b'dddd', 'image/png', 'd', 0)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('d'))
+
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 2, 'misses': 3, 'evictions': 1, 'items': 1, 'bytes': 4}
+        )
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,246 @@
+import unittest
+import os
+import subprocess
+import sys
+import tempfile
+from shutil import rmtree
+from unittest.mock import patch
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import HTMLResponse
+from httpx import AsyncClient, ASGITransport
+
+from anastasia.cluster import Cluster, HashRing, rebalance
+from anastasia.routers import v3_0
+from anastasia.storage import FileSystemStorage
+from anastasia.uploads import UploadSessions
+
+NODES = ['http://node-a', 'http://node-b', 'http://node-c']
+
+
+class NodesTransport(httpx.AsyncBaseTransport):
+    """Sends requests to the app of the node they are addressed to"""
+    def __init__(self):
+        self.apps = {}
+
+    async def handle_async_request(self, request):
+        node = f'{request.url.scheme}://{request.url.host}'
+        return await ASGITransport(app=self.apps[node]).handle_async_request(request)
+
+
+class TestHashRing(unittest.TestCase):
+    def test_owner(self):
+        keys = [f'{number:08d}.png' for number in range(10000)]
+        ring = HashRing(NODES[:2])
+        owners = {key: ring.owner(key) for key in keys}
+        for node in NODES[:2]:
+            self.assertGreater(list(owners.values()).count(node), 4000)
+
+        # Only the keys taken over by the new node move
+        ring = HashRing(NODES)
+        moved = [key for key in keys if ring.owner(key) != owners[key]]
+        self.assertTrue(all(ring.owner(key) == NODES[2] for key in moved))
+        self.assertLess(abs(len(moved) - len(keys) / 3), len(keys) / 10)
+
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+
+class TestWithoutHttpx(unittest.TestCase):
+    def test_import(self):
+        # httpx is only needed by cluster mode
+        script = (
+            "import sys\n"
+            "sys.modules['httpx'] = None\n"
+            "import anastasia\n"
+            "from anastasia.cluster import Cluster\n"
+            "from anastasia.settings import Settings\n"
+            "try:\n"
+            "    Cluster('http://a', ['http://a'])\n"
+            "except RuntimeError:\n"
+            "    pass\n"
+            "else:\n"
+            "    sys.exit(1)\n"
+            "try:\n"
+            "    Settings(folder='.', contact_name='a', contact_url='http://a/',\n"
+            "             contact_email='a@example.com', cluster_nodes=['http://a'])\n"
+            "except ValueError:\n"
+            "    pass\n"
+            "else:\n"
+            "    sys.exit(1)\n"
+        )
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, check=False)
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+
+
+class TestClusterWebApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.transport = NodesTransport()
+        self.folders = {node: tempfile.mkdtemp() for node in NODES}
+
+    async def asyncTearDown(self):
+        for folder in self.folders.values():
+            rmtree(folder)
+
+    def start(self, node, nodes, previous_nodes=(), redirect=False):
+        cluster = Cluster(
+            node, nodes, previous_nodes, redirect, transport=self.transport, secret='secret'
+        )
+        api = FastAPI()
+        api.include_router(v3_0.get_api(
+            self.folders[node], f'{node}/api/', cluster=cluster,
+            uploads=UploadSessions(self.folders[node], 60),
+        ))
+        app = FastAPI()
+        app.mount('/api', api)
+        self.transport.apps[node] = app
+        return cluster
+
+    def client(self, node):
+        return AsyncClient(transport=self.transport, base_url=f'{node}/api/3')
+
+    def stored(self, node):
+        return sorted(os.listdir(self.folders[node]))
+
+    async def upload(self, node, count):
+        hashes = []
+        async with self.client(node) as client:
+            for _ in range(count):
+                response = await client.post(
+                    '/upload', files={'image': ('image.gif', b'GIF89a' + os.urandom(100))}
+                )
+                hashes.append(response.json()['data']['deletehash'])
+        return hashes
+
+    async def test_routing(self):
+        for node in NODES[:2]:
+            cluster = self.start(node, NODES[:2])
+
+        # Uploads are placed on the node that receives them
+        hashes = await self.upload(NODES[0], 10)
+        self.assertTrue(all(cluster.owner(image_hash) == NODES[0] for image_hash in hashes))
+        self.assertTrue(set(hashes) <= set(self.stored(NODES[0])))
+
+        async with self.client(NODES[1]) as client:
+            with open(os.path.join(self.folders[NODES[0]], hashes[0]), 'rb') as image:
+                content = image.read()
+            response = await client.get(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, content)
+            response = await client.get(f'/image/{hashes[0]}', headers={'Range': 'bytes=0-5'})
+            self.assertEqual(response.status_code,  206)
+            self.assertEqual(response.content, b'GIF89a')
+            response = await client.head(f'/image/{hashes[0]}')
+            self.assertEqual(response.headers['content-length'], str(len(content)))
+
+            response = await client.delete(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  204)
+            self.assertNotIn(hashes[0], self.stored(NODES[0]))
+            response = await client.get(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  404)
+
+            response = await client.post(
+                '/delete/batch', json={'hashes': hashes[1:3] + [hashes[0]]}
+            )
+            self.assertEqual([item['status'] for item in response.json()['data']], [204, 204, 404])
+
+            # Upload sessions live on the node that created them
+            response = await client.post('/uploads', headers={'Upload-Length': '8'})
+            session_id = response.json()['data']['id']
+        async with self.client(NODES[0]) as client:
+            response = await client.patch(
+                f'/uploads/{session_id}', content=b'GIF89a!!',
+                headers={'Content-Type': 'application/offset+octet-stream', 'Upload-Offset': '0'}
+            )
+            self.assertEqual(response.headers['upload-offset'], '8')
+            response = await client.post(f'/uploads/{session_id}/finalize')
+            self.assertEqual(response.status_code,  200)
+            self.assertIn(response.json()['data']['deletehash'], self.stored(NODES[1]))
+
+        self.start(NODES[1], NODES[:2], redirect=True)
+        async with self.client(NODES[1]) as client:
+            response = await client.get(f'/image/{hashes[5]}', params={'size': 'b'})
+            self.assertEqual(response.status_code,  307)
+            self.assertEqual(
+                response.headers['location'], f'{NODES[0]}/api/3/image/{hashes[5]}?size=b'
+            )
+
+    async def test_peer_error(self):
+        cluster = self.start(NODES[0], NODES[:2])
+        hashes = await self.upload(NODES[0], 2)
+        remote = next(
+            f'{number:08d}.gif' for number in range(1000)
+            if cluster.owner(f'{number:08d}.gif') == NODES[1]
+        )
+
+        # A proxy in front of the other node answers with HTML
+        async def bad_gateway(scope, receive, send):
+            response = HTMLResponse('<html>Bad Gateway</html>', status_code=502)
+            await response(scope, receive, send)
+
+        self.transport.apps[NODES[1]] = bad_gateway
+        async with self.client(NODES[0]) as client:
+            response = await client.post(
+                '/delete/batch', json={'hashes': [hashes[0], remote, hashes[1]]}
+            )
+            self.assertEqual(response.status_code,  200)
+            items = response.json()['data']
+            self.assertEqual([item['status'] for item in items], [204, 502, 204])
+            self.assertEqual(items[1]['error'], 'Bad Gateway')
+
+    async def test_rebalance(self):
+        self.start(NODES[0], NODES[:1])
+        hashes = await self.upload(NODES[0], 30)
+
+        # Node added, images are looked up on their previous owner meanwhile
+        for node in NODES[:2]:
+            cluster = self.start(node, NODES[:2], NODES[:1])
+        moving = [image_hash for image_hash in hashes if cluster.owner(image_hash) == NODES[1]]
+        self.assertTrue(moving)
+        async with self.client(NODES[1]) as client:
+            response = await client.get(f'/image/{moving[0]}')
+            self.assertEqual(response.status_code,  200)
+
+        cluster = Cluster(NODES[0], NODES[:2], transport=self.transport, secret='secret')
+        storage = FileSystemStorage(self.folders[NODES[0]])
+        stat = storage.stat
+
+        async def failing_stat(image_hash):
+            if image_hash == moving[0]:
+                raise OSError('Disk error')
+            return await stat(image_hash)
+
+        # Images are streamed, not read in full. Failures don't stop the others
+        with patch.object(storage, 'read', side_effect=AssertionError), \
+                patch.object(storage, 'stat', side_effect=failing_stat):
+            self.assertEqual(
+                await rebalance(cluster, storage, workers=2),
+                (len(moving) - 1, {moving[0]: 'Disk error'})
+            )
+        self.assertEqual(await rebalance(cluster, storage), (1, {}))
+        self.assertEqual(await rebalance(cluster, storage), (0, {}))
+        await cluster.close()
+
+        self.assertEqual(
+            [image_hash for image_hash in self.stored(NODES[1]) if not image_hash.startswith('.')],
+            sorted(moving)
+        )
+        self.assertTrue(set(hashes) - set(moving) <= set(self.stored(NODES[0])))
+        async with self.client(NODES[0]) as client:
+            for image_hash in hashes:
+                response = await client.get(f'/image/{image_hash}')
+                self.assertEqual(response.status_code,  200)
+            # Only nodes of the cluster choose names
+            response = await client.put(
+                '/image/chosen.gif', files={'image': ('image.gif', b'GIF89a')},
+                headers={'X-Anastasia-Forwarded': NODES[1], 'X-Anastasia-Secret': 'guess'}
+            )
+            self.assertEqual(response.status_code,  403)
+
+            # Names must belong to the node they are put on
+            response = await client.put(
+                f'/image/{moving[0]}', files={'image': ('image.gif', b'GIF89a')},
+                headers={'X-Anastasia-Forwarded': NODES[1], 'X-Anastasia-Secret': 'secret'}
+            )
+            self.assertEqual(response.status_code,  421)
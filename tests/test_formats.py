@@ -0,0 +1,65 @@
+import unittest
+import struct
+
+from anastasia.formats import (
+    AVIF, GIF, JPEG, MP4, PNG, WEBP, dimensions, negotiate, sniff
+)
+
+PNG_HEAD = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', 640, 480)
+JPEG_HEAD = (
+    b'\xff\xd8'
+    + b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+    + b'\xff\xc0' + struct.pack('>HBHH', 17, 8, 480, 640)
+)
+GIF_HEAD = b'GIF89a' + struct.pack('<HH', 640, 480)
+AVIF_HEAD = (
+    struct.pack('>I', 28) + b'ftypavif\x00\x00\x00\x00avifmif1miaf'
+    + struct.pack('>I', 20) + b'ispe\x00\x00\x00\x00' + struct.pack('>II', 640, 480)
+)
+MP4_HEAD = struct.pack('>I', 24) + b'ftypisom\x00\x00\x02\x00isomiso2'
+
+
+def webp(chunk, payload):
+    return b'RIFF\x00\x00\x00\x00WEBP' + chunk + b'\x00\x00\x00\x00' + payload
+
+
+class TestFormats(unittest.TestCase):
+    def test_sniff(self):
+        self.assertIs(sniff(PNG_HEAD), PNG)
+        self.assertIs(sniff(JPEG_HEAD), JPEG)
+        self.assertIs(sniff(GIF_HEAD), GIF)
+        self.assertIs(sniff(webp(b'VP8 ', b'')), WEBP)
+        self.assertIs(sniff(AVIF_HEAD), AVIF)
+        self.assertIs(sniff(MP4_HEAD), MP4)
+        self.assertIsNone(sniff(b'<html><body>GIF89a</body></html>'))
+        self.assertIsNone(sniff(b''))
+
+    def test_dimensions(self):
+        self.assertEqual(dimensions(PNG_HEAD, PNG), (640, 480))
+        self.assertEqual(dimensions(JPEG_HEAD, JPEG), (640, 480))
+        self.assertEqual(dimensions(GIF_HEAD, GIF), (640, 480))
+        self.assertEqual(dimensions(AVIF_HEAD, AVIF), (640, 480))
+        self.assertEqual(
+            dimensions(webp(b'VP8 ', b'\x00\x00\x00\x9d\x01\x2a' + struct.pack('<HH', 640, 480)),
+                       WEBP),
+            (640, 480)
+        )
+        self.assertEqual(
+            dimensions(webp(b'VP8L', b'\x2f' + struct.pack('<I', 639 | 479 << 14)), WEBP),
+            (640, 480)
+        )
+        size = (639).to_bytes(3, 'little') + (479).to_bytes(3, 'little')
+        self.assertEqual(dimensions(webp(b'VP8X', b'\x00' * 4 + size), WEBP), (640, 480))
+
+        # Not within the inspected bytes
+        self.assertIsNone(dimensions(b'GIF89a', GIF))
+        self.assertIsNone(dimensions(JPEG_HEAD[:24], JPEG))
+        self.assertIsNone(dimensions(MP4_HEAD, MP4))
+
+    def test_negotiate(self):
+        chrome = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+        self.assertIs(negotiate(chrome, [AVIF, WEBP]), AVIF)
+        self.assertIs(negotiate(chrome, [WEBP, AVIF]), WEBP)
+        self.assertIs(negotiate('image/avif;q=0, image/webp', [AVIF, WEBP]), WEBP)
+        self.assertIsNone(negotiate('image/*,*/*;q=0.8', [AVIF, WEBP]))
+        self.assertIsNone(negotiate('', [AVIF, WEBP]))
@@ -0,0 +1,137 @@
+import unittest
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree
+from unittest.mock import patch
+
+from anastasia.index import INDEX_FILENAME, ImageIndex, ImageRecord
+from anastasia.storage import FileSystemStorage
+
+
+async def chunks(data):
+    yield data
+
+
+class TestImageIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.index = ImageIndex(os.path.join(self.folder, INDEX_FILENAME))
+
+    def tearDown(self):
+        self.index.close()
+        rmtree(self.folder)
+
+    async def test_records(self):
+        record = ImageRecord('abcd1234.png', 4, 'image/png', 'checksum', 1.0, 'abcd1234.png')
+        await self.index.add(record)
+        self.assertEqual(await self.index.get('abcd1234.png'), record)
+
+        self.assertEqual(await self.index.remove('abcd1234.png'), record)
+        self.assertIsNone(await self.index.get('abcd1234.png'))
+        self.assertIsNone(await self.index.remove('abcd1234.png'))
+
+    def test_concurrent_remove(self):
+        record = ImageRecord('abcd1234.png', 4, 'image/png', 'checksum', 1.0, 'abcd1234.png')
+        for _ in range(20):
+            self.index._add([record])
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                removed = list(executor.map(self.index._remove, [record.image_hash] * 4))
+            # Only one of the removals gets the record
+            self.assertEqual([r for r in removed if r is not None], [record])
+
+    async def test_list_and_stats(self):
+        for number in range(5):
+            await self.index.add(
+                ImageRecord(f'image{number}.png', 10, 'image/png', 'checksum', number, '')
+            )
+        await self.index.add(ImageRecord('image.gif', 5, 'image/gif', 'checksum', 0, ''))
+        # Replacing a record updates the stats
+        await self.index.add(ImageRecord('image.gif', 7, 'image/gif', 'checksum', 0, ''))
+        await self.index.remove('image4.png')
+
+        records = await self.index.list(limit=2)
+        self.assertEqual([record.image_hash for record in records], ['image3.png', 'image2.png'])
+        records = await self.index.list((records[-1].created, records[-1].image_hash), limit=5)
+        self.assertEqual(
+            [record.image_hash for record in records], ['image1.png', 'image0.png', 'image.gif']
+        )
+
+        self.assertEqual(
+            await self.index.stats(), {'image/gif': (1, 7), 'image/png': (4, 40)}
+        )
+
+    async def test_expiry(self):
+        now = time.time()
+        expired = ImageRecord('expired.png', 4, 'image/png', 'checksum', 1.0, '', expires=now - 1)
+        later = ImageRecord('later.png', 4, 'image/png', 'checksum', 2.0, '', expires=now + 60)
+        kept = ImageRecord('kept.png', 4, 'image/png', 'checksum', 3.0, '')
+        for record in (expired, later, kept):
+            await self.index.add(record)
+
+        # Expired images are gone before they are removed
+        self.assertIsNone(await self.index.get('expired.png'))
+        self.assertTrue(await self.index.expired('expired.png'))
+        self.assertFalse(await self.index.expired('later.png'))
+        self.assertFalse(await self.index.expired('kept.png'))
+        self.assertEqual(await self.index.get('later.png'), later)
+        self.assertEqual(
+            [record.image_hash for record in await self.index.list()], ['kept.png', 'later.png']
+        )
+        self.assertEqual(await self.index.due(), [expired])
+
+        # Rebuilds keep expiry times
+        await self.index.add(ImageRecord('later.png', 4, 'image/png', 'checksum', 2.0, ''))
+        self.assertEqual((await self.index.get('later.png')).expires, later.expires)
+
+    async def test_upgrade(self):
+        self.index.close()
+        path = os.path.join(self.folder, 'old.sqlite3')
+        connection = sqlite3.connect(path)
+        connection.execute(
+            'CREATE TABLE images (hash TEXT PRIMARY KEY, size INTEGER NOT NULL,'
+            ' media_type TEXT NOT NULL, checksum TEXT NOT NULL, created REAL NOT NULL,'
+            ' path TEXT NOT NULL)'
+        )
+        connection.execute("INSERT INTO images VALUES ('old.png', 4, 'image/png', 'c', 1.0, '')")
+        connection.commit()
+        connection.close()
+
+        self.index = ImageIndex(path)
+        self.assertIsNone((await self.index.get('old.png')).expires)
+        self.assertEqual(await self.index.stats(), {'image/png': (1, 4)})
+
+    async def test_rebuild(self):
+        storage = FileSystemStorage(self.folder, shard_depth=1)
+        saved = await storage.save('abcd1234.png', chunks(b'data'))
+        await FileSystemStorage(self.folder).save('efgh5678.gif', chunks(b'data'))
+        # Indexed already, with an outdated checksum
+        await self.index.add(
+            ImageRecord('abcd1234.png', 4, 'image/png', 'checksum', 2.0, 'abcd1234.png')
+        )
+        # Stale record
+        await self.index.add(
+            ImageRecord('ijkl9012.png', 4, 'image/png', 'checksum', 1.0, 'ijkl9012.png')
+        )
+
+        # Images are described one batch at a time
+        with patch('anastasia.index.REBUILD_BATCH_SIZE', 1):
+            self.assertEqual(self.index.rebuild(storage), 2)
+
+        record = await self.index.get('abcd1234.png')
+        self.assertEqual(record.path, os.path.join('ab', 'abcd1234.png'))
+        self.assertEqual(record.checksum, saved.checksum)
+        self.assertEqual(record.size, 4)
+        # Upload times are not replaced with modification times
+        self.assertEqual(record.created, 2.0)
+        record = await self.index.get('efgh5678.gif')
+        self.assertEqual(record.media_type, 'image/gif')
+        mtime = os.stat(os.path.join(self.folder, 'efgh5678.gif')).st_mtime
+        self.assertEqual(record.created, mtime)
+        self.assertIsNone(await self.index.get('ijkl9012.png'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
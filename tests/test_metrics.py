@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from anastasia.metrics import Metrics
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_workers(self):
+        metrics = Metrics(self.folder)
+        metrics.observe_request('/3/image/{image_hash}', 'GET', 200, 0.002)
+        metrics.served_bytes += 10
+
+        # Snapshot of another worker
+        other = Metrics()
+        other.observe_request('/3/image/{image_hash}', 'GET', 200, 0.2)
+        other.served_bytes += 5
+        with open(os.path.join(self.folder, '1.json'), 'w') as file:
+            json.dump(other.snapshot(), file)
+
+        # Snapshot of a worker that is gone
+        gone = os.path.join(self.folder, '2.json')
+        with open(gone, 'w') as file:
+            json.dump(other.snapshot(), file)
+        os.utime(gone, (0, 0))
+
+        text = await metrics.render()
+        labels = 'route="/3/image/{image_hash}",method="GET",status="200"'
+        self.assertIn(f'anastasia_request_duration_seconds_bucket{{{labels},le="0.0025"}} 1', text)
+        self.assertIn(f'anastasia_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'anastasia_request_duration_seconds_count{{{labels}}} 2', text)
+        self.assertIn('anastasia_served_bytes_total 15', text)
+        self.assertIn('anastasia_workers 2', text)
+
+        await metrics.flush()
+        self.assertIn(f'{os.getpid()}.json', os.listdir(self.folder))
+        metrics.discard()
+        self.assertNotIn(f'{os.getpid()}.json', os.listdir(self.folder))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,71 @@
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from anastasia.packs import PackStorage
+
+
+async def chunks(data):
+    yield data[:3]
+    yield data[3:]
+
+
+def segments(folder):
+    return sorted(name for name in os.listdir(folder) if name.endswith('.pack'))
+
+
+class TestPackStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.storage = PackStorage(self.folder, segment_bytes=100)
+
+    def tearDown(self):
+        self.storage.close()
+        rmtree(self.folder)
+
+    async def read(self, image_hash):
+        return await self.storage.read(await self.storage.stat(image_hash))
+
+    async def test_save_and_delete(self):
+        first = await self.storage.save('first.png', chunks(b'a' * 60))
+        await self.storage.save('second.png', chunks(b'b' * 30))
+        self.assertEqual(first.size, 60)
+        self.assertEqual(first.path, os.path.join('.packs', 'segment-000001.pack'))
+        self.assertEqual(await self.read('first.png'), b'a' * 60)
+        self.assertEqual(await self.read('second.png'), b'b' * 30)
+
+        # Doesn't fit within the first segment
+        saved = await self.storage.save('third.png', chunks(b'c' * 30))
+        self.assertEqual(saved.path, os.path.join('.packs', 'segment-000002.pack'))
+        self.assertEqual(len(segments(self.storage.root)), 2)
+
+        await self.storage.delete('first.png')
+        self.assertIsNone(await self.storage.get('first.png'))
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.delete('first.png')
+
+        self.assertEqual(
+            sorted(image_hash for image_hash, _ in self.storage.iter_images()),
+            ['second.png', 'third.png']
+        )
+
+    async def test_compact(self):
+        await self.storage.save('first.png', chunks(b'a' * 60))
+        await self.storage.save('second.png', chunks(b'b' * 30))
+        await self.storage.save('third.png', chunks(b'c' * 30))
+        await self.storage.delete('first.png')
+
+        self.assertEqual(self.storage.compact(), 60)
+        self.assertEqual(await self.read('second.png'), b'b' * 30)
+        self.assertEqual((await self.storage.get('second.png')).path, self.storage.segment_path(2))
+
+        # The retired segment is removed by the next run
+        self.assertEqual(len(segments(self.storage.root)), 2)
+        self.assertEqual(self.storage.compact(), 0)
+        self.assertEqual(segments(self.storage.root), ['segment-000002.pack'])
+        self.assertEqual(await self.read('third.png'), b'c' * 30)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
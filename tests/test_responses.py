@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+
+from anastasia.responses import (
+    BaseImageResponse, ImageResponse, RangeNotSatisfiable, parse_range
+)
+
+
+class TestImageResponse(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.data = os.urandom(1000)
+        file_descriptor, self.path = tempfile.mkstemp()
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(self.data)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    async def call(self, extensions, headers=()):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+            'asgi': {'spec_version': '2.4'},
+            'extensions': extensions,
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        response = ImageResponse(self.path, len(self.data), 0, 'abc', 60, 'image/gif')
+        await response(scope, receive, send)
+        return messages
+
+    def test_abstract(self):
+        class IncompleteResponse(BaseImageResponse):
+            pass
+
+        # Fails upfront rather than while the response is being sent
+        with self.assertRaises(TypeError):
+            IncompleteResponse(b'GIF89a', 6, 'image/gif', 'abc', 0, 60)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), [(0, 10)])
+        self.assertEqual(parse_range('bytes=90-', 100), [(90, 100)])
+        self.assertEqual(parse_range('bytes=-10', 100), [(90, 100)])
+        self.assertEqual(parse_range('bytes=50-200', 100), [(50, 100)])
+        # Overlapping and adjacent ranges are merged
+        self.assertEqual(parse_range('bytes=20-29,0-9,10-14,25-40', 100), [(0, 15), (20, 41)])
+        # Invalid headers are ignored
+        self.assertIsNone(parse_range('items=0-9', 100))
+        self.assertIsNone(parse_range('bytes=9-0', 100))
+        self.assertIsNone(parse_range('bytes=a-b', 100))
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range('bytes=100-', 100)
+
+    async def test_zerocopysend(self):
+        messages = await self.call(
+            {'http.response.zerocopysend': {}}, [('range', 'bytes=10-19,100-')]
+        )
+        self.assertEqual(messages[0]['status'], 206)
+        sendfile = [m for m in messages if m['type'] == 'http.response.zerocopysend']
+        self.assertEqual(
+            [(m['offset'], m['count']) for m in sendfile], [(10, 10), (100, 900)]
+        )
+        self.assertFalse(messages[-1]['more_body'])
+
+    async def test_pathsend(self):
+        messages = await self.call({'http.response.pathsend': {}})
+        self.assertEqual(messages[1], {'type': 'http.response.pathsend', 'path': self.path})
+
+        # Ranges can't be sent by path
+        messages = await self.call({'http.response.pathsend': {}}, [('range', 'bytes=1-2')])
+        body = b''.join(m['body'] for m in messages[1:])
+        self.assertEqual(body, self.data[1:3])
+
+    async def test_mmap(self):
+        messages = await self.call({})
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertEqual(b''.join(m['body'] for m in messages[1:]), self.data)
+        self.assertFalse(messages[-1]['more_body'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,153 @@
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from httpx import AsyncClient, ASGITransport
+
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+from anastasia import create_app
+from anastasia.s3 import MIN_PART_SIZE, S3Storage
+
+
+async def chunks(data, size=1024 * 1024):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def join(stream):
+    return b''.join([chunk async for chunk in stream])
+
+
+@unittest.skipIf(mock_aws is None, 'boto3 and moto are required')
+class TestS3Storage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='images')
+        self.storage = S3Storage(
+            'images', prefix='img/', region='us-east-1', part_size=MIN_PART_SIZE
+        )
+
+    def tearDown(self):
+        self.storage.close()
+        self.mock.stop()
+
+    async def test_save_and_stream(self):
+        saved = await self.storage.save('small.gif', chunks(b'GIF89a' + b'a' * 100))
+        self.assertEqual(saved.size, 106)
+        self.assertEqual(saved.path, 'img/small.gif')
+
+        record = await self.storage.stat('small.gif')
+        self.assertEqual(record.size, 106)
+        self.assertEqual(record.media_type, 'image/gif')
+        self.assertEqual(record.checksum, saved.checksum)
+        self.assertEqual(await self.storage.read(record), b'GIF89a' + b'a' * 100)
+        self.assertEqual(await join(self.storage.stream(record, 3, 8)), b'89aaa')
+        self.assertIsNone(await self.storage.stat('missing.gif'))
+
+    async def test_multipart(self):
+        data = bytes(range(256)) * (MIN_PART_SIZE // 128)
+        saved = await self.storage.save('large.png', chunks(data))
+        self.assertEqual(saved.size, len(data))
+        self.assertTrue(saved.checksum.endswith('-2'))
+
+        record = await self.storage.stat('large.png')
+        self.assertEqual(record.checksum, saved.checksum)
+        self.assertEqual(await self.storage.read(record), data)
+
+        images = dict(self.storage.iter_images())
+        self.assertEqual(list(images), ['large.png'])
+        self.assertEqual(images['large.png'].size, len(data))
+
+    async def test_delete(self):
+        await self.storage.save('small.gif', chunks(b'GIF89a'))
+        record = await self.storage.stat('small.gif')
+        await self.storage.delete('small.gif')
+        self.assertFalse(await self.storage.exists('small.gif'))
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.delete('small.gif')
+        with self.assertRaises(FileNotFoundError):
+            await self.storage.read(record)
+
+
+@unittest.skipIf(mock_aws is None, 'boto3 and moto are required')
+class TestS3WebApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='images')
+        self.folder = tempfile.mkdtemp()
+        self.app = create_app(settings={
+            "folder": self.folder,
+            "contact_name": "Average Joe",
+            "contact_url": "http://0.0.0.0:8080/",
+            "contact_email": "averagejoe@example.com",
+            "baseurl": "http://0.0.0.0:8080/",
+            "storage": "s3",
+            "s3_bucket": "images",
+            "s3_region": "us-east-1",
+            "enable_index": True,
+        })
+
+    def tearDown(self):
+        rmtree(self.folder)
+        self.mock.stop()
+
+    async def test_image_methods(self):
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            image_hash = response.json()['data']['deletehash']
+            self.assertNotIn(image_hash, os.listdir(self.folder))
+
+            response = await client.get(f'/image/{image_hash}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, data)
+            response = await client.get(f'/image/{image_hash}', headers={'Range': 'bytes=2-5'})
+            self.assertEqual(response.status_code,  206)
+            self.assertEqual(response.content, data[2:6])
+
+            response = await client.delete(f'/image/{image_hash}')
+            self.assertEqual(response.status_code,  204)
+            response = await client.get(f'/image/{image_hash}')
+            self.assertEqual(response.status_code,  404)
+
+    async def test_missing_bucket(self):
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+        app = create_app(settings={
+            "folder": self.folder,
+            "contact_name": "Average Joe",
+            "contact_url": "http://0.0.0.0:8080/",
+            "contact_email": "averagejoe@example.com",
+            "baseurl": "http://0.0.0.0:8080/",
+            "storage": "s3",
+            "s3_bucket": "missing",
+            "s3_region": "us-east-1",
+        })
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  503)
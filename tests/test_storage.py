@@ -0,0 +1,69 @@
+import unittest
+import os
+import tempfile
+from shutil import rmtree
+
+from anastasia.storage import FileSystemStorage
+
+
+async def chunks(data):
+    yield data
+
+
+class TestFileSystemStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_sharded_layout(self):
+        storage = FileSystemStorage(self.folder, shard_depth=2)
+        self.assertEqual(
+            storage.path('abcd1234.png'),
+            os.path.join(self.folder, 'ab', 'cd', 'abcd1234.png')
+        )
+        # Too short to be sharded
+        self.assertEqual(storage.path('abc.png'), os.path.join(self.folder, 'abc.png'))
+
+        saved = await storage.save('abcd1234.png', chunks(b'data'))
+        self.assertEqual(saved.size, 4)
+        self.assertEqual(storage.locate('abcd1234.png'), storage.path('abcd1234.png'))
+
+        await storage.delete('abcd1234.png')
+        self.assertIsNone(storage.locate('abcd1234.png'))
+        with self.assertRaises(FileNotFoundError):
+            await storage.delete('abcd1234.png')
+
+    async def test_migrate(self):
+        await FileSystemStorage(self.folder).save('abcd1234.png', chunks(b'data'))
+        await FileSystemStorage(self.folder).save('efgh5678.png', chunks(b'data'))
+
+        storage = FileSystemStorage(self.folder, shard_depth=2)
+        # Flat files are served before and after the migration
+        self.assertEqual(
+            storage.locate('abcd1234.png'), os.path.join(self.folder, 'abcd1234.png')
+        )
+        self.assertEqual(storage.migrate(), 2)
+        self.assertEqual(storage.locate('abcd1234.png'), storage.path('abcd1234.png'))
+        self.assertEqual(storage.locate('efgh5678.png'), storage.path('efgh5678.png'))
+        self.assertEqual(storage.migrate(), 0)
+
+    async def test_deduplicate(self):
+        storage = FileSystemStorage(self.folder, deduplicate=True)
+        first = await storage.save('abcd1234.png', chunks(b'data'))
+        second = await storage.save('efgh5678.png', chunks(b'data'))
+        self.assertEqual(first[:3], second[:3])
+
+        blob_path = storage.blob_path(first.checksum)
+        self.assertEqual(os.stat(blob_path).st_nlink, 3)
+        self.assertTrue(os.path.samefile(blob_path, storage.locate('efgh5678.png')))
+
+        await storage.delete('abcd1234.png')
+        self.assertEqual(os.stat(blob_path).st_nlink, 2)
+        await storage.delete('efgh5678.png')
+        self.assertFalse(os.path.exists(blob_path))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
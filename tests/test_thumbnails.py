@@ -0,0 +1,284 @@
+import unittest
+import asyncio
+import io
+import os
+import tempfile
+import time
+from shutil import rmtree
+from unittest.mock import patch
+
+from httpx import AsyncClient, ASGITransport
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from anastasia import create_app
+from anastasia.formats import AVIF, JPEG, PNG, WEBP
+from anastasia.thumbnails import ThumbnailCache, ThumbnailError, encodable, render
+
+
+def thumbnail_folders(folder):
+    return sorted(
+        name for name in os.listdir(os.path.join(folder, '.thumbnails'))
+        if not name.startswith('.')
+    )
+
+
+def make_image(size, image_format='PNG'):
+    output = io.BytesIO()
+    Image.new('RGB', size, 'red').save(output, image_format)
+    return output.getvalue()
+
+
+@unittest.skipIf(Image is None, 'Pillow is required')
+class TestRender(unittest.TestCase):
+    def test_sizes(self):
+        content = make_image((400, 200))
+        with Image.open(io.BytesIO(render(content, 't', PNG))) as image:
+            self.assertEqual(image.size, (160, 80))
+            self.assertEqual(image.format, 'PNG')
+        with Image.open(io.BytesIO(render(content, 's', JPEG))) as image:
+            self.assertEqual(image.size, (90, 90))
+            self.assertEqual(image.format, 'JPEG')
+
+        # Never enlarged
+        with Image.open(io.BytesIO(render(content, 'h', PNG))) as image:
+            self.assertEqual(image.size, (400, 200))
+
+        with self.assertRaises(ThumbnailError):
+            render(b'GIF89a', 't', PNG)
+
+    def test_transcode(self):
+        content = make_image((400, 200))
+        with Image.open(io.BytesIO(render(content, None, WEBP))) as image:
+            self.assertEqual(image.size, (400, 200))
+            self.assertEqual(image.format, 'WEBP')
+        with Image.open(io.BytesIO(render(content, None, AVIF))) as image:
+            self.assertEqual(image.format, 'AVIF')
+
+        # Formats Pillow can't encode
+        with patch.dict(Image.SAVE):
+            del Image.SAVE['AVIF']
+            self.assertFalse(encodable(AVIF))
+            with self.assertRaises(ThumbnailError):
+                render(content, None, AVIF)
+        self.assertTrue(encodable(AVIF))
+
+        # Animations are left alone
+        frames = [Image.new('RGB', (10, 10), color) for color in ('red', 'blue')]
+        output = io.BytesIO()
+        frames[0].save(output, 'GIF', save_all=True, append_images=frames[1:])
+        with self.assertRaises(ThumbnailError):
+            render(output.getvalue(), None, WEBP)
+
+
+@unittest.skipIf(Image is None, 'Pillow is required')
+class TestThumbnailCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.thumbnails = ThumbnailCache(self.folder, max_bytes=10000)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_make(self):
+        content = make_image((400, 200))
+        reads = 0
+
+        async def read():
+            nonlocal reads
+            reads += 1
+            return content
+
+        # Concurrent requests wait for the same job
+        results = await asyncio.gather(
+            *(self.thumbnails.make('image.png', 'm', PNG, read) for _ in range(5))
+        )
+        self.assertEqual(reads, 1)
+        self.assertEqual(len(set(results)), 1)
+
+        path = self.thumbnails.path('image.png', 'm', PNG)
+        self.assertEqual(await self.thumbnails.get(path), results[0])
+        await self.thumbnails.discard('image.png')
+        self.assertIsNone(await self.thumbnails.get(path))
+
+    async def test_evict(self):
+        now = time.time()
+        for number in range(4):
+            path = self.thumbnails.path(f'{number}.png', 't', PNG)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as file:
+                file.write(b'a' * 3000)
+            os.utime(path, (now - 1000 + number, now - 1000 + number))
+
+        # Used, so no longer the least recently used one
+        path = self.thumbnails.path('0.png', 't', PNG)
+        self.assertIsNotNone(await self.thumbnails.get(path))
+
+        self.assertEqual(self.thumbnails.evict(), 1)
+        self.assertEqual(thumbnail_folders(self.folder), ['0.png', '2.png', '3.png'])
+
+        # The size is known from now on, so the cache is not scanned again
+        # while it is within its budget
+        with patch('os.scandir', side_effect=AssertionError):
+            self.assertEqual(self.thumbnails.evict(), 0)
+
+    async def test_size(self):
+        async def read():
+            return make_image((400, 200))
+
+        # Not known until the cache has been scanned once
+        self.assertEqual(self.thumbnails.evict(), 0)
+        first = await self.thumbnails.make('first.png', 'm', PNG, read)
+        second = await self.thumbnails.make('second.png', 't', PNG, read)
+        size = os.path.join(self.folder, '.thumbnails', '.size')
+        with open(size, 'rb') as file:
+            self.assertEqual(int.from_bytes(file.read(), 'little'), len(first) + len(second))
+
+        await self.thumbnails.discard('first.png')
+        with open(size, 'rb') as file:
+            self.assertEqual(int.from_bytes(file.read(), 'little'), len(second))
+
+
+@unittest.skipIf(Image is None, 'Pillow is required')
+class TestThumbnailWebApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.app = create_app(settings={
+            "folder": self.folder,
+            "contact_name": "Average Joe",
+            "contact_url": "http://0.0.0.0:8080/",
+            "contact_email": "averagejoe@example.com",
+            "baseurl": "http://0.0.0.0:8080/",
+            "enable_thumbnails": True,
+        })
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_thumbnails(self):
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.jpg', make_image((400, 200), 'JPEG'), 'image/jpeg')}
+            )
+            filename = response.json()['data']['deletehash']
+
+            for _ in range(2):
+                response = await client.get(f'/image/{filename}', params={'size': 'l'})
+                self.assertEqual(response.status_code,  200)
+                self.assertEqual(response.headers['content-type'], 'image/jpeg')
+                with Image.open(io.BytesIO(response.content)) as image:
+                    self.assertEqual(image.size, (400, 200))
+            etag = response.headers['etag']
+
+            response = await client.get(f'/image/{filename}', params={'size': 'b'})
+            with Image.open(io.BytesIO(response.content)) as image:
+                self.assertEqual(image.size, (160, 160))
+            self.assertNotEqual(response.headers['etag'], etag)
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(self.folder, '.thumbnails', filename))),
+                ['b.jpg', 'l.jpg']
+            )
+
+            response = await client.get(f'/image/{filename}', params={'size': 'x'})
+            self.assertEqual(response.status_code,  422)
+            response = await client.get('/image/missing.jpg', params={'size': 'b'})
+            self.assertEqual(response.status_code,  404)
+
+            response = await client.delete(f'/image/{filename}')
+            self.assertEqual(response.status_code,  204)
+            self.assertEqual(thumbnail_folders(self.folder), [])
+
+
+@unittest.skipIf(Image is None, 'Pillow is required')
+class TestTranscodeWebApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.app = create_app(settings={
+            "folder": self.folder,
+            "contact_name": "Average Joe",
+            "contact_url": "http://0.0.0.0:8080/",
+            "contact_email": "averagejoe@example.com",
+            "baseurl": "http://0.0.0.0:8080/",
+            "transcode_formats": ["webp"],
+        })
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_transcode(self):
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            content = make_image((400, 200))
+            response = await client.post(
+                '/upload', files={'image': ('image.png', content, 'image/png')}
+            )
+            filename = response.json()['data']['deletehash']
+            headers = {'Accept': 'image/webp,*/*'}
+
+            # The original is served while the transcode is made
+            response = await client.get(f'/image/{filename}', headers=headers)
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.headers['content-type'], 'image/png')
+            self.assertEqual(response.headers['vary'], 'Accept')
+
+            path = os.path.join(self.folder, '.thumbnails', filename, 'full.webp')
+            for _ in range(100):
+                if os.path.exists(path):
+                    break
+                await asyncio.sleep(0.05)
+
+            response = await client.get(f'/image/{filename}', headers=headers)
+            self.assertEqual(response.headers['content-type'], 'image/webp')
+            self.assertEqual(response.headers['vary'], 'Accept')
+            self.assertTrue(response.headers['etag'].endswith('-webp"'))
+            self.assertLess(len(response.content), len(content))
+            with Image.open(io.BytesIO(response.content)) as image:
+                self.assertEqual(image.size, (400, 200))
+
+            response = await client.head(f'/image/{filename}', headers=headers)
+            self.assertEqual(response.headers['content-type'], 'image/webp')
+
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.headers['content-type'], 'image/png')
+            self.assertEqual(response.content, content)
+
+            response = await client.delete(f'/image/{filename}')
+            self.assertEqual(response.status_code,  204)
+            self.assertEqual(thumbnail_folders(self.folder), [])
+
+    async def test_unencodable(self):
+        with patch.dict(Image.SAVE):
+            del Image.SAVE['WEBP']
+            with self.assertLogs('anastasia', 'WARNING'):
+                app = create_app(settings={
+                    "folder": self.folder,
+                    "contact_name": "Average Joe",
+                    "contact_url": "http://0.0.0.0:8080/",
+                    "contact_email": "averagejoe@example.com",
+                    "baseurl": "http://0.0.0.0:8080/",
+                    "transcode_formats": ["webp"],
+                })
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            content = make_image((400, 200))
+            response = await client.post(
+                '/upload', files={'image': ('image.png', content, 'image/png')}
+            )
+            filename = response.json()['data']['deletehash']
+            response = await client.get(
+                f'/image/{filename}', headers={'Accept': 'image/webp,*/*'}
+            )
+            self.assertEqual(response.headers['content-type'], 'image/png')
+            self.assertNotIn('vary', response.headers)
@@ -0,0 +1,162 @@
+import unittest
+import os
+import tempfile
+import time
+from shutil import rmtree
+
+from httpx import AsyncClient, ASGITransport
+
+from anastasia import create_app
+from anastasia.uploads import UploadConflictError, UploadSessions
+
+
+async def iterate(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class TestUploadSessions(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.uploads = UploadSessions(self.folder, timeout=60, max_bytes=100)
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_append(self):
+        with self.assertRaises(ValueError):
+            await self.uploads.create(101)
+
+        session_id = await self.uploads.create(10)
+        self.assertEqual(await self.uploads.status(session_id), (0, 10))
+        self.assertEqual(await self.uploads.append(session_id, 0, iterate(b'abc', b'de')), 5)
+        self.assertEqual(await self.uploads.status(session_id), (5, 10))
+
+        with self.assertRaises(UploadConflictError):
+            await self.uploads.append(session_id, 3, iterate(b'fgh'))
+        with self.assertRaises(UploadConflictError):
+            with self.uploads.open(session_id):
+                pass
+
+        # Chunks that don't fit are refused whole
+        with self.assertRaises(ValueError):
+            await self.uploads.append(session_id, 5, iterate(b'fg', b'hijkl'))
+        self.assertEqual(await self.uploads.status(session_id), (7, 10))
+
+        self.assertEqual(await self.uploads.append(session_id, 7, iterate(b'hij')), 10)
+        with self.uploads.open(session_id) as file:
+            self.assertEqual(file.read(), b'abcdefghij')
+            # Locked while it is read
+            with self.assertRaises(UploadConflictError):
+                await self.uploads.append(session_id, 10, iterate(b''))
+
+        await self.uploads.discard(session_id)
+        self.assertIsNone(await self.uploads.status(session_id))
+        with self.assertRaises(FileNotFoundError):
+            await self.uploads.append(session_id, 0, iterate(b'abc'))
+
+    async def test_expire(self):
+        old = await self.uploads.create(10)
+        new = await self.uploads.create(10)
+        past = time.time() - 120
+        os.utime(self.uploads.path(old), (past, past))
+
+        self.assertEqual(self.uploads.expire(), 1)
+        self.assertIsNone(await self.uploads.status(old))
+        self.assertEqual(await self.uploads.status(new), (0, 10))
+        self.assertEqual(sorted(os.listdir(self.uploads.root)), [new, f'{new}.json'])
+
+
+class TestUploadWebApp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.app = create_app(settings={
+            "folder": self.folder,
+            "contact_name": "Average Joe",
+            "contact_url": "http://0.0.0.0:8080/",
+            "contact_email": "averagejoe@example.com",
+            "baseurl": "http://0.0.0.0:8080/",
+            "enable_resumable_uploads": True,
+        })
+
+    def tearDown(self):
+        rmtree(self.folder)
+
+    async def test_resumable_upload(self):
+        content = b'GIF89a' + os.urandom(100000)
+        headers = {'Content-Type': 'application/offset+octet-stream'}
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post('/uploads', headers={'Upload-Length': str(len(content))})
+            self.assertEqual(response.status_code,  201)
+            session_id = response.json()['data']['id']
+            self.assertEqual(
+                response.headers['location'], f'http://0.0.0.0:8080/api/3/uploads/{session_id}'
+            )
+
+            response = await client.patch(
+                f'/uploads/{session_id}', content=content[:60000],
+                headers={**headers, 'Upload-Offset': '0'}
+            )
+            self.assertEqual(response.status_code,  204)
+            self.assertEqual(response.headers['upload-offset'], '60000')
+
+            response = await client.post(f'/uploads/{session_id}/finalize')
+            self.assertEqual(response.status_code,  409)
+
+            response = await client.patch(
+                f'/uploads/{session_id}', content=content[50000:],
+                headers={**headers, 'Upload-Offset': '50000'}
+            )
+            self.assertEqual(response.status_code,  409)
+            response = await client.patch(
+                f'/uploads/{session_id}', content=content[60000:],
+                headers={'Upload-Offset': '60000'}
+            )
+            self.assertEqual(response.status_code,  415)
+
+            response = await client.head(f'/uploads/{session_id}')
+            self.assertEqual(response.headers['upload-offset'], '60000')
+            offset = int(response.headers['upload-offset'])
+            response = await client.patch(
+                f'/uploads/{session_id}', content=content[offset:],
+                headers={**headers, 'Upload-Offset': str(offset)}
+            )
+            self.assertEqual(response.headers['upload-offset'], str(len(content)))
+
+            response = await client.post(f'/uploads/{session_id}/finalize')
+            self.assertEqual(response.status_code,  200)
+            image_hash = response.json()['data']['deletehash']
+            self.assertTrue(image_hash.endswith('.gif'))
+            response = await client.get(f'/image/{image_hash}')
+            self.assertEqual(response.content, content)
+
+            response = await client.head(f'/uploads/{session_id}')
+            self.assertEqual(response.status_code,  404)
+            response = await client.post(f'/uploads/{session_id}/finalize')
+            self.assertEqual(response.status_code,  404)
+
+            # Sessions whose content is not an image are dropped
+            response = await client.post('/uploads', headers={'Upload-Length': '4'})
+            session_id = response.json()['data']['id']
+            await client.patch(
+                f'/uploads/{session_id}', content=b'<a/>', headers={**headers, 'Upload-Offset': '0'}
+            )
+            response = await client.post(f'/uploads/{session_id}/finalize')
+            self.assertEqual(response.status_code,  400)
+            response = await client.head(f'/uploads/{session_id}')
+            self.assertEqual(response.status_code,  404)
+
+            response = await client.post('/uploads', headers={'Upload-Length': '4'})
+            session_id = response.json()['data']['id']
+            response = await client.delete(f'/uploads/{session_id}')
+            self.assertEqual(response.status_code,  204)
+            response = await client.delete(f'/uploads/{session_id}')
+            self.assertEqual(response.status_code,  404)
+
+            response = await client.post(
+                '/uploads', headers={'Upload-Length': str(64 * 1024 * 1024)}
+            )
+            self.assertEqual(response.status_code,  413)
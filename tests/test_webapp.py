@@ -1,11 +1,17 @@
 import unittest
+import asyncio
+import base64
 import os
+import struct
 import tempfile
+import time
 from shutil import rmtree
+from unittest.mock import patch
 
 from httpx import AsyncClient, ASGITransport
 
 from anastasia import create_app
+from anastasia.bloom import BloomFilter
 
 
 class TestWebApp(unittest.IsolatedAsyncioTestCase):
@@ -83,6 +89,694 @@ class TestWebApp(unittest.IsolatedAsyncioTestCase):
             )
         self.assertEqual(response.status_code,  404)
 
+    async def test_batch(self):
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            content = image.read()
+
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload/batch',
+                files=[
+                    ('images', ('first.gif', content)),
+                    ('images', ('broken.gif', b'<html></html>')),
+                    ('images', ('second.gif', content)),
+                ]
+            )
+            self.assertEqual(response.status_code,  200)
+            items = response.json()['data']
+            self.assertEqual([item['status'] for item in items], [200, 400, 200])
+            self.assertEqual([item['filename'] for item in items],
+                             ['first.gif', 'broken.gif', 'second.gif'])
+            self.assertEqual(items[1]['error'], 'Unsupported image format')
+            hashes = [items[0]['deletehash'], items[2]['deletehash']]
+            for image_hash in hashes:
+                response = await client.get(f'/image/{image_hash}')
+                self.assertEqual(response.content, content)
+
+            response = await client.post(
+                '/upload/batch', files=[('images', ('image.gif', content))] * 101
+            )
+            self.assertEqual(response.status_code,  400)
+
+            response = await client.post(
+                '/delete/batch', json={'hashes': [hashes[0], 'missing.gif', '../x', hashes[1]]}
+            )
+            self.assertEqual(response.status_code,  200)
+            items = response.json()['data']
+            self.assertEqual([item['status'] for item in items], [204, 404, 400, 204])
+            self.assertEqual(items[1]['deletehash'], 'missing.gif')
+            for image_hash in hashes:
+                response = await client.get(f'/image/{image_hash}')
+                self.assertEqual(response.status_code,  404)
+
+            response = await client.post('/delete/batch', json={'hashes': []})
+            self.assertEqual(response.status_code,  422)
+
+    async def test_chunked_upload(self):
+        data = b"GIF89a" + os.urandom(3 * 1024 * 1024)
+
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  200)
+            filename = response.json()['data']['deletehash']
+
+            response = await client.get(
+                f'/image/{filename}'
+            )
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, data)
+
+        # Temporary files are renamed into place
+        self.assertEqual(os.listdir(self.settings['folder']), [filename])
+
+    async def test_conditional_get(self):
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+
+        transport = ASGITransport(app=self.app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            with open(filename, "rb") as image:
+                response = await client.post(
+                    '/upload',
+                    files={'image': ('image.gif', image)}
+                )
+            self.assertEqual(
+                response.headers['content-security-policy'], "default-src 'none'"
+            )
+            filename = response.json()['data']['deletehash']
+
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.headers['x-content-type-options'], 'nosniff')
+            self.assertEqual(response.headers['x-frame-options'], 'deny')
+            self.assertNotIn('content-security-policy', response.headers)
+            self.assertIn('immutable', response.headers['cache-control'])
+            etag = response.headers['etag']
+            last_modified = response.headers['last-modified']
+
+            response = await client.get(
+                f'/image/{filename}', headers={'If-None-Match': f'"other", {etag}'}
+            )
+            self.assertEqual(response.status_code,  304)
+            self.assertEqual(response.content, b'')
+            self.assertEqual(response.headers['etag'], etag)
+
+            response = await client.get(
+                f'/image/{filename}', headers={'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(response.status_code,  304)
+
+            # If-None-Match takes precedence over If-Modified-Since
+            response = await client.get(
+                f'/image/{filename}',
+                headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified}
+            )
+            self.assertEqual(response.status_code,  200)
+
+    async def test_range_and_head(self):
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        for memory_cache_bytes in (0, 1024 * 1024):
+            self.settings['memory_cache_bytes'] = memory_cache_bytes
+            app = create_app(settings=self.settings)
+
+            transport = ASGITransport(app=app)
+            async with AsyncClient(
+                transport=transport, base_url="http://0.0.0.0:8080/api/3"
+            ) as client:
+                response = await client.post(
+                    '/upload',
+                    files={'image': ('image.gif', data, 'image/gif')}
+                )
+                filename = response.json()['data']['deletehash']
+
+                response = await client.head(f'/image/{filename}')
+                self.assertEqual(response.status_code,  200)
+                self.assertEqual(response.content, b'')
+                self.assertEqual(response.headers['content-length'], str(len(data)))
+                self.assertEqual(response.headers['accept-ranges'], 'bytes')
+                etag = response.headers['etag']
+
+                response = await client.head('/image/missing.gif')
+                self.assertEqual(response.status_code,  404)
+
+                response = await client.get(f'/image/{filename}', headers={'Range': 'bytes=2-5'})
+                self.assertEqual(response.status_code,  206)
+                self.assertEqual(response.content, data[2:6])
+                self.assertEqual(response.headers['content-range'], f'bytes 2-5/{len(data)}')
+
+                response = await client.get(f'/image/{filename}', headers={'Range': 'bytes=-3'})
+                self.assertEqual(response.content, data[-3:])
+
+                response = await client.get(
+                    f'/image/{filename}', headers={'Range': 'bytes=0-1,4-5'}
+                )
+                self.assertEqual(response.status_code,  206)
+                self.assertTrue(
+                    response.headers['content-type'].startswith('multipart/byteranges')
+                )
+                self.assertEqual(response.headers['content-length'], str(len(response.content)))
+                self.assertIn(data[0:2], response.content)
+                self.assertIn(f'Content-Range: bytes 4-5/{len(data)}'.encode(), response.content)
+
+                response = await client.get(
+                    f'/image/{filename}', headers={'Range': f'bytes={len(data)}-'}
+                )
+                self.assertEqual(response.status_code,  416)
+                self.assertEqual(response.headers['content-range'], f'bytes */{len(data)}')
+
+                # The image changed since the client got its part
+                response = await client.get(
+                    f'/image/{filename}', headers={'Range': 'bytes=2-5', 'If-Range': '"other"'}
+                )
+                self.assertEqual(response.status_code,  200)
+                self.assertEqual(response.content, data)
+                response = await client.get(
+                    f'/image/{filename}', headers={'Range': 'bytes=2-5', 'If-Range': etag}
+                )
+                self.assertEqual(response.status_code,  206)
+
+    async def test_pack_storage(self):
+        self.settings['storage'] = 'pack'
+        self.settings['enable_index'] = True
+        app = create_app(settings=self.settings)
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            hashes = []
+            for _ in range(2):
+                response = await client.post(
+                    '/upload',
+                    files={'image': ('image.gif', data, 'image/gif')}
+                )
+                hashes.append(response.json()['data']['deletehash'])
+
+            # Both images live in the same segment
+            packs = os.listdir(os.path.join(self.settings['folder'], '.packs'))
+            self.assertEqual([name for name in packs if name.endswith('.pack')],
+                             ['segment-000001.pack'])
+            self.assertNotIn(hashes[0], os.listdir(self.settings['folder']))
+
+            response = await client.get(f'/image/{hashes[1]}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, data)
+            response = await client.get(f'/image/{hashes[1]}', headers={'Range': 'bytes=2-5'})
+            self.assertEqual(response.content, data[2:6])
+
+            response = await client.get('/images')
+            self.assertEqual(len(response.json()['data']['images']), 2)
+
+            response = await client.delete(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  204)
+            response = await client.get(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  404)
+            response = await client.delete(f'/image/{hashes[0]}')
+            self.assertEqual(response.status_code,  404)
+
+    async def test_memory_cache(self):
+        self.settings['memory_cache_bytes'] = 1024 * 1024
+        app = create_app(settings=self.settings)
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            with open(filename, "rb") as image:
+                data = image.read()
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            filename = response.json()['data']['deletehash']
+
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, data)
+            self.assertEqual(response.headers['content-type'], 'image/gif')
+
+            response = await client.delete(f'/image/{filename}')
+            self.assertEqual(response.status_code,  204)
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.status_code,  404)
+
+            response = await client.get('/cache')
+            stats = response.json()['data']
+            self.assertEqual(stats['hits'], 1)
+            self.assertEqual(stats['items'], 0)
+
+    async def test_index(self):
+        self.settings['enable_index'] = True
+        app = create_app(settings=self.settings)
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+
+        # Files that are not in the index do not exist
+        with open(os.path.join(self.settings['folder'], 'unindexed.gif'), 'wb') as image:
+            image.write(b'GIF89a')
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.get('/image/unindexed.gif')
+            self.assertEqual(response.status_code,  404)
+
+            with open(filename, "rb") as image:
+                data = image.read()
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            filename = response.json()['data']['deletehash']
+
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.status_code,  200)
+            self.assertEqual(response.content, data)
+            self.assertEqual(response.headers['content-length'], str(len(data)))
+
+            response = await client.delete(f'/image/{filename}')
+            self.assertEqual(response.status_code,  204)
+            response = await client.delete(f'/image/{filename}')
+            self.assertEqual(response.status_code,  404)
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.status_code,  404)
+
+    async def test_ttl(self):
+        self.settings['enable_index'] = True
+        app = create_app(settings=self.settings)
+        with open(os.path.join(os.path.dirname(__file__), 'image.gif'), "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload', files={'image': ('image.gif', data)}, data={'ttl': '1'}
+            )
+            expiring = response.json()['data']['deletehash']
+            response = await client.post('/upload', files={'image': ('image.gif', data)})
+            kept = response.json()['data']['deletehash']
+
+            response = await client.get(f'/image/{expiring}')
+            self.assertEqual(response.status_code,  200)
+            # Not cached beyond expiry
+            self.assertNotIn('31536000', response.headers['cache-control'])
+
+            await asyncio.sleep(1.1)
+            # Gone before it is removed
+            response = await client.get(f'/image/{expiring}')
+            self.assertEqual(response.status_code,  404)
+            self.assertTrue(os.path.exists(os.path.join(self.settings['folder'], expiring)))
+
+            # Removed by the reaper, which runs along with the app
+            async with app.router.lifespan_context(app):
+                for _ in range(50):
+                    if not os.path.exists(os.path.join(self.settings['folder'], expiring)):
+                        break
+                    await asyncio.sleep(0.02)
+            self.assertFalse(os.path.exists(os.path.join(self.settings['folder'], expiring)))
+            response = await client.get(f'/image/{kept}')
+            self.assertEqual(response.status_code,  200)
+
+        # Expiry requires the index
+        self.settings['enable_index'] = False
+        self.settings['default_ttl'] = 60
+        with self.assertRaises(ValueError):
+            create_app(settings=self.settings)
+        app = create_app(settings={**self.settings, 'default_ttl': 0})
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post(
+                '/upload', files={'image': ('image.gif', data)}, data={'ttl': '60'}
+            )
+            self.assertEqual(response.status_code,  400)
+
+    async def test_ttl_deduplicated(self):
+        self.settings['enable_index'] = True
+        self.settings['deduplicate'] = True
+        app = create_app(settings=self.settings)
+        with open(os.path.join(os.path.dirname(__file__), 'image.gif'), "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            response = await client.post('/upload', files={'image': ('image.gif', data)})
+            first = response.json()['data']['deletehash']
+
+            # The shared content was stored a day ago
+            blobs = os.path.join(self.settings['folder'], '.blobs')
+            for root, _, files in os.walk(blobs):
+                for filename in files:
+                    yesterday = time.time() - 86400
+                    os.utime(os.path.join(root, filename), (yesterday, yesterday))
+
+            response = await client.post(
+                '/upload', files={'image': ('image.gif', data)}, data={'ttl': '3600'}
+            )
+            self.assertEqual(response.status_code,  200)
+            second = response.json()['data']['deletehash']
+
+            response = await client.get(f'/image/{second}')
+            self.assertEqual(response.status_code,  200)
+            response = await client.get('/images')
+            hashes = [image['deletehash'] for image in response.json()['data']['images']]
+            self.assertEqual(hashes, [second, first])
+
+    async def test_sniffing(self):
+        self.settings['max_image_pixels'] = 100
+        app = create_app(settings=self.settings)
+        png = b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', 10, 10)
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            # The claimed type and name don't matter
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.txt', png, 'application/octet-stream')}
+            )
+            self.assertEqual(response.status_code,  200)
+            filename = response.json()['data']['deletehash']
+            self.assertTrue(filename.endswith('.png'))
+            response = await client.get(f'/image/{filename}')
+            self.assertEqual(response.headers['content-type'], 'image/png')
+            self.assertEqual(response.content, png)
+
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', b'<?php echo 1; ?>', 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  400)
+
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.png', png[:16] + struct.pack('>II', 11, 10), 'image/png')}
+            )
+            self.assertEqual(response.status_code,  400)
+        self.assertEqual(len(os.listdir(self.settings['folder'])), 1)
+
+    async def test_list_images(self):
+        self.settings['enable_index'] = True
+        app = create_app(settings=self.settings)
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            uploaded = set()
+            for _ in range(3):
+                response = await client.post(
+                    '/upload',
+                    files={'image': ('image.gif', b'GIF89a', 'image/gif')}
+                )
+                uploaded.add(response.json()['data']['deletehash'])
+
+            listed = set()
+            cursor = None
+            while True:
+                params = {'limit': 2}
+                if cursor:
+                    params['cursor'] = cursor
+                response = await client.get('/images', params=params)
+                self.assertEqual(response.status_code,  200)
+                data = response.json()['data']
+                listed.update(image['deletehash'] for image in data['images'])
+                cursor = data['cursor']
+                if cursor is None:
+                    break
+            self.assertEqual(listed, uploaded)
+
+            for cursor in ('!', base64.urlsafe_b64encode(b'abc:x.gif'), 'YWJj'):
+                response = await client.get('/images', params={'cursor': cursor})
+                self.assertEqual(response.status_code,  400)
+                self.assertEqual(response.json()['detail'], 'Invalid cursor')
+
+            response = await client.get('/stats')
+            self.assertEqual(
+                response.json()['data'],
+                {'count': 3, 'bytes': 18, 'types': {'image/gif': {'count': 3, 'bytes': 18}}}
+            )
+
+    async def test_max_upload_bytes(self):
+        self.settings['max_upload_bytes'] = 1024
+        app = create_app(settings=self.settings)
+        data = b"GIF89a" + os.urandom(4096)
+        body = (
+            b'--xyz\r\nContent-Disposition: form-data; name="image"; '
+            b'filename="image.gif"\r\nContent-Type: image/gif\r\n\r\n'
+            + data + b'\r\n--xyz--\r\n'
+        )
+
+        async def chunked_body():
+            for offset in range(0, len(body), 512):
+                yield body[offset:offset + 512]
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            # Rejected upfront because of Content-Length
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  413)
+
+            # Rejected while the body is being received
+            response = await client.post(
+                '/upload',
+                content=chunked_body(),
+                headers={'Content-Type': 'multipart/form-data; boundary=xyz'}
+            )
+            self.assertEqual(response.status_code,  413)
+
+        self.assertEqual(os.listdir(self.settings['folder']), [])
+
+    async def test_admission(self):
+        self.settings['upload_concurrency'] = 1
+        self.settings['upload_queue'] = 0
+        self.settings['queue_timeout'] = 0.1
+        app = create_app(settings=self.settings)
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, 'rb') as image:
+            data = image.read()
+        body = (
+            b'--xyz\r\nContent-Disposition: form-data; name="image"; '
+            b'filename="image.gif"\r\nContent-Type: image/gif\r\n\r\n'
+            + data + b'\r\n--xyz--\r\n'
+        )
+        started = asyncio.Event()
+        resume = asyncio.Event()
+
+        async def slow_body():
+            yield body[:10]
+            started.set()
+            await resume.wait()
+            yield body[10:]
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            # A slow upload holds the only upload slot
+            slow = asyncio.create_task(client.post(
+                '/upload',
+                content=slow_body(),
+                headers={'Content-Type': 'multipart/form-data; boundary=xyz'}
+            ))
+            await started.wait()
+
+            # Other uploads are shed right away
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  503)
+            self.assertEqual(response.headers['retry-after'], '1')
+            self.assertEqual(response.headers['x-content-type-options'], 'nosniff')
+
+            # Reads go through their own lane
+            response = await client.get('/image/missing.gif')
+            self.assertEqual(response.status_code,  404)
+
+            resume.set()
+            response = await slow
+            self.assertEqual(response.status_code,  200)
+
+            # The slot is given back
+            response = await client.post(
+                '/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertEqual(response.status_code,  200)
+
+    async def test_rate_limit(self):
+        self.settings['rate_limit'] = 1
+        self.settings['rate_limit_burst'] = 2
+        app = create_app(settings=self.settings)
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            for _ in range(2):
+                response = await client.get('/image/missing.gif')
+                self.assertEqual(response.status_code,  404)
+            response = await client.get('/image/missing.gif')
+            self.assertEqual(response.status_code,  429)
+            self.assertEqual(response.headers['retry-after'], '1')
+            self.assertEqual(response.headers['x-frame-options'], 'deny')
+
+        # Nodes of the cluster, given by name, are not rate limited
+        self.settings['cluster_nodes'] = ['http://localhost:8001']
+        self.settings['cluster_node'] = 'http://localhost:8001'
+        app = create_app(settings=self.settings)
+        transport = ASGITransport(app=app)
+        async with AsyncClient(
+            transport=transport, base_url="http://0.0.0.0:8080/api/3"
+        ) as client:
+            for _ in range(3):
+                response = await client.get('/image/missing.gif')
+                self.assertEqual(response.status_code,  404)
+
+    async def test_bloom_filter(self):
+        self.settings['enable_bloom_filter'] = True
+        self.settings['enable_metrics'] = True
+        app = create_app(settings=self.settings)
+        # Built by the lifespan, which the transport doesn't run
+        BloomFilter(self.settings['folder']).rebuild([])
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://0.0.0.0:8080") as client:
+            response = await client.post(
+                '/api/3/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            filename = response.json()['data']['deletehash']
+            response = await client.get(f'/api/3/image/{filename}')
+            self.assertEqual(response.status_code, 200)
+
+            # Answered without touching the storage
+            response = await client.get('/api/3/image/missing.gif')
+            self.assertEqual(response.status_code, 404)
+            response = await client.delete('/api/3/image/missing.gif')
+            self.assertEqual(response.status_code, 404)
+            response = await client.get('/metrics')
+            # Made by the upload and by the GET of the uploaded image
+            self.assertIn(
+                'anastasia_fs_operation_duration_seconds_count{operation="stat"} 2', response.text
+            )
+            self.assertIn('anastasia_bloom_filter_images{state="added"} 1', response.text)
+
+            response = await client.delete(f'/api/3/image/{filename}')
+            self.assertEqual(response.status_code, 204)
+            response = await client.get(f'/api/3/image/{filename}')
+            self.assertEqual(response.status_code, 404)
+            response = await client.get('/metrics')
+            self.assertIn('anastasia_bloom_filter_images{state="deleted"} 1', response.text)
+            self.assertIn('anastasia_bloom_filter_rebuild_seconds', response.text)
+
+    async def test_bloom_filter_rebuild_race(self):
+        self.settings['enable_bloom_filter'] = True
+        self.settings['enable_index'] = True
+        folder = self.settings['folder']
+
+        class RacingBloomFilter(BloomFilter):
+            def add(self, image_hash, again=False):
+                super().add(image_hash, again)
+                if not RacingBloomFilter.racing:
+                    # A rebuild runs between the upload and its commit to the
+                    # index, so its listing misses the image
+                    RacingBloomFilter.racing = True
+                    BloomFilter(folder).rebuild([])
+
+        RacingBloomFilter.racing = False
+        with patch('anastasia.webapp.BloomFilter', RacingBloomFilter):
+            app = create_app(settings=self.settings)
+        BloomFilter(folder).rebuild([])
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://0.0.0.0:8080") as client:
+            response = await client.post(
+                '/api/3/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            self.assertTrue(RacingBloomFilter.racing)
+            filename = response.json()['data']['deletehash']
+            response = await client.get(f'/api/3/image/{filename}')
+            self.assertEqual(response.status_code, 200)
+
+    async def test_metrics(self):
+        self.settings['enable_metrics'] = True
+        self.settings['enable_index'] = True
+        app = create_app(settings=self.settings)
+        filename = os.path.join(os.path.dirname(__file__), 'image.gif')
+        with open(filename, "rb") as image:
+            data = image.read()
+
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://0.0.0.0:8080") as client:
+            response = await client.post(
+                '/api/3/upload',
+                files={'image': ('image.gif', data, 'image/gif')}
+            )
+            filename = response.json()['data']['deletehash']
+            for _ in range(2):
+                response = await client.get(f'/api/3/image/{filename}')
+            response = await client.get('/api/3/image/missing.gif')
+            self.assertEqual(response.status_code, 404)
+
+            response = await client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        metrics = response.text
+
+        # Routes are labelled with their template, not with the image name
+        self.assertIn(
+            'anastasia_request_duration_seconds_count{route="/api/3/image/{image_hash}",'
+            'method="GET",status="200"} 2',
+            metrics
+        )
+        self.assertIn(
+            'anastasia_request_duration_seconds_count{route="/api/3/image/{image_hash}",'
+            'method="GET",status="404"} 1',
+            metrics
+        )
+        self.assertIn(f'anastasia_uploaded_bytes_total {len(data)}', metrics)
+        self.assertIn('anastasia_fs_operation_duration_seconds_count{operation="write"} 1', metrics)
+        # The request for the metrics themselves is in flight
+        self.assertIn('anastasia_requests_in_flight 1', metrics)
+        self.assertIn('anastasia_images{media_type="image/gif"} 1', metrics)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)